@@ -0,0 +1,251 @@
+"""
+Write-behind audit log of reads of patient records.
+
+Endpoints call record() with the JWT user and the patient whose data was
+read; it only appends to an in-process bounded queue, so a read costs no
+extra DB round trip. A background task drains the queue and writes each
+batch (up to BATCH_SIZE events, at least every FLUSH_INTERVAL_SECONDS) with
+one COPY into audit_log. stop() — called from the app lifespan on shutdown —
+flushes whatever is left.
+
+audit_log is append-only (a trigger rejects UPDATE and DELETE) and
+range-partitioned by month. Partitions are created PARTITIONS_AHEAD months
+ahead at startup and by `python audit.py ensure`; a default partition
+catches anything outside them so a missed month never loses events. If the
+default already holds rows for a month being created, it is swapped for an
+empty one and its rows are routed again. occurred_at and the partition
+bounds are both UTC. Old months are removed by detaching and dropping
+partitions, which the trigger does not block.
+
+When the queue is full, events are dropped and counted (audit.dropped)
+rather than slowing requests down. A failed COPY is retried with the next
+batch while the retry buffer has room.
+"""
+
+import argparse
+import asyncio
+import csv
+import datetime
+import io
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+import metrics
+from db import connect
+
+logger = logging.getLogger("tms")
+
+QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", "10000"))
+BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", "500"))
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("AUDIT_FLUSH_INTERVAL_SECONDS", "1"))
+PARTITIONS_AHEAD = int(os.environ.get("AUDIT_PARTITIONS_AHEAD", "3"))
+SHUTDOWN_TIMEOUT_SECONDS = 10
+
+# No foreign key to patients: the trail must outlive the record it describes
+DDL = """
+CREATE TABLE IF NOT EXISTS audit_log (
+    occurred_at TIMESTAMP NOT NULL,
+    actor_role TEXT NOT NULL,
+    actor_id INTEGER,
+    patient_id INTEGER NOT NULL,
+    endpoint TEXT NOT NULL
+) PARTITION BY RANGE (occurred_at);
+
+CREATE TABLE IF NOT EXISTS audit_log_default PARTITION OF audit_log DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_audit_patient ON audit_log(patient_id, occurred_at);
+CREATE INDEX IF NOT EXISTS idx_audit_actor   ON audit_log(actor_role, actor_id, occurred_at);
+
+CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'audit_log is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'audit_log_append_only') THEN
+        CREATE TRIGGER audit_log_append_only BEFORE UPDATE OR DELETE ON audit_log
+        FOR EACH ROW EXECUTE FUNCTION audit_log_append_only();
+    END IF;
+END $$;
+"""
+
+COLUMNS = "occurred_at, actor_role, actor_id, patient_id, endpoint"
+
+Event = Tuple[datetime.datetime, str, Optional[int], int, str]
+
+_queue: Optional[asyncio.Queue] = None
+_batch_ready: Optional[asyncio.Event] = None
+_retry: List[Event] = []
+_task: Optional[asyncio.Task] = None
+_stopping = False
+
+
+def ensure_partitions(cur, ahead: int = PARTITIONS_AHEAD) -> int:
+    """Create monthly partitions from this month to `ahead` months out."""
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('audit_partitions'))")
+    # UTC, the clock record() stamps occurred_at with
+    cur.execute("""
+        SELECT m::date, (m + interval '1 month')::date
+        FROM generate_series(date_trunc('month', NOW() AT TIME ZONE 'UTC'),
+                             date_trunc('month', NOW() AT TIME ZONE 'UTC') + make_interval(months => %s),
+                             interval '1 month') AS m
+    """, (ahead,))
+    missing = []
+    for start, end in cur.fetchall():
+        cur.execute("SELECT to_regclass(%s)", (f"audit_log_{start:%Y_%m}",))
+        if cur.fetchone()[0] is None:
+            missing.append((start, end))
+    if not missing:
+        return 0
+
+    # PostgreSQL refuses a partition whose range the default already holds rows
+    # for (events written while the month was missing), and the append-only
+    # trigger forbids moving them out. Swap in an empty default instead.
+    cur.execute(
+        "SELECT EXISTS (SELECT 1 FROM audit_log_default WHERE occurred_at >= %s AND occurred_at < %s)",
+        (missing[0][0], missing[-1][1]),
+    )
+    spilled = cur.fetchone()[0]
+    if spilled:
+        cur.execute("ALTER TABLE audit_log DETACH PARTITION audit_log_default")
+        cur.execute("ALTER TABLE audit_log_default RENAME TO audit_log_default_old")
+    for start, end in missing:
+        cur.execute(f"CREATE TABLE audit_log_{start:%Y_%m} PARTITION OF audit_log FOR VALUES FROM (%s) TO (%s)",
+                    (start, end))
+    if spilled:
+        cur.execute("CREATE TABLE audit_log_default PARTITION OF audit_log DEFAULT")
+        cur.execute(f"INSERT INTO audit_log({COLUMNS}) SELECT {COLUMNS} FROM audit_log_default_old")
+        logger.warning("Audit: routed %d events out of the default partition", cur.rowcount)
+        cur.execute("DROP TABLE audit_log_default_old")
+    return len(missing)
+
+
+def record(user: dict, patient_id: int, endpoint: str) -> None:
+    """Queue one access event; never blocks, never raises."""
+    role = user.get("role", "unknown")
+    actor_id = user.get("doctor_id") if role == "doctor" else user.get("patient_id")
+    if _queue is None:
+        # Not started (scripts, tests) — nothing would flush it
+        metrics.inc("audit.dropped")
+        return
+    try:
+        # UTC, like the partition bounds
+        _queue.put_nowait((datetime.datetime.utcnow(), role, actor_id, int(patient_id), endpoint))
+    except asyncio.QueueFull:
+        metrics.inc("audit.dropped")
+        return
+    metrics.inc("audit.enqueued")
+    metrics.set_gauge("audit.queue_depth", _queue.qsize())
+    if _queue.qsize() >= BATCH_SIZE:
+        _batch_ready.set()
+
+
+def write_batch(events: List[Event]) -> None:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for occurred_at, role, actor_id, patient_id, endpoint in events:
+        writer.writerow((occurred_at.isoformat(), role, "" if actor_id is None else actor_id, patient_id, endpoint))
+    buf.seek(0)
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.copy_expert(f"COPY audit_log({COLUMNS}) FROM STDIN WITH (FORMAT csv)", buf)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _take(limit: int) -> List[Event]:
+    events = []
+    while len(events) < limit:
+        try:
+            events.append(_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return events
+
+
+async def flush() -> int:
+    """Write the retry buffer plus up to BATCH_SIZE queued events."""
+    global _retry
+    events = _retry + _take(BATCH_SIZE)
+    _retry = []
+    metrics.set_gauge("audit.queue_depth", _queue.qsize())
+    if not events:
+        return 0
+    try:
+        await run_in_threadpool(write_batch, events)
+    except Exception:
+        metrics.inc("audit.flush_errors")
+        logger.exception("Audit flush of %d events failed", len(events))
+        keep = events[-QUEUE_SIZE:]
+        metrics.inc("audit.dropped", len(events) - len(keep))
+        _retry = keep
+        raise
+    metrics.inc("audit.flushed", len(events))
+    metrics.inc("audit.batches")
+    return len(events)
+
+
+async def _flush_forever() -> None:
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_batch_ready.wait(), timeout=FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _batch_ready.clear()
+        try:
+            while await flush() >= BATCH_SIZE and not _stopping:
+                pass
+        except Exception:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+
+
+def start() -> None:
+    global _queue, _batch_ready, _task, _stopping
+    _queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    _batch_ready = asyncio.Event()
+    _stopping = False
+    _task = asyncio.ensure_future(_flush_forever())
+
+
+async def stop() -> None:
+    """Let the flusher finish its current batch, then write everything still queued."""
+    global _task, _stopping
+    if _task is None:
+        return
+    _stopping = True
+    _batch_ready.set()
+    await _task
+    _task = None
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_TIMEOUT_SECONDS
+    while (_retry or not _queue.empty()) and loop.time() < deadline:
+        try:
+            await flush()
+        except Exception:
+            await asyncio.sleep(0.5)
+    left = len(_retry) + _queue.qsize()
+    if left:
+        metrics.inc("audit.dropped", left)
+        logger.error("Audit: %d events could not be written before shutdown", left)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain audit_log")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("ensure", help=f"create partitions up to {PARTITIONS_AHEAD} months ahead")
+    parser.parse_args()
+
+    conn = connect()
+    try:
+        created = ensure_partitions(conn.cursor())
+        conn.commit()
+        print(f"{created} partitions created")
+    finally:
+        conn.close()
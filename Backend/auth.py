@@ -1,5 +1,7 @@
 import os
 import datetime
+import hashlib
+import hmac
 import secrets
 from dotenv import load_dotenv
 from jose import jwt, JWTError
@@ -11,6 +13,7 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY", secrets.token_hex(32))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("JWT_EXPIRE_MINUTES", "120"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
 
 security = HTTPBearer()
 
@@ -21,6 +24,18 @@ def create_access_token(subject: dict) -> str:
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def hash_refresh_token(token: str) -> str:
+    """Refresh tokens are opaque and stored only as HMAC-SHA256 digests."""
+    return hmac.new(SECRET_KEY.encode("utf-8"), token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def create_refresh_token() -> tuple[str, str, datetime.datetime]:
+    """Returns (token for the client, hash for the DB, expiry)."""
+    token = secrets.token_urlsafe(32)
+    expire = datetime.datetime.utcnow() + datetime.timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    return token, hash_refresh_token(token), expire
+
+
 def decode_token(token: str) -> dict:
     return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
 
@@ -1,18 +1,26 @@
 import os
 import json
+import asyncio
+import datetime
 import base64
 import logging
 import uuid
 import io
+import math
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI, Depends, HTTPException, Request, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, Header, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import cookie_parser
 from pydantic import BaseModel, Field, constr, field_validator
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import re
 import psycopg2, psycopg2.extras, hashlib, secrets
 try:
@@ -20,15 +28,40 @@ try:
     HAS_PILLOW = True
 except ImportError:
     HAS_PILLOW = False
+try:
+    from brotli_asgi import BrotliMiddleware
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
 
 from auth import (
     create_access_token,
+    create_refresh_token,
+    hash_refresh_token,
     get_current_user,
     require_patient,
     require_doctor,
     require_patient_or_doctor,
 )
 from crypto_utils import encrypt_field, decrypt_field
+import db
+from db import connect, connect_read
+import symptom_stats
+import epidemiology
+import symptom_extraction
+import lab_cache
+import lab_markers
+import metrics
+import versions
+import triage_stream
+import partitions
+import singleflight
+import idempotency
+import blind_index
+import blob_store
+import explanations
+import audit
+import similar_cases
 
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -67,6 +100,7 @@ class RegisterRequest(BaseModel):
 class RegisterResponse(BaseModel):
     patient_id: int
     access_token: str
+    refresh_token: Optional[str] = None
     token_type: str = "bearer"
 
 class LoginPatientRequest(BaseModel):
@@ -80,6 +114,15 @@ class LoginDoctorRequest(BaseModel):
 class LoginResponse(BaseModel):
     login: bool
     access_token: str
+    refresh_token: Optional[str] = None
+    token_type: str = "bearer"
+
+class RefreshRequest(BaseModel):
+    refresh_token: str = Field(..., min_length=1, max_length=200)
+
+class RefreshResponse(BaseModel):
+    access_token: str
+    refresh_token: str
     token_type: str = "bearer"
 
 class DoctorInfo(BaseModel):
@@ -93,10 +136,17 @@ class DoctorLoginResponse(LoginResponse):
 
 class HistoryRequest(BaseModel):
     patient_id: int = Field(..., gt=0)
+    date_from: Optional[datetime.date] = None
+    date_to: Optional[datetime.date] = None
 
 class SymptomsRequest(BaseModel):
     patient_id: int = Field(..., gt=0)
     symptom_str: str = Field(..., min_length=1)
+    date_from: Optional[datetime.date] = None
+    date_to: Optional[datetime.date] = None
+
+class ExtractSymptomsRequest(BaseModel):
+    text: str = Field(..., min_length=1, max_length=2000)
 
 class AnalysRequest(BaseModel):
     symptoms: List[int] = Field(..., min_length=23, max_length=23)
@@ -107,6 +157,20 @@ class SaveExplanationRequest(BaseModel):
     patient_explanation: str = ""
     doctor_explanation: str = ""
 
+class ExplainRequest(BaseModel):
+    symptoms: List[int] = Field(..., min_length=23, max_length=23)
+    lang: str = Field("ru", pattern="^(ru|en|kk)$")
+    # Also store the texts on this diary day (saves a /save_explanation call)
+    day_id: Optional[int] = Field(None, gt=0)
+
+class SimilarCasesRequest(BaseModel):
+    day_id: int = Field(..., gt=0)
+    k: int = Field(10, gt=0, le=50)
+    # Only days where a doctor set disease_setup
+    confirmed_only: bool = False
+    # Leave out the patient's own earlier days
+    other_patients_only: bool = True
+
 class UpdateByDoctorRequest(BaseModel):
     patient_id: int = Field(..., gt=0)
     day_id: int = Field(..., gt=0)
@@ -117,9 +181,22 @@ class UpdateByDoctorRequest(BaseModel):
 class PatientInfoRequest(BaseModel):
     patient_id: int = Field(..., gt=0)
 
+class PatientSearchRequest(BaseModel):
+    name: Optional[str] = Field(None, max_length=200)
+    city: Optional[str] = Field(None, max_length=100)
+    prefix: bool = True
+    limit: int = Field(20, gt=0, le=50)
+
 class DaySymptomsRequest(BaseModel):
     day_id: int = Field(..., gt=0)
 
+class EpidemiologyRequest(BaseModel):
+    date_from: datetime.date
+    date_to: datetime.date
+    disease: Optional[str] = None
+    city: Optional[str] = None
+    zone: Optional[str] = Field(None, pattern="^(red|yellow|green)$")
+
 class LabResultItem(BaseModel):
     name: str
     value: str
@@ -137,6 +214,11 @@ class LabResultResponse(BaseModel):
 class GetLabResultsRequest(BaseModel):
     patient_id: int = Field(..., gt=0)
 
+class LabMarkerTrendRequest(BaseModel):
+    patient_id: Optional[int] = Field(None, gt=0)
+    marker: str = Field(..., min_length=1, max_length=100)
+    since: Optional[datetime.date] = None
+
 # ─── Data & Config ───
 
 model_dict = {
@@ -203,8 +285,6 @@ disease_doctors = {
     "Common Cold": "Терапевт"
 }
 
-DATABASE_URL = os.environ.get("DATABASE_URL", "")
-
 symptom_list =[
     'ABDOMINAL_PAIN','CHEST_PAIN','COUGH','DEHYDRATION','DIARRHEA','FEVER','HEADACHE','ITCHING',
     'MUSCLE_ACHES','NAUSEA','NECK_STIFFNESS','PHOTOPHOBIA','POLYDIPSIA','POLYURIA','RASH',
@@ -252,11 +332,6 @@ def verify_password(pwd: str, stored: str) -> bool:
 
 # ─── Database ───
 
-def connect():
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = False
-    return conn
-
 def create_tables():
     conn = connect()
     try:
@@ -277,44 +352,144 @@ def create_tables():
             password_hash TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT NOW()
         );
-
-        CREATE TABLE IF NOT EXISTS diary_days (
-            day_id SERIAL PRIMARY KEY,
+        """)
+        # Diary tables are range-partitioned by month, see partitions.py. Plain
+        # tables from an older install are converted first: everything below
+        # relies on diary_symptoms.created_at
+        if partitions.needs_migration(cur):
+            logger.warning("Converting diary tables to monthly partitions, this locks them until done")
+            logger.warning("%d diary days moved into partitions", partitions.migrate(conn))
+        cur.execute(partitions.DDL)
+        cur.execute(partitions.INDEX_DDL)
+        # Append-only access trail, partitioned by month, see audit.py
+        cur.execute(audit.DDL)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS lab_results (
+            result_id SERIAL PRIMARY KEY,
             patient_id INTEGER NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
-            doctor_id INTEGER REFERENCES doctors(doctor_id) ON DELETE SET NULL,
+            day_id INTEGER,
             created_at TIMESTAMP DEFAULT NOW(),
-            disease_predict TEXT,
-            score REAL,
-            disease_setup TEXT,
-            recept TEXT,
-            patient_explanation TEXT,
-            doctor_explanation TEXT
+            test_type TEXT,
+            test_date TEXT,
+            results_json TEXT,
+            interpretation TEXT,
+            image_filename TEXT,
+            image_hash TEXT,
+            image_type TEXT,
+            thumb_hash TEXT
+        );
+        -- Blob addresses (blob_store.py); older rows only have image_filename
+        ALTER TABLE lab_results ADD COLUMN IF NOT EXISTS image_hash TEXT;
+        ALTER TABLE lab_results ADD COLUMN IF NOT EXISTS image_type TEXT;
+        ALTER TABLE lab_results ADD COLUMN IF NOT EXISTS thumb_hash TEXT;
+
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            token_id SERIAL PRIMARY KEY,
+            token_hash TEXT NOT NULL UNIQUE,
+            family_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            subject_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            expires_at TIMESTAMP NOT NULL,
+            used_at TIMESTAMP,
+            revoked_at TIMESTAMP
         );
 
-        CREATE TABLE IF NOT EXISTS diary_symptoms (
-            day_id INTEGER NOT NULL REFERENCES diary_days(day_id) ON DELETE CASCADE,
+        CREATE TABLE IF NOT EXISTS symptom_daily_stats (
+            patient_id INTEGER NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
             symptom_code TEXT NOT NULL,
-            value INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY(day_id, symptom_code)
+            day DATE NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            peak INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(patient_id, symptom_code, day)
         );
 
-        CREATE TABLE IF NOT EXISTS lab_results (
-            result_id SERIAL PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS epi_daily_counts (
+            day DATE NOT NULL,
+            city_bucket TEXT NOT NULL,
+            disease TEXT NOT NULL,
+            zone TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(day, city_bucket, disease, zone)
+        );
+
+        CREATE TABLE IF NOT EXISTS explanation_cache (
+            cache_key TEXT PRIMARY KEY,
+            model_version TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            patient_explanation TEXT,
+            doctor_explanation TEXT,
+            created_at TIMESTAMP DEFAULT NOW(),
+            last_used_at TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS lab_ocr_cache (
+            cache_id SERIAL PRIMARY KEY,
             patient_id INTEGER NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
-            day_id INTEGER REFERENCES diary_days(day_id) ON DELETE SET NULL,
+            content_hash TEXT NOT NULL,
+            phash BIGINT,
+            result_id INTEGER REFERENCES lab_results(result_id) ON DELETE CASCADE,
             created_at TIMESTAMP DEFAULT NOW(),
             test_type TEXT,
             test_date TEXT,
             results_json TEXT,
-            interpretation TEXT,
-            image_filename TEXT
+            interpretation TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS lab_markers (
+            marker_id SERIAL PRIMARY KEY,
+            result_id INTEGER NOT NULL REFERENCES lab_results(result_id) ON DELETE CASCADE,
+            patient_id INTEGER NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+            marker_code TEXT NOT NULL,
+            taken_on DATE NOT NULL,
+            value TEXT,
+            unit TEXT,
+            status TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS triage_events (
+            event_id BIGSERIAL PRIMARY KEY,
+            patient_id INTEGER NOT NULL,
+            zone TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS patient_blind_index (
+            patient_id INTEGER NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+            field TEXT NOT NULL,
+            term TEXT NOT NULL,
+            PRIMARY KEY(field, term, patient_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            idem_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            response TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY(scope, endpoint, idem_key)
         );
 
-        CREATE INDEX IF NOT EXISTS idx_days_patient ON diary_days(patient_id, day_id);
-        CREATE INDEX IF NOT EXISTS idx_days_doctor  ON diary_days(doctor_id, day_id);
-        CREATE INDEX IF NOT EXISTS idx_sym_code     ON diary_symptoms(symptom_code);
         CREATE INDEX IF NOT EXISTS idx_lab_patient  ON lab_results(patient_id);
+        CREATE INDEX IF NOT EXISTS idx_refresh_family ON refresh_tokens(family_id);
+        CREATE INDEX IF NOT EXISTS idx_ocr_cache_patient ON lab_ocr_cache(patient_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_markers_trend ON lab_markers(patient_id, marker_code, taken_on);
+        CREATE INDEX IF NOT EXISTS idx_markers_result ON lab_markers(result_id);
+        CREATE INDEX IF NOT EXISTS idx_idem_expires ON idempotency_keys(expires_at);
+        CREATE INDEX IF NOT EXISTS idx_blind_patient ON patient_blind_index(patient_id);
+        CREATE INDEX IF NOT EXISTS idx_explanation_used ON explanation_cache(last_used_at);
         """)
+        partitions.ensure_partitions(cur)
+        audit.ensure_partitions(cur)
         conn.commit()
     finally:
         conn.close()
@@ -325,13 +500,11 @@ def seed_doctors():
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM doctors")
         if cur.fetchone()[0] > 0:
-            conn.close()
             return
 
         seeds_raw = os.environ.get("DOCTOR_SEEDS", "")
         if not seeds_raw:
             logger.warning("DOCTOR_SEEDS env variable not set — no doctors seeded")
-            conn.close()
             return
 
         for entry in seeds_raw.split(";"):
@@ -354,7 +527,8 @@ def seed_doctors():
 
 # ─── Service Functions ───
 
-def register_as_patient(full_name: str, city: str, password_5: str) -> int:
+def register_as_patient(full_name: str, city: str, password_5: str) -> Tuple[int, str]:
+    """Returns (patient_id, refresh_token)."""
     conn = connect()
     try:
         cur = conn.cursor()
@@ -363,63 +537,170 @@ def register_as_patient(full_name: str, city: str, password_5: str) -> int:
             VALUES (%s,%s,%s) RETURNING patient_id
         """, (encrypt_field(full_name), encrypt_field(city), hash_password(password_5)))
         patient_id = cur.fetchone()[0]
+        blind_index.index_patient(cur, patient_id, full_name, city)
+        refresh_token = issue_refresh_token(cur, "patient", patient_id)
+        versions.bump(cur)
         conn.commit()
-        return patient_id
+        return patient_id, refresh_token
     finally:
         conn.close()
 
-def log_in_patient(patient_id: int, password_5: str) -> bool:
+def issue_refresh_token(cur, role: str, subject_id: int, family_id: Optional[str] = None) -> str:
+    token, token_hash, expires_at = create_refresh_token()
+    cur.execute("""
+        INSERT INTO refresh_tokens(token_hash, family_id, role, subject_id, expires_at)
+        VALUES (%s,%s,%s,%s,%s)
+    """, (token_hash, family_id or uuid.uuid4().hex, role, subject_id, expires_at))
+    return token
+
+def rotate_refresh_token(refresh_token: str) -> Optional[Dict[str, Any]]:
+    """Consume a refresh token and issue its successor in the same family.
+
+    The happy path is a single statement: an indexed UPDATE on token_hash chained
+    into the INSERT of the new token. Presenting an already-used token is treated
+    as theft and revokes the whole family."""
+    token_hash = hash_refresh_token(refresh_token)
+    new_token, new_hash, new_expires_at = create_refresh_token()
     conn = connect()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT password_hash FROM patients WHERE patient_id = %s", (patient_id,))
+        cur.execute("""
+            WITH used AS (
+                UPDATE refresh_tokens
+                SET used_at = NOW()
+                WHERE token_hash = %s
+                  AND used_at IS NULL
+                  AND revoked_at IS NULL
+                  AND expires_at > NOW()
+                RETURNING family_id, role, subject_id
+            )
+            INSERT INTO refresh_tokens(token_hash, family_id, role, subject_id, expires_at)
+            SELECT %s, family_id, role, subject_id, %s FROM used
+            RETURNING role, subject_id
+        """, (token_hash, new_hash, new_expires_at))
         row = cur.fetchone()
-        if not row:
-            return False
-        return verify_password(password_5, row[0])
+        if row is not None:
+            conn.commit()
+            return {"role": row[0], "subject_id": row[1], "refresh_token": new_token}
+
+        cur.execute("""
+            UPDATE refresh_tokens
+            SET revoked_at = NOW()
+            WHERE revoked_at IS NULL AND family_id = (
+                SELECT family_id FROM refresh_tokens
+                WHERE token_hash = %s AND used_at IS NOT NULL
+            )
+        """, (token_hash,))
+        if cur.rowcount > 0:
+            logger.warning("Refresh token reuse detected — token family revoked")
+        conn.commit()
+        return None
     finally:
         conn.close()
 
-def log_in_doctor(doctor_id: int, password_5: str) -> bool:
+def authenticate_patient(patient_id: int, password_5: str) -> Optional[str]:
+    """Verify credentials and issue a refresh token on one connection.
+    Returns the refresh token, or None on bad credentials."""
     conn = connect()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT password_hash FROM doctors WHERE doctor_id = %s", (doctor_id,))
+        cur.execute("SELECT password_hash FROM patients WHERE patient_id = %s", (patient_id,))
         row = cur.fetchone()
-        if not row:
-            return False
-        return verify_password(password_5, row[0])
+        if not row or not verify_password(password_5, row[0]):
+            return None
+        refresh_token = issue_refresh_token(cur, "patient", patient_id)
+        conn.commit()
+        return refresh_token
     finally:
         conn.close()
 
-def get_doctor_info(doctor_id: int) -> Optional[Dict[str, Any]]:
+def authenticate_doctor(doctor_id: int, password_5: str) -> Optional[Dict[str, Any]]:
+    """Fetch credentials and profile in one query, verify, issue a refresh token.
+    Returns {"doctor": info, "refresh_token": ...}, or None on bad credentials."""
     conn = connect()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT doctor_id, full_name, specialty, created_at FROM doctors WHERE doctor_id = %s", (doctor_id,))
+        cur.execute("""
+            SELECT password_hash, full_name, specialty, created_at
+            FROM doctors
+            WHERE doctor_id = %s
+        """, (doctor_id,))
         row = cur.fetchone()
-        if not row:
+        if not row or not verify_password(password_5, row[0]):
             return None
-        return {"doctor_id": row[0], "full_name": decrypt_field(row[1]), "specialty": decrypt_field(row[2]), "created_at": str(row[3])}
+        refresh_token = issue_refresh_token(cur, "doctor", doctor_id)
+        conn.commit()
+        info = {"doctor_id": doctor_id, "full_name": decrypt_field(row[1]), "specialty": decrypt_field(row[2]), "created_at": str(row[3])}
+        return {"doctor": info, "refresh_token": refresh_token}
     finally:
         conn.close()
 
-def select_patient(patient_id: int) -> Optional[Dict[str, Any]]:
+def get_doctor_info(doctor_id: int) -> Optional[Dict[str, Any]]:
     conn = connect()
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT patient_id, full_name, city, created_at
-            FROM patients
-            WHERE patient_id = %s
-        """, (patient_id,))
+        cur.execute("SELECT doctor_id, full_name, specialty, created_at FROM doctors WHERE doctor_id = %s", (doctor_id,))
         row = cur.fetchone()
         if not row:
             return None
-        return {"patient_id": row[0], "full_name": decrypt_field(row[1]), "city": decrypt_field(row[2]), "created_at": str(row[3])}
+        return {"doctor_id": row[0], "full_name": decrypt_field(row[1]), "specialty": decrypt_field(row[2]), "created_at": str(row[3])}
     finally:
         conn.close()
 
+# Hot statements, prepared once per pooled connection (see db.prepare)
+
+PATIENT_INFO = db.prepare("patient_info", """
+    SELECT patient_id, full_name, city, created_at
+    FROM patients
+    WHERE patient_id = $1
+""")
+
+# Ownership is part of the statement: a patient's day that isn't theirs simply
+# has no rows, so authorization costs no extra round trip. $2 NULL = doctor.
+DAY_SYMPTOMS = db.prepare("day_symptoms", """
+    SELECT s.symptom_code, s.value, d.patient_id
+    FROM diary_symptoms s
+    JOIN diary_days d ON d.day_id = s.day_id AND d.created_at = s.created_at
+    WHERE s.day_id = $1 AND ($2::int IS NULL OR d.patient_id = $2)
+    ORDER BY s.symptom_code
+""")
+
+# Update, ownership check and version bump (same upsert as versions.bump) in
+# one atomic statement
+SAVE_EXPLANATION = db.prepare("save_explanation", """
+    WITH upd AS (
+        UPDATE diary_days
+        SET patient_explanation = $1, doctor_explanation = $2
+        WHERE day_id = $3 AND patient_id = $4
+        RETURNING patient_id
+    ), bumped AS (
+        INSERT INTO data_versions(scope, version)
+        SELECT scope, 1 FROM upd, unnest(ARRAY['global', 'patient:' || upd.patient_id]) AS scope
+        ON CONFLICT (scope) DO UPDATE SET version = data_versions.version + 1
+    )
+    SELECT COUNT(*) FROM upd
+""")
+
+DAY_OWNED = db.prepare("day_owned", """
+    SELECT 1 FROM diary_days WHERE day_id = $1 AND patient_id = $2
+""")
+
+LAB_RESULTS = db.prepare("lab_results_list", """
+    SELECT result_id, test_type, test_date, results_json, interpretation, created_at,
+           image_hash IS NOT NULL, thumb_hash IS NOT NULL
+    FROM lab_results
+    WHERE patient_id = $1
+    ORDER BY result_id DESC
+    LIMIT 50
+""")
+
+def select_patient(patient_id: int) -> Optional[Dict[str, Any]]:
+    rows = db.query(PATIENT_INFO, (patient_id,), read=True, patient_id=patient_id)
+    if not rows:
+        return None
+    row = rows[0]
+    return {"patient_id": row[0], "full_name": decrypt_field(row[1]), "city": decrypt_field(row[2]), "created_at": str(row[3])}
+
 def last_day(patient_id: int) -> Optional[int]:
     conn = connect()
     try:
@@ -465,7 +746,7 @@ def insert_disease(
                 patient_explanation,
                 doctor_explanation
             )
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s) RETURNING day_id
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s) RETURNING day_id, created_at
         """, (
             patient_id,
             doctor_id,
@@ -477,19 +758,32 @@ def insert_disease(
             encrypt_field(doctor_explanation),
         ))
 
-        day_id = cur.fetchone()[0]
+        day_id, created_at = cur.fetchone()
 
+        # Same created_at as the day keeps both rows in the same monthly partition
         rows = [
-            (day_id, symptom_list[i], int(symptoms_23[i]))
+            (day_id, created_at, symptom_list[i], int(symptoms_23[i]))
             for i in range(len(symptom_list))
         ]
 
-        cur.executemany("""
-            INSERT INTO diary_symptoms(day_id, symptom_code, value)
-            VALUES (%s,%s,%s)
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO diary_symptoms(day_id, created_at, symptom_code, value)
+            VALUES %s
         """, rows)
 
+        symptom_stats.record_day(cur, patient_id, symptom_list, symptoms_23)
+
+        cur.execute("SELECT city FROM patients WHERE patient_id = %s", (patient_id,))
+        city_row = cur.fetchone()
+        top_disease = primary_disease(disease_predict)
+        zone = classify_zone(top_disease, float(score))
+        epidemiology.record_day(cur, decrypt_field(city_row[0]) if city_row else None, top_disease, zone)
+        versions.bump(cur, patient_id)
+        triage_stream.emit(cur, patient_id, zone)
+
         conn.commit()
+        db.mark_write(patient_id)
+        similar_index.add(day_id, patient_id, symptoms_23)
         return day_id
     finally:
         conn.close()
@@ -511,7 +805,7 @@ def update_recept_last_day(patient_id: int, recept_text: str) -> bool:
     return True
 
 def list_doctors_db() -> List[Dict[str, Any]]:
-    conn = connect()
+    conn = connect_read()
     try:
         cur = conn.cursor()
         cur.execute("""
@@ -563,20 +857,37 @@ def doctor_update_day(
             SET {set_sql}
             WHERE day_id = %s AND patient_id = %s
         """, (*params, int(day_id), int(patient_id)))
+        updated = cur.rowcount > 0
+        if updated:
+            # No triage event: the zone comes from disease_predict / score, which doctors don't edit
+            versions.bump(cur, patient_id)
 
         conn.commit()
-        return cur.rowcount > 0
+        if updated:
+            db.mark_write(int(patient_id))
+        return updated
     finally:
         conn.close()
 
-def get_patient_history(patient_id: int, limit: int = 30) -> List[Dict[str, Any]]:
+def get_patient_history(
+    patient_id: int,
+    limit: int = 30,
+    conn=None,
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+) -> List[Dict[str, Any]]:
+    """Pass `conn` to read on the same connection as a preceding version check.
+    A date window limits the scan to the matching monthly partitions."""
     if limit <= 0:
         limit = 30
+    window, window_params = partitions.window_sql(["d.created_at"], date_from, date_to)
 
-    conn = connect()
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_read(patient_id)
     try:
         cur = conn.cursor()
-        cur.execute("""
+        cur.execute(f"""
             SELECT
                 d.day_id,
                 d.created_at,
@@ -590,10 +901,10 @@ def get_patient_history(patient_id: int, limit: int = 30) -> List[Dict[str, Any]
                 d.doctor_explanation
             FROM diary_days d
             LEFT JOIN doctors doc ON doc.doctor_id = d.doctor_id
-            WHERE d.patient_id = %s
+            WHERE d.patient_id = %s{window}
             ORDER BY d.day_id DESC
             LIMIT %s
-        """, (patient_id, limit))
+        """, (patient_id, *window_params, limit))
         rows = cur.fetchall()
 
         return [{
@@ -609,28 +920,49 @@ def get_patient_history(patient_id: int, limit: int = 30) -> List[Dict[str, Any]
             "doctor_explanation": decrypt_field(r[9]),
         } for r in rows]
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
-def get_symptom_graph(patient_id: int, symptom_code: str) -> List[Dict[str, Any]]:
+def get_symptom_graph(
+    patient_id: int,
+    symptom_code: str,
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+) -> List[Dict[str, Any]]:
     if symptom_code not in symptom_list:
         raise ValueError("Неверный symptom_code (нет в symptom_list)")
 
-    conn = connect()
+    window, window_params = partitions.window_sql(["d.created_at", "s.created_at"], date_from, date_to)
+    conn = connect_read(patient_id)
     try:
         cur = conn.cursor()
-        cur.execute("""
+        cur.execute(f"""
             SELECT d.day_id, d.created_at, s.value
             FROM diary_days d
-            JOIN diary_symptoms s ON s.day_id = d.day_id
-            WHERE d.patient_id = %s AND s.symptom_code = %s
+            JOIN diary_symptoms s ON s.day_id = d.day_id AND s.created_at = d.created_at
+            WHERE d.patient_id = %s AND s.symptom_code = %s{window}
             ORDER BY d.day_id
-        """, (patient_id, symptom_code))
+        """, (patient_id, symptom_code, *window_params))
         rows = cur.fetchall()
 
         return [{"day_id": r[0], "created_at": str(r[1]), "value": r[2]} for r in rows]
     finally:
         conn.close()
 
+def get_symptom_stats(patient_id: int) -> Dict[str, Dict[str, Any]]:
+    conn = connect_read(patient_id)
+    try:
+        return symptom_stats.get_patient_stats(conn.cursor(), patient_id, symptom_list)
+    finally:
+        conn.close()
+
+def load_triage_events(last_event_id: int) -> List[Dict[str, Any]]:
+    conn = connect()
+    try:
+        return triage_stream.events_since(conn.cursor(), last_event_id)
+    finally:
+        conn.close()
+
 def model_predict(symptoms):
     score_dict = dict()
     if not len(symptoms) > len(model_dict["Croup"][0]):
@@ -654,9 +986,25 @@ def model_predict(symptoms):
     pre_diagnose = sorted(score_dict.items(),key = lambda x: x[1] ,reverse = True)[:3]
     return pre_diagnose
 
+MODEL_VERSION = explanations.model_version(model_dict)
+
+# Nearest-neighbour index over all diary days, see similar_cases.py
+similar_index = similar_cases.CaseIndex(symptom_list)
+# Candidates fetched per requested case when only confirmed days count
+SIMILAR_CONFIRMED_OVERFETCH = 10
+
 RED_ZONE_DISEASES = {"Meningitis", "Appendicitis", "Type 1 Diabetes"}
 YELLOW_ZONE_DISEASES = {"Pneumonia", "Scarlet Fever", "Influenza"}
 
+def primary_disease(disease_predict: Optional[str]) -> str:
+    """disease_predict stores the space-joined top-3, and names may contain spaces."""
+    if not disease_predict:
+        return ""
+    for name in model_dict:
+        if disease_predict.startswith(name):
+            return name
+    return disease_predict.split(" ")[0]
+
 def classify_zone(disease: str, score: float) -> str:
     if disease in RED_ZONE_DISEASES or score > 0.6:
         return "red"
@@ -664,8 +1012,10 @@ def classify_zone(disease: str, score: float) -> str:
         return "yellow"
     return "green"
 
-def get_all_patients_triage() -> list:
-    conn = connect()
+def get_all_patients_triage(conn=None) -> list:
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_read()
     try:
         cur = conn.cursor()
         cur.execute("""
@@ -682,8 +1032,7 @@ def get_all_patients_triage() -> list:
         for r in rows:
             disease = decrypt_field(r[4]) or ""
             score = r[5] or 0.0
-            first_disease = disease.split(" ")[0] if disease else ""
-            zone = classify_zone(first_disease, score)
+            zone = classify_zone(primary_disease(disease), score)
             result.append({
                 "patient_id": r[0],
                 "full_name": decrypt_field(r[1]),
@@ -695,15 +1044,93 @@ def get_all_patients_triage() -> list:
                 "zone": zone,
             })
         return result
+    finally:
+        if own_conn:
+            conn.close()
+
+def get_day_symptoms(day_id: int, patient_id: Optional[int]) -> Tuple[Optional[int], Dict[str, int]]:
+    """Owner and symptoms of one day; with `patient_id`, only if the day is theirs."""
+    rows = db.query(DAY_SYMPTOMS, (day_id, patient_id), read=True, patient_id=patient_id)
+    return (rows[0][2] if rows else None), {r[0]: r[1] for r in rows}
+
+def owns_day(day_id: int, patient_id: int) -> bool:
+    return bool(db.query(DAY_OWNED, (day_id, patient_id), read=True, patient_id=patient_id))
+
+def save_explanation(day_id: int, patient_id: int, patient_explanation: str, doctor_explanation: str) -> bool:
+    rows = db.query(SAVE_EXPLANATION, (
+        encrypt_field(patient_explanation), encrypt_field(doctor_explanation), day_id, patient_id,
+    ))
+    return rows[0][0] > 0
+
+# ─── Coalesced reads ───
+# Concurrent identical requests (e.g. every doctor opening the dashboard at shift
+# start) share one scan + decrypt. Keys carry the data version, so the short
+# result TTL never serves data older than the version the caller just saw.
+
+SINGLEFLIGHT_TTL = float(os.environ.get("SINGLEFLIGHT_TTL_SECONDS", "2"))
+triage_flight = singleflight.SingleFlight("triage", SINGLEFLIGHT_TTL)
+history_flight = singleflight.SingleFlight("history", SINGLEFLIGHT_TTL)
+labs_flight = singleflight.SingleFlight("labs", SINGLEFLIGHT_TTL)
+
+def get_data_version(scope: str, patient_id: Optional[int] = None) -> int:
+    rows = db.query(versions.DATA_VERSION, (scope,), read=True, patient_id=patient_id)
+    return rows[0][0] if rows else 0
+
+# Snapshots return the version read on the same connection as the rows, so the
+# ETag always describes the body even if another replica answered the check.
+
+def load_triage_snapshot() -> Tuple[int, list]:
+    conn = connect_read()
+    try:
+        return versions.get(conn.cursor(), "global"), get_all_patients_triage(conn=conn)
     finally:
         conn.close()
 
-def day_belongs_to_patient(day_id: int, patient_id: int) -> bool:
-    conn = connect()
+def load_history_snapshot(
+    patient_id: int,
+    date_from: Optional[datetime.date],
+    date_to: Optional[datetime.date],
+) -> Tuple[int, List[Dict[str, Any]]]:
+    conn = connect_read(patient_id)
+    try:
+        version = versions.get(conn.cursor(), f"patient:{patient_id}")
+        return version, get_patient_history(patient_id, conn=conn, date_from=date_from, date_to=date_to)
+    finally:
+        conn.close()
+
+def load_lab_results_snapshot(patient_id: int) -> Tuple[int, List[Dict[str, Any]]]:
+    conn = connect_read(patient_id)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT 1 FROM diary_days WHERE day_id = %s AND patient_id = %s", (day_id, patient_id))
-        return cur.fetchone() is not None
+        version = versions.get(cur, f"patient:{patient_id}")
+        db.execute_prepared(cur, LAB_RESULTS, (patient_id,))
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    results = []
+    for r in rows:
+        decrypted_json = decrypt_field(r[3])
+        try:
+            items = json.loads(decrypted_json) if decrypted_json else[]
+        except json.JSONDecodeError:
+            items = []
+        results.append({
+            "result_id": r[0],
+            "test_type": r[1],
+            "test_date": r[2],
+            "results": items,
+            "interpretation": decrypt_field(r[4]),
+            "created_at": r[5],
+            "has_image": r[6],
+            "has_thumbnail": r[7],
+        })
+    return version, results
+
+def load_lab_marker_trend(patient_id: int, code: str, since: Optional[datetime.date]) -> List[Dict[str, Any]]:
+    conn = connect_read(patient_id)
+    try:
+        return lab_markers.marker_trend(conn.cursor(), patient_id, code, since)
     finally:
         conn.close()
 
@@ -712,14 +1139,46 @@ def day_belongs_to_patient(day_id: int, patient_id: int) -> bool:
 create_tables()
 seed_doctors()
 
+def log_warm_up_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Similar-cases warm-up failed: %s", task.exception())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    audit.start()
+    # Map the snapshot and catch up in the background, off the first request
+    warm_up = asyncio.ensure_future(run_in_threadpool(similar_index.refresh))
+    warm_up.add_done_callback(log_warm_up_failure)
+    try:
+        yield
+    finally:
+        # Runs after in-flight requests finish, so their access events get written
+        await audit.stop()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="TMS API",
     description="Therapist Machine Support — AI-powered pediatric symptom analysis and triage system",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 # Rate limiter
-limiter = Limiter(key_func=get_real_ip)
+# Counters live in a shared store so limits hold across workers/instances.
+# RATE_LIMIT_STORAGE_URI accepts any `limits` backend: memory:// (local stand-in,
+# per-process), redis://host:6379/0 or rediss:// (Redis-protocol, e.g. Valkey/KeyDB).
+# moving-window on Redis is a single atomic Lua call per check. If the store is
+# unreachable, slowapi falls back to per-process memory counters.
+RATE_LIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+RATE_LIMIT_STRATEGY = os.environ.get("RATE_LIMIT_STRATEGY", "moving-window")
+
+limiter = Limiter(
+    key_func=get_real_ip,
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    strategy=RATE_LIMIT_STRATEGY,
+    key_prefix="tms",
+    in_memory_fallback_enabled=True,
+)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -736,9 +1195,96 @@ app.add_middleware(
     allow_origins=["*"], # Для хакатона лучше оставить "*", чтобы не было проблем с фронтом
     allow_credentials=True,
     allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_headers=["Authorization", "Content-Type", "If-None-Match", "Last-Event-ID", "Range", idempotency.HEADER,
+                   db.WRITE_HEADER],
+    expose_headers=["ETag", "Content-Range", "Accept-Ranges", idempotency.REPLAY_HEADER, db.WRITE_HEADER],
 )
 
+# Response compression (Accept-Encoding negotiated; brotli when installed, else gzip)
+# gzip level 5 is ~2x faster than the default 9 on large JSON for ~15% more bytes
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "5"))
+# Event streams must reach the client chunk by chunk, never through a compressor's buffer
+# Images are already compressed, and byte ranges must refer to the stored bytes
+UNCOMPRESSED_PATHS = {"/triage/stream"}
+UNCOMPRESSED_PREFIXES = ("/lab_image/",)
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+        # BrotliMiddleware's own gzip fallback ignores GZIP_LEVEL, so gzip-only
+        # clients always go through GZipMiddleware
+        self.gzip = GZipMiddleware(app, minimum_size=COMPRESS_MIN_SIZE, compresslevel=GZIP_LEVEL)
+        self.brotli = BrotliMiddleware(app, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=False) if HAS_BROTLI else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+        elif scope["path"] in UNCOMPRESSED_PATHS or scope["path"].startswith(UNCOMPRESSED_PREFIXES):
+            await self.app(scope, receive, send)
+        elif self.brotli is not None and "br" in Headers(scope=scope).get("accept-encoding", ""):
+            await self.brotli(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware)
+
+class RoundTripMiddleware:
+    """Counts DB round trips per matched route (db.round_trips.<path> over
+    db.requests.<path>; averages in /metrics)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        counter = db.count_round_trips()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router puts the matched route into the scope; keying by its
+            # template keeps /lab_image/{result_id} to one pair of counters.
+            # Unmatched paths aren't recorded
+            route = scope.get("route")
+            if route is not None:
+                metrics.inc(f"db.requests.{route.path}")
+                metrics.inc(f"db.round_trips.{route.path}", counter[0])
+
+app.add_middleware(RoundTripMiddleware)
+
+class ReadYourWritesMiddleware:
+    """Hands the client the time of its last write and reads it back, so the
+    replica routing in db.connect_read() can keep its next reads on the
+    primary whichever worker serves them."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not db.REPLICA_URLS:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        reported = headers.get(db.WRITE_HEADER) or cookie_parser(headers.get("cookie", "")).get(db.WRITE_COOKIE)
+        state = db.track_writes(reported)
+
+        async def send_with_write_time(message):
+            if message["type"] == "http.response.start" and state[1]:
+                value = f"{state[1]:.3f}"
+                response_headers = MutableHeaders(raw=message.setdefault("headers", []))
+                response_headers.append(db.WRITE_HEADER, value)
+                response_headers.append(
+                    "Set-Cookie",
+                    f"{db.WRITE_COOKIE}={value}; Max-Age={math.ceil(db.READ_PIN_SECONDS)}; Path=/; HttpOnly; SameSite=Lax",
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_with_write_time)
+
+app.add_middleware(ReadYourWritesMiddleware)
+
 # ─── Health Check ───
 
 @app.get("/health")
@@ -758,36 +1304,66 @@ async def health():
 async def root():
     return {"message": "TMS API is running"}
 
+@app.get("/metrics")
+async def metrics_endpoint(user: dict = Depends(require_doctor)):
+    snap = metrics.snapshot()
+    counters = snap["counters"]
+    per_request = {
+        name[len("db.requests."):]: round(counters.get("db.round_trips." + name[len("db.requests."):], 0) / n, 2)
+        for name, n in counters.items() if name.startswith("db.requests.") and n
+    }
+    return {
+        **snap,
+        "db_round_trips_per_request": per_request,
+        "lab_ocr_cache": lab_cache.stats(),
+        "similar_cases": similar_index.stats(),
+    }
+
 # ─── Auth endpoints (public, rate-limited) ───
 
 @app.post("/regist_as_patient", response_model=RegisterResponse)
 @limiter.limit("10/minute")
 async def regist_as_patient(request: Request, body: RegisterRequest):
-    patient_id = register_as_patient(body.name, body.city, body.password)
+    patient_id, refresh_token = await run_in_threadpool(register_as_patient, body.name, body.city, body.password)
     logger.info("Patient %d registered", patient_id)
     token = create_access_token({"role": "patient", "patient_id": patient_id})
-    return RegisterResponse(patient_id=patient_id, access_token=token)
+    return RegisterResponse(patient_id=patient_id, access_token=token, refresh_token=refresh_token)
 
 @app.post("/login_patient", response_model=LoginResponse)
 @limiter.limit("5/minute")
 async def login_patient_endpoint(request: Request, body: LoginPatientRequest):
-    flag = log_in_patient(body.patient_id, body.password)
-    if not flag:
+    # PBKDF2 is CPU-bound — keep it off the event loop
+    refresh_token = await run_in_threadpool(authenticate_patient, body.patient_id, body.password)
+    if refresh_token is None:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     logger.info("Patient %d logged in", body.patient_id)
     token = create_access_token({"role": "patient", "patient_id": body.patient_id})
-    return LoginResponse(login=True, access_token=token)
+    return LoginResponse(login=True, access_token=token, refresh_token=refresh_token)
 
 @app.post("/login_doctor", response_model=DoctorLoginResponse)
 @limiter.limit("5/minute")
 async def login_doctor_endpoint(request: Request, body: LoginDoctorRequest):
-    flag = log_in_doctor(body.doctor_id, body.password)
-    if not flag:
+    auth_result = await run_in_threadpool(authenticate_doctor, body.doctor_id, body.password)
+    if auth_result is None:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     logger.info("Doctor %d logged in", body.doctor_id)
-    info = get_doctor_info(body.doctor_id)
     token = create_access_token({"role": "doctor", "doctor_id": body.doctor_id})
-    return DoctorLoginResponse(login=True, access_token=token, doctor=info)
+    return DoctorLoginResponse(
+        login=True,
+        access_token=token,
+        refresh_token=auth_result["refresh_token"],
+        doctor=auth_result["doctor"],
+    )
+
+@app.post("/token/refresh", response_model=RefreshResponse)
+@limiter.limit("30/minute")
+async def refresh_token_endpoint(request: Request, body: RefreshRequest):
+    rotated = rotate_refresh_token(body.refresh_token)
+    if rotated is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
+    role = rotated["role"]
+    token = create_access_token({"role": role, f"{role}_id": rotated["subject_id"]})
+    return RefreshResponse(access_token=token, refresh_token=rotated["refresh_token"])
 
 @app.post("/list_doctor")
 @limiter.limit("20/minute")
@@ -798,23 +1374,59 @@ async def list_doctor_endpoint(request: Request):
 # ─── Patient endpoints (require patient or doctor token) ───
 
 @app.post("/get_history")
-async def get_history_endpoint(body: HistoryRequest, user: dict = Depends(require_patient_or_doctor)):
+async def get_history_endpoint(request: Request, body: HistoryRequest, user: dict = Depends(require_patient_or_doctor)):
     if user.get("role") == "patient" and user.get("patient_id") != body.patient_id:
         raise HTTPException(status_code=403, detail="Access denied")
-    history = get_patient_history(body.patient_id)
-    return {"history": history}
+    audit.record(user, body.patient_id, "get_history")
+    resource = f"history-{body.patient_id}-{body.date_from or ''}-{body.date_to or ''}"
+    version = await run_in_threadpool(get_data_version, f"patient:{body.patient_id}", body.patient_id)
+    etag = versions.etag(resource, version)
+    if versions.not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    version, history = await history_flight.do(
+        (body.patient_id, body.date_from, body.date_to, version),
+        load_history_snapshot, body.patient_id, body.date_from, body.date_to,
+    )
+    etag = versions.etag(resource, version)
+    # Returning the response directly skips jsonable_encoder; orjson handles the rows
+    return ORJSONResponse({"history": history}, headers={"ETag": etag})
 
 @app.post("/get_symptoms")
 async def get_symptoms_endpoint(body: SymptomsRequest, user: dict = Depends(require_patient_or_doctor)):
     if user.get("role") == "patient" and user.get("patient_id") != body.patient_id:
         raise HTTPException(status_code=403, detail="Access denied")
-    graph = get_symptom_graph(body.patient_id, body.symptom_str)
+    audit.record(user, body.patient_id, "get_symptoms")
+    graph = get_symptom_graph(body.patient_id, body.symptom_str, body.date_from, body.date_to)
     return {"symptoms_arr": graph}
 
+@app.post("/get_symptom_stats")
+async def get_symptom_stats_endpoint(body: HistoryRequest, user: dict = Depends(require_patient_or_doctor)):
+    if user.get("role") == "patient" and user.get("patient_id") != body.patient_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    stats = get_symptom_stats(body.patient_id)
+    audit.record(user, body.patient_id, "get_symptom_stats")
+    return {"stats": stats}
+
+@app.post("/extract_symptoms")
+@limiter.limit("30/minute")
+async def extract_symptoms_endpoint(request: Request, body: ExtractSymptomsRequest, user: dict = Depends(require_patient_or_doctor)):
+    # Lexicon fast path first; the LLM only sees texts the lexicon can't cover
+    return await symptom_extraction.extract_symptoms(body.text, symptom_list)
+
 @app.post("/analys")
-async def analys_endpoint(body: AnalysRequest, user: dict = Depends(require_patient)):
+async def analys_endpoint(
+    body: AnalysRequest,
+    user: dict = Depends(require_patient),
+    idempotency_key: Optional[str] = Header(None),
+):
     patient_id = user["patient_id"]
+    req_hash = idempotency.request_hash(body.symptoms, body.diagnose_setup)
+    return await idempotency.run(
+        idempotency_key, f"patient:{patient_id}", "analys", req_hash,
+        lambda: analyse(patient_id, body),
+    )
 
+async def analyse(patient_id: int, body: AnalysRequest) -> Dict[str, Any]:
     top3 = model_predict(body.symptoms)
     top1_name = top3[0][0]
     top1_score = top3[0][1]
@@ -860,22 +1472,92 @@ async def analys_endpoint(body: AnalysRequest, user: dict = Depends(require_pati
 @app.post("/save_explanation")
 async def save_explanation_endpoint(body: SaveExplanationRequest, user: dict = Depends(require_patient)):
     patient_id = user.get("patient_id")
-    if not day_belongs_to_patient(body.day_id, patient_id):
+    ok = await run_in_threadpool(
+        save_explanation, body.day_id, patient_id, body.patient_explanation, body.doctor_explanation,
+    )
+    if not ok:
         raise HTTPException(status_code=403, detail="Access denied")
-    conn = connect()
+    db.mark_write(patient_id)
+    return {"ok": ok}
+
+@app.post("/explain_diagnosis")
+@limiter.limit("20/minute")
+async def explain_diagnosis_endpoint(request: Request, body: ExplainRequest, user: dict = Depends(require_patient_or_doctor)):
+    """Patient and doctor explanations for the model's top-3, cached across
+    presentations with the same quantized symptoms."""
+    patient_id = user.get("patient_id")
+    # Refuse before a cache miss can spend two LLM calls
+    if body.day_id is not None and (
+        user.get("role") != "patient" or not await run_in_threadpool(owns_day, body.day_id, patient_id)
+    ):
+        raise HTTPException(status_code=403, detail="Access denied")
+    top3 = [(name, disease_labels.get(name, name)) for name, _ in model_predict(body.symptoms)]
+    result = await explanations.explain(MODEL_VERSION, top3, body.symptoms, symptom_list, body.lang)
+    if body.day_id is not None:
+        if not await run_in_threadpool(
+            save_explanation, body.day_id, patient_id, result["patient_explanation"], result["doctor_explanation"],
+        ):
+            raise HTTPException(status_code=403, detail="Access denied")
+        db.mark_write(patient_id)
+    return result
+
+# ─── Doctor-only endpoints ───
+
+def find_similar_cases(body: SimilarCasesRequest) -> Optional[Tuple[int, List[Dict[str, Any]]]]:
+    """Owner of the day and its nearest days with their diagnoses, or None if the day doesn't exist."""
+    owner, symptoms = get_day_symptoms(body.day_id, None)
+    if owner is None:
+        return None
+    vector = [symptoms.get(code, 0) for code in symptom_list]
+    want = body.k * SIMILAR_CONFIRMED_OVERFETCH if body.confirmed_only else body.k
+    hits = similar_index.search(vector, want, owner if body.other_patients_only else None, body.day_id)
+    if not hits:
+        return owner, []
+
+    conn = connect_read()
     try:
         cur = conn.cursor()
         cur.execute("""
-            UPDATE diary_days
-            SET patient_explanation = %s, doctor_explanation = %s
-            WHERE day_id = %s
-        """, (encrypt_field(body.patient_explanation), encrypt_field(body.doctor_explanation), body.day_id))
-        conn.commit()
-        return {"ok": cur.rowcount > 0}
+            SELECT day_id, created_at, disease_predict, disease_setup, score
+            FROM diary_days WHERE day_id = ANY(%s)
+        """, ([day for day, _, _ in hits],))
+        days = {r[0]: r for r in cur.fetchall()}
     finally:
         conn.close()
 
-# ─── Doctor-only endpoints ───
+    cases = []
+    for day, pid, distance in hits:
+        row = days.get(day)
+        if row is None:
+            continue
+        setup = decrypt_field(row[3])
+        confirmed = setup not in (None, "", "Nothing")
+        if body.confirmed_only and not confirmed:
+            continue
+        cases.append({
+            "day_id": day,
+            "patient_id": pid,
+            "created_at": str(row[1]),
+            "distance": round(distance, 3),
+            "disease_predict": primary_disease(decrypt_field(row[2])),
+            "disease_setup": setup if confirmed else None,
+            "score": row[4],
+        })
+        if len(cases) >= body.k:
+            break
+    return owner, cases
+
+@app.post("/similar_cases")
+async def similar_cases_endpoint(body: SimilarCasesRequest, user: dict = Depends(require_doctor)):
+    """Past days with the closest symptom vectors (Euclidean) and how they were diagnosed."""
+    found = await run_in_threadpool(find_similar_cases, body)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Day not found")
+    owner, cases = found
+    # The matched days belong to other patients, so they are reads too
+    for patient_id in {owner, *(c["patient_id"] for c in cases)}:
+        audit.record(user, patient_id, "similar_cases")
+    return {"day_id": body.day_id, "cases": cases}
 
 @app.post("/update_by_doctor")
 async def update_by_doctor_endpoint(body: UpdateByDoctorRequest, user: dict = Depends(require_doctor)):
@@ -891,14 +1573,76 @@ async def update_by_doctor_endpoint(body: UpdateByDoctorRequest, user: dict = De
     return {"ok": ok}
 
 @app.post("/list_patients_triage")
-async def list_patients_triage_endpoint(user: dict = Depends(require_doctor)):
-    patients = get_all_patients_triage()
+async def list_patients_triage_endpoint(request: Request, user: dict = Depends(require_doctor)):
+    version = await run_in_threadpool(get_data_version, "global")
+    etag = versions.etag("triage", version)
+    if versions.not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    version, patients = await triage_flight.do(version, load_triage_snapshot)
+    etag = versions.etag("triage", version)
+    return ORJSONResponse({"patients": patients}, headers={"ETag": etag})
+
+def search_patients(name: Optional[str], city: Optional[str], prefix: bool, limit: int) -> List[Dict[str, Any]]:
+    conn = connect_read()
+    try:
+        return blind_index.search(conn.cursor(), name, city, prefix, decrypt_field, limit)
+    finally:
+        conn.close()
+
+@app.post("/search_patients")
+async def search_patients_endpoint(body: PatientSearchRequest, user: dict = Depends(require_doctor)):
+    """Name tokens must all match (the last one as a prefix when `prefix`); city must match exactly."""
+    if not blind_index.enabled():
+        raise HTTPException(status_code=503, detail="Patient search is not configured")
+    patients = await run_in_threadpool(search_patients, body.name, body.city, body.prefix, body.limit)
     return {"patients": patients}
 
+@app.get("/triage/stream")
+async def triage_stream_endpoint(request: Request, user: dict = Depends(require_doctor)):
+    """SSE feed of zone changes: `event: zone` with {patient_id, zone}; `event: resync`
+    means the client missed events and should refetch /list_patients_triage.
+    Browsers' EventSource can't send Authorization — use a fetch-based SSE client.
+    Not available on serverless deployments (needs a long-lived worker)."""
+    last_event_id = request.headers.get("last-event-id", "")
+    sub = await triage_stream.broadcaster.subscribe()
+
+    async def event_source():
+        try:
+            yield "retry: 3000\n\n"
+            # Subscribed (and LISTENing) before the replay query, so every event is
+            # in the replay, the queue, or both; sub.seen drops the doubles
+            if last_event_id.isdigit():
+                missed = await run_in_threadpool(load_triage_events, int(last_event_id))
+                if len(missed) >= triage_stream.REPLAY_LIMIT:
+                    yield triage_stream.format_sse(triage_stream.RESYNC)
+                else:
+                    for event in missed:
+                        sub.seen.add(event["id"])
+                    for event in triage_stream.latest_per_patient(missed):
+                        yield triage_stream.format_sse(event)
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=triage_stream.HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is not triage_stream.RESYNC and not sub.seen.add(event["id"]):
+                    continue
+                yield triage_stream.format_sse(event)
+        finally:
+            triage_stream.broadcaster.unsubscribe(sub)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/get_patient_info")
 async def get_patient_info_endpoint(body: PatientInfoRequest, user: dict = Depends(require_patient_or_doctor)):
     if user.get("role") == "patient" and user.get("patient_id") != body.patient_id:
         raise HTTPException(status_code=403, detail="Access denied")
+    audit.record(user, body.patient_id, "get_patient_info")
     info = select_patient(body.patient_id)
     if info is None:
         return {"found": False, "patient": None}
@@ -906,50 +1650,51 @@ async def get_patient_info_endpoint(body: PatientInfoRequest, user: dict = Depen
 
 @app.post("/get_day_symptoms")
 async def get_day_symptoms_endpoint(body: DaySymptomsRequest, user: dict = Depends(require_patient_or_doctor)):
-    if user.get("role") == "patient":
-        if not day_belongs_to_patient(body.day_id, user["patient_id"]):
-            raise HTTPException(status_code=403, detail="Access denied")
-    conn = connect()
+    patient_id = user["patient_id"] if user.get("role") == "patient" else None
+    owner, symptoms = await run_in_threadpool(get_day_symptoms, body.day_id, patient_id)
+    # Every diary day has a full symptom row set, so nothing back means not theirs
+    if patient_id is not None and not symptoms:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if owner is not None:
+        audit.record(user, owner, "get_day_symptoms")
+    return {"symptoms": symptoms}
+
+@app.post("/epidemiology")
+async def epidemiology_endpoint(body: EpidemiologyRequest, user: dict = Depends(require_doctor)):
+    if body.date_to < body.date_from:
+        raise HTTPException(status_code=400, detail="date_to must not be before date_from")
+    if (body.date_to - body.date_from).days > epidemiology.MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail="Date range too large")
+    conn = connect_read()
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT symptom_code, value
-            FROM diary_symptoms
-            WHERE day_id = %s
-            ORDER BY symptom_code
-        """, (body.day_id,))
-        rows = cur.fetchall()
-        symptoms = {r[0]: r[1] for r in rows}
+        counts = epidemiology.query_counts(
+            conn.cursor(), body.date_from, body.date_to, body.disease, body.city, body.zone,
+        )
     finally:
         conn.close()
-    return {"symptoms": symptoms}
+    return {"counts": counts}
 
 # ─── Lab Results endpoints ───
 
 ALLOWED_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp"}
 MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10 MB
 
-@app.post("/upload_lab_result")
-async def upload_lab_result_endpoint(
-    image: UploadFile = File(...),
-    user: dict = Depends(require_patient),
-):
-    patient_id = user["patient_id"]
-
-    if image.content_type not in ALLOWED_IMAGE_TYPES:
-        raise HTTPException(status_code=400, detail="Unsupported file type. Use JPG, PNG, or WebP.")
-
-    raw_bytes = await image.read()
-    if len(raw_bytes) > MAX_IMAGE_SIZE:
-        raise HTTPException(status_code=400, detail="File too large (max 10 MB)")
-
-    image_bytes = blur_pii_region(raw_bytes)
-
-    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-    mime = image.content_type
-
-    safe_filename = f"{uuid.uuid4().hex}.jpg"
+LAB_VISION_PROMPT = (
+    "Ты медицинский OCR-ассистент. Извлеки данные из фотографии медицинского анализа.\n"
+    "КРИТИЧЕСКОЕ ПРАВИЛО БЕЗОПАСНОСТИ: Полностью игнорируй любые персональные данные на изображении.\n"
+    "Верни ТОЛЬКО валидный JSON без markdown:\n"
+    "{\n"
+    '  "test_type": "Тип анализа",\n'
+    '  "test_date": "YYYY-MM-DD или пусто",\n'
+    '  "interpretation": "Краткая интерпретация отклонений",\n'
+    '  "results":[\n'
+    '    {"name": "Показатель", "value": "значение", "unit": "ед.", "reference_range": "норма", "status": "normal|high|low"}\n'
+    "  ]\n"
+    "}\n"
+)
 
+async def vision_extract_lab(image_bytes: bytes, mime: str) -> Dict[str, Any]:
+    """Send a (blurred) lab photo to the vision model and return the parsed JSON."""
     groq_key = os.environ.get("GROQ_API_KEY", "")
     if not groq_key:
         raise HTTPException(status_code=500, detail="GROQ_API_KEY not configured on server")
@@ -957,30 +1702,17 @@ async def upload_lab_result_endpoint(
     import httpx
 
     vision_model = os.environ.get("GROQ_VISION_MODEL", "llama-4-scout-17b-16e-instruct")
-
-    system_prompt = (
-        "Ты медицинский OCR-ассистент. Извлеки данные из фотографии медицинского анализа.\n"
-        "КРИТИЧЕСКОЕ ПРАВИЛО БЕЗОПАСНОСТИ: Полностью игнорируй любые персональные данные на изображении.\n"
-        "Верни ТОЛЬКО валидный JSON без markdown:\n"
-        "{\n"
-        '  "test_type": "Тип анализа",\n'
-        '  "test_date": "YYYY-MM-DD или пусто",\n'
-        '  "interpretation": "Краткая интерпретация отклонений",\n'
-        '  "results":[\n'
-        '    {"name": "Показатель", "value": "значение", "unit": "ед.", "reference_range": "норма", "status": "normal|high|low"}\n'
-        "  ]\n"
-        "}\n"
-    )
+    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
 
     try:
         async with httpx.AsyncClient(timeout=60) as client:
             resp = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
+                f"{symptom_extraction.LLM_API_BASE}/chat/completions",
                 headers={"Authorization": f"Bearer {groq_key}", "Content-Type": "application/json"},
                 json={
                     "model": vision_model,
                     "messages":[
-                        {"role": "system", "content": system_prompt},
+                        {"role": "system", "content": LAB_VISION_PROMPT},
                         {"role": "user", "content":[
                             {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_b64}"}},
                             {"type": "text", "text": "Извлеки все данные из этого анализа."},
@@ -1014,6 +1746,66 @@ async def upload_lab_result_endpoint(
 
     if "error" in parsed:
         raise HTTPException(status_code=422, detail=parsed["error"])
+    return parsed
+
+def store_lab_image(image_bytes: bytes) -> Tuple[str, Optional[str]]:
+    """Blurred image and its WebP thumbnail into the blob store."""
+    image_hash = blob_store.put(image_bytes)
+    thumb = blob_store.thumbnail(image_bytes)
+    return image_hash, blob_store.put(thumb) if thumb else None
+
+def lookup_lab_cache(patient_id: int, raw_bytes: bytes, chash: str, phash: Optional[int]) -> Optional[Dict[str, Any]]:
+    blurred: List[bytes] = []
+
+    def confirm(image_hash: str) -> bool:
+        # Stored images are blurred, so compare against the upload blurred the same way
+        if not blurred:
+            blurred.append(blur_pii_region(raw_bytes))
+        try:
+            return lab_cache.same_content(blob_store.read(image_hash), blurred[0])
+        except (OSError, ValueError):
+            return False
+
+    conn = connect()
+    try:
+        return lab_cache.lookup(conn.cursor(), patient_id, chash, phash, confirm)
+    finally:
+        conn.close()
+
+@app.post("/upload_lab_result")
+async def upload_lab_result_endpoint(
+    image: UploadFile = File(...),
+    user: dict = Depends(require_patient),
+    idempotency_key: Optional[str] = Header(None),
+):
+    patient_id = user["patient_id"]
+
+    if image.content_type not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported file type. Use JPG, PNG, or WebP.")
+
+    raw_bytes = await image.read()
+    if len(raw_bytes) > MAX_IMAGE_SIZE:
+        raise HTTPException(status_code=400, detail="File too large (max 10 MB)")
+
+    req_hash = idempotency.request_hash(image.content_type, raw_bytes)
+    return await idempotency.run(
+        idempotency_key, f"patient:{patient_id}", "upload_lab_result", req_hash,
+        lambda: process_lab_upload(patient_id, raw_bytes, image.content_type),
+    )
+
+async def process_lab_upload(patient_id: int, raw_bytes: bytes, content_type: str) -> Dict[str, Any]:
+    # Same photo re-uploaded (e.g. after a client timeout) → reuse the stored result
+    chash = lab_cache.content_hash(raw_bytes)
+    phash = lab_cache.perceptual_hash(raw_bytes)
+    cached = await run_in_threadpool(lookup_lab_cache, patient_id, raw_bytes, chash, phash)
+    if cached is not None:
+        logger.info("Lab OCR cache hit for patient %d (result %s)", patient_id, cached["result_id"])
+        return cached
+
+    image_bytes = blur_pii_region(raw_bytes)
+
+    parsed = await vision_extract_lab(image_bytes, content_type)
+    image_hash, thumb_hash = await run_in_threadpool(store_lab_image, image_bytes)
 
     test_type = parsed.get("test_type", "Неизвестный анализ")
     test_date = parsed.get("test_date", "")
@@ -1024,11 +1816,17 @@ async def upload_lab_result_endpoint(
     try:
         cur = conn.cursor()
         cur.execute("""
-            INSERT INTO lab_results(patient_id, test_type, test_date, results_json, interpretation, image_filename)
-            VALUES (%s, %s, %s, %s, %s, %s) RETURNING result_id
-        """, (patient_id, test_type, test_date, encrypt_field(json.dumps(results, ensure_ascii=False)), encrypt_field(interpretation), safe_filename))
+            INSERT INTO lab_results(patient_id, test_type, test_date, results_json, interpretation,
+                                    image_hash, image_type, thumb_hash)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING result_id
+        """, (patient_id, test_type, test_date, encrypt_field(json.dumps(results, ensure_ascii=False)), encrypt_field(interpretation),
+              image_hash, content_type, thumb_hash))
         result_id = cur.fetchone()[0]
+        lab_markers.insert_markers(cur, result_id, patient_id, test_type, test_date, results)
+        versions.bump(cur, patient_id)
+        lab_cache.store(cur, patient_id, chash, phash, result_id, test_type, test_date, results, interpretation)
         conn.commit()
+        db.mark_write(patient_id)
     finally:
         conn.close()
 
@@ -1041,43 +1839,70 @@ async def upload_lab_result_endpoint(
     }
 
 
+def lab_image_ref(result_id: int) -> Optional[Tuple[int, Optional[str], Optional[str], Optional[str]]]:
+    conn = connect_read()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT patient_id, image_hash, image_type, thumb_hash FROM lab_results WHERE result_id = %s",
+            (result_id,),
+        )
+        return cur.fetchone()
+    finally:
+        conn.close()
+
+@app.get("/lab_image/{result_id}")
+async def get_lab_image_endpoint(
+    result_id: int,
+    request: Request,
+    thumb: bool = False,
+    user: dict = Depends(require_patient_or_doctor),
+):
+    """Blurred lab photo (or its WebP thumbnail); supports Range and If-None-Match."""
+    ref = await run_in_threadpool(lab_image_ref, result_id)
+    if ref is None or (user.get("role") == "patient" and ref[0] != user["patient_id"]):
+        raise HTTPException(status_code=404, detail="Lab result not found")
+    owner, image_hash, image_type, thumb_hash = ref
+    audit.record(user, owner, "lab_image")
+    addr, media_type = (thumb_hash, "image/webp") if thumb else (image_hash, image_type or "application/octet-stream")
+    if not addr:
+        raise HTTPException(status_code=404, detail="No stored image for this result")
+    try:
+        return await run_in_threadpool(
+            blob_store.serve, addr, media_type, request.headers.get("range"), request.headers.get("if-none-match"),
+        )
+    except FileNotFoundError:
+        logger.error("Blob %s for lab result %d is missing", addr, result_id)
+        raise HTTPException(status_code=404, detail="Image file missing")
+
 @app.post("/get_lab_results")
-async def get_lab_results_endpoint(body: GetLabResultsRequest = None, user: dict = Depends(require_patient_or_doctor)):
+async def get_lab_results_endpoint(request: Request, body: GetLabResultsRequest = None, user: dict = Depends(require_patient_or_doctor)):
     if user.get("role") == "patient":
         patient_id = user["patient_id"]
     else:
         if not body or not body.patient_id:
             raise HTTPException(status_code=400, detail="patient_id required for doctors")
         patient_id = body.patient_id
+    audit.record(user, patient_id, "get_lab_results")
+
+    version = await run_in_threadpool(get_data_version, f"patient:{patient_id}", patient_id)
+    etag = versions.etag(f"labs-{patient_id}", version)
+    if versions.not_modified(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    version, results = await labs_flight.do((patient_id, version), load_lab_results_snapshot, patient_id)
+    etag = versions.etag(f"labs-{patient_id}", version)
+    return ORJSONResponse({"results": results}, headers={"ETag": etag})
+
+@app.post("/get_lab_marker_trend")
+async def get_lab_marker_trend_endpoint(body: LabMarkerTrendRequest, user: dict = Depends(require_patient_or_doctor)):
+    if user.get("role") == "patient":
+        patient_id = user["patient_id"]
+    else:
+        if not body.patient_id:
+            raise HTTPException(status_code=400, detail="patient_id required for doctors")
+        patient_id = body.patient_id
 
-    conn = connect()
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT result_id, test_type, test_date, results_json, interpretation, created_at
-            FROM lab_results
-            WHERE patient_id = %s
-            ORDER BY result_id DESC
-            LIMIT 50
-        """, (patient_id,))
-        rows = cur.fetchall()
-    finally:
-        conn.close()
-
-    results = []
-    for r in rows:
-        decrypted_json = decrypt_field(r[3])
-        try:
-            items = json.loads(decrypted_json) if decrypted_json else[]
-        except json.JSONDecodeError:
-            items = []
-        results.append({
-            "result_id": r[0],
-            "test_type": r[1],
-            "test_date": r[2],
-            "results": items,
-            "interpretation": decrypt_field(r[4]),
-            "created_at": r[5],
-        })
-
-    return {"results": results}
\ No newline at end of file
+    code = lab_markers.marker_code(body.marker)
+    points = await run_in_threadpool(load_lab_marker_trend, patient_id, code, body.since)
+    audit.record(user, patient_id, "get_lab_marker_trend")
+    return {"marker": code, "points": points}
@@ -0,0 +1,123 @@
+"""
+DB round trips per request for the hot endpoints.
+
+Runs each endpoint --repeat times against a backend seeded by loadtest/seed.py
+(its accounts file carries ready tokens) and divides the growth of a round-trip
+counter by the number of requests. Two counters are available:
+
+  --source metrics   the server's own db.round_trips.<path> (RoundTripMiddleware,
+                     /metrics); statements, BEGINs and COMMITs
+  --source pg        SUM(calls) in pg_stat_statements (needs the extension and
+                     --dsn); works on revisions that predate the counters. With
+                     track_utility on (the default) BEGIN/COMMIT are included
+
+To compare two revisions, run it against each and pass the first report to
+the second:
+
+    git checkout <before> && uvicorn main:app --port 8000 &
+    python benchmarks/bench_round_trips.py --source pg --dsn $DATABASE_URL --json before.json
+    git checkout <after> && uvicorn main:app --port 8000 &
+    python benchmarks/bench_round_trips.py --source pg --dsn $DATABASE_URL --compare before.json
+
+Use one worker, no read replicas and no other traffic on the database; for
+--source pg also set AUDIT_FLUSH_INTERVAL_SECONDS=3600 so audit COPYs stay out
+of the window. No numbers are checked in: they depend on the data seeded.
+"""
+
+import argparse
+import json
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+
+
+def metrics_counter(client: httpx.Client, doctor_token: str, path: str) -> Callable[[], int]:
+    def read() -> int:
+        resp = client.get("/metrics", headers={"Authorization": f"Bearer {doctor_token}"})
+        resp.raise_for_status()
+        return resp.json()["counters"].get(f"db.round_trips.{path}", 0)
+    return read
+
+
+def pg_counter(dsn: str) -> Callable[[], int]:
+    import psycopg2
+
+    def read() -> int:
+        conn = psycopg2.connect(dsn)
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute("SELECT COALESCE(SUM(calls), 0) FROM pg_stat_statements WHERE dbid = "
+                        "(SELECT oid FROM pg_database WHERE datname = current_database())")
+            return int(cur.fetchone()[0])
+        finally:
+            conn.close()
+    return read
+
+
+def mix(patient: dict, doctor: dict, day_ids: List[int]) -> List[Tuple[str, str, Callable[[int], dict], dict]]:
+    as_patient = {"Authorization": f"Bearer {patient['token']}"}
+    as_doctor = {"Authorization": f"Bearer {doctor['token']}"}
+    pid = patient["patient_id"]
+    day = lambda i: day_ids[i % len(day_ids)]  # noqa: E731
+    return [
+        ("get_history (patient)", "/get_history", lambda i: {"patient_id": pid}, as_patient),
+        ("get_history (doctor)", "/get_history", lambda i: {"patient_id": pid}, as_doctor),
+        ("get_day_symptoms", "/get_day_symptoms", lambda i: {"day_id": day(i)}, as_patient),
+        ("get_symptoms", "/get_symptoms", lambda i: {"patient_id": pid, "symptom_str": "FEVER"}, as_patient),
+        ("get_lab_results", "/get_lab_results", lambda i: {}, as_patient),
+        ("save_explanation", "/save_explanation",
+         lambda i: {"day_id": day(i), "patient_explanation": "bench"}, as_patient),
+        ("list_patients_triage", "/list_patients_triage", lambda i: {}, as_doctor),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DB round trips per request")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--accounts", default="loadtest/accounts.json")
+    parser.add_argument("--source", choices=["metrics", "pg"], default="metrics")
+    parser.add_argument("--dsn", default="", help="database to read pg_stat_statements from (--source pg)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", default="", help="write the report to this file")
+    parser.add_argument("--compare", default="", help="earlier report to show next to this one")
+    args = parser.parse_args()
+    if args.source == "pg" and not args.dsn:
+        parser.error("--source pg needs --dsn")
+
+    with open(args.accounts, encoding="utf-8") as f:
+        accounts = json.load(f)
+    patient, doctor = accounts["patients"][0], accounts["doctors"][0]
+
+    report: Dict[str, float] = {}
+    with httpx.Client(base_url=args.base_url, timeout=60) as client:
+        history = client.post("/get_history", json={"patient_id": patient["patient_id"]},
+                              headers={"Authorization": f"Bearer {patient['token']}"})
+        history.raise_for_status()
+        day_ids = [d["day_id"] for d in history.json()["history"]]
+        if not day_ids:
+            raise SystemExit(f"Patient {patient['patient_id']} has no diary days — seed with --days > 0")
+
+        for label, path, body, headers in mix(patient, doctor, day_ids):
+            read = pg_counter(args.dsn) if args.source == "pg" else metrics_counter(client, doctor["token"], path)
+            # The first pg_stat_statements probe counts itself once it has run
+            probe = 1 if args.source == "pg" else 0
+            # Warm-up: connections opened and statements prepared once per process aren't per-request cost
+            client.post(path, json=body(0), headers=headers).raise_for_status()
+            start = read()
+            for i in range(args.repeat):
+                client.post(path, json=body(i), headers=headers).raise_for_status()
+            report[label] = round((read() - start - probe) / args.repeat, 2)
+
+    before = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            before = json.load(f)
+        print(f"{'endpoint':<24}{'before':>8}{'after':>8}")
+    else:
+        print(f"{'endpoint':<24}{'trips':>8}")
+    for label, trips in report.items():
+        print(f"{label:<24}{before.get(label, '-'):>8}{trips:>8}" if before else f"{label:<24}{trips:>8}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,104 @@
+"""
+Serialization benchmark for /list_patients_triage-shaped payloads.
+
+Compares FastAPI's default path (jsonable_encoder + stdlib json, as JSONResponse
+renders it) with orjson on a synthetic triage list, and reports bytes on the
+wire raw / gzip / brotli.
+
+    python benchmarks/bench_serialization.py [--patients 10000] [--repeat 20]
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import random
+import statistics
+import time
+
+import orjson
+
+try:
+    from fastapi.encoders import jsonable_encoder
+except ImportError:
+    jsonable_encoder = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+NAMES = ["Айгерим Садыкова", "Нурлан Ахметов", "Мария Иванова", "Тимур Касымов", "Алия Жумабаева"]
+CITIES = ["Алматы", "Астана", "Шымкент", "Караганда", "Актобе"]
+DISEASES = ["Influenza Common Cold Pneumonia", "Croup Asthma Bronchiolitis", "Gastroenteritis Appendicitis Influenza", ""]
+
+
+def make_rows(n: int):
+    rnd = random.Random(42)
+    base = datetime.datetime(2026, 1, 1, 9, 0, 0)
+    rows = []
+    for i in range(1, n + 1):
+        disease = rnd.choice(DISEASES)
+        created = base + datetime.timedelta(minutes=rnd.randint(0, 500_000))
+        rows.append({
+            "patient_id": i,
+            "full_name": rnd.choice(NAMES),
+            "city": rnd.choice(CITIES),
+            "created_at": str(created),
+            "last_disease": disease,
+            "last_score": rnd.random() if disease else 0.0,
+            "diag_date": str(created + datetime.timedelta(days=3)) if disease else None,
+            "zone": rnd.choice(["red", "yellow", "green"]),
+        })
+    return {"patients": rows}
+
+
+def stdlib_render(payload):
+    content = jsonable_encoder(payload) if jsonable_encoder else payload
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def orjson_render(payload):
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def timed(fn, payload, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        body = fn(payload)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return body, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = make_rows(args.patients)
+    label = "jsonable_encoder + json" if jsonable_encoder else "json (fastapi not installed)"
+    std_body, std_ms = timed(stdlib_render, payload, args.repeat)
+    orj_body, orj_ms = timed(orjson_render, payload, args.repeat)
+    assert json.loads(std_body) == json.loads(orj_body)
+
+    print(f"{args.patients} patients, median of {args.repeat} runs")
+    print(f"  {label:<32} {std_ms:8.2f} ms")
+    print(f"  {'orjson':<32} {orj_ms:8.2f} ms   ({std_ms / orj_ms:.1f}x)")
+
+    print("bytes on the wire")
+    print(f"  {'identity':<32} {len(orj_body):>10,}")
+    for level in (5, 9):
+        t0 = time.perf_counter()
+        gz = gzip.compress(orj_body, compresslevel=level)
+        print(f"  {f'gzip (level {level})':<32} {len(gz):>10,}   {(time.perf_counter() - t0) * 1000:.2f} ms")
+    if brotli is not None:
+        t0 = time.perf_counter()
+        br = brotli.compress(orj_body, quality=4)
+        print(f"  {'brotli (quality 4)':<32} {len(br):>10,}   {(time.perf_counter() - t0) * 1000:.2f} ms")
+    else:
+        print("  brotli not installed — skipped")
+
+
+if __name__ == "__main__":
+    main()
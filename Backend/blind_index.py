@@ -0,0 +1,172 @@
+"""
+Blind index for searching Fernet-encrypted patient names and cities.
+
+For every normalised name token (and its prefixes of at least MIN_PREFIX
+characters) and for the city, patient_blind_index stores
+HMAC-SHA256(BLIND_INDEX_KEY, field + value), truncated to 128 bits. Lookups
+hash the query the same way and hit the (field, term) index; only matching
+patients are decrypted, and the decrypted values are re-checked to drop
+truncation collisions.
+
+BLIND_INDEX_KEY must differ from DB_ENCRYPTION_KEY: a leaked index key lets
+an attacker confirm guessed names, but never decrypt anything. Without the
+key, registration skips indexing and search is unavailable.
+
+Index existing patients:  python blind_index.py backfill
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import re
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import psycopg2.extras
+
+KEY = os.environ.get("BLIND_INDEX_KEY", "").encode("utf-8")
+MIN_PREFIX = int(os.environ.get("BLIND_INDEX_MIN_PREFIX", "3"))
+MAX_TOKEN = 32
+
+_NON_LETTER = re.compile(r"[^\w]+|[\d_]+")
+
+
+def enabled() -> bool:
+    return bool(KEY)
+
+
+def normalize(text: Optional[str]) -> str:
+    text = unicodedata.normalize("NFKC", text or "").casefold().replace("ё", "е")
+    return " ".join(_NON_LETTER.sub(" ", text).split())
+
+
+def tokens(text: Optional[str]) -> List[str]:
+    return [t[:MAX_TOKEN] for t in normalize(text).split()]
+
+
+def term(field: str, value: str) -> str:
+    mac = hmac.new(KEY, f"{field}\x00{value}".encode("utf-8"), hashlib.sha256)
+    return mac.hexdigest()[:32]
+
+
+def patient_terms(full_name: Optional[str], city: Optional[str]) -> List[Tuple[str, str]]:
+    terms = set()
+    for tok in tokens(full_name):
+        terms.add(("name", term("name", tok)))
+        for n in range(MIN_PREFIX, len(tok) + 1):
+            terms.add(("name_prefix", term("name_prefix", tok[:n])))
+    city_norm = normalize(city)
+    if city_norm:
+        terms.add(("city", term("city", city_norm)))
+    return sorted(terms)
+
+
+def index_patient(cur, patient_id: int, full_name: Optional[str], city: Optional[str]) -> None:
+    """(Re)write one patient's terms; call in the transaction that writes the patient."""
+    if not enabled():
+        return
+    cur.execute("DELETE FROM patient_blind_index WHERE patient_id = %s", (patient_id,))
+    rows = [(patient_id, field, t) for field, t in patient_terms(full_name, city)]
+    if rows:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO patient_blind_index(patient_id, field, term) VALUES %s
+            ON CONFLICT DO NOTHING
+        """, rows)
+
+
+def query_terms(name: Optional[str], city: Optional[str], prefix: bool) -> List[Tuple[str, str]]:
+    """Every whole name token must match; with `prefix`, the last one may be a
+    prefix (as typed into a search box)."""
+    toks = tokens(name)
+    terms = []
+    for i, tok in enumerate(toks):
+        if prefix and i == len(toks) - 1 and len(tok) >= MIN_PREFIX:
+            terms.append(("name_prefix", term("name_prefix", tok)))
+        else:
+            terms.append(("name", term("name", tok)))
+    if normalize(city):
+        terms.append(("city", term("city", normalize(city))))
+    return sorted(set(terms))
+
+
+def _matches(full_name: str, city: str, name: Optional[str], city_q: Optional[str], prefix: bool) -> bool:
+    have = tokens(full_name)
+    want = tokens(name)
+    for i, tok in enumerate(want):
+        if prefix and i == len(want) - 1 and len(tok) >= MIN_PREFIX:
+            if not any(h.startswith(tok) for h in have):
+                return False
+        elif tok not in have:
+            return False
+    return not normalize(city_q) or normalize(city) == normalize(city_q)
+
+
+def search(cur, name: Optional[str], city: Optional[str], prefix: bool,
+           decrypt: Callable[[Optional[str]], Optional[str]], limit: int = 20) -> List[Dict[str, Any]]:
+    terms = query_terms(name, city, prefix)
+    if not terms:
+        return []
+    cur.execute("""
+        SELECT p.patient_id, p.full_name, p.city, p.created_at
+        FROM patients p
+        JOIN (
+            SELECT patient_id
+            FROM patient_blind_index
+            WHERE (field, term) IN %s
+            GROUP BY patient_id
+            HAVING COUNT(*) = %s
+            ORDER BY patient_id
+            LIMIT %s
+        ) hit ON hit.patient_id = p.patient_id
+        ORDER BY p.patient_id
+    """, (tuple(terms), len(terms), limit * 2))
+    out = []
+    for pid, enc_name, enc_city, created_at in cur.fetchall():
+        full_name, city_plain = decrypt(enc_name), decrypt(enc_city)
+        if _matches(full_name, city_plain, name, city, prefix):
+            out.append({"patient_id": pid, "full_name": full_name, "city": city_plain, "created_at": str(created_at)})
+            if len(out) >= limit:
+                break
+    return out
+
+
+def backfill(conn, decrypt: Callable[[Optional[str]], Optional[str]], batch: int = 500) -> int:
+    """Index every patient, committing per batch. Returns the number indexed."""
+    cur = conn.cursor()
+    last_id, done = 0, 0
+    while True:
+        cur.execute("""
+            SELECT patient_id, full_name, city FROM patients
+            WHERE patient_id > %s ORDER BY patient_id LIMIT %s
+        """, (last_id, batch))
+        rows = cur.fetchall()
+        if not rows:
+            return done
+        for pid, enc_name, enc_city in rows:
+            index_patient(cur, pid, decrypt(enc_name), decrypt(enc_city))
+        conn.commit()
+        last_id = rows[-1][0]
+        done += len(rows)
+
+
+if __name__ == "__main__":
+    from crypto_utils import decrypt_field
+    from db import connect
+
+    parser = argparse.ArgumentParser(description="Maintain patient_blind_index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="index all existing patients")
+    parser.parse_args()
+    if not enabled():
+        raise SystemExit("BLIND_INDEX_KEY is not set")
+
+    conn = connect()
+    try:
+        print(f"{backfill(conn, decrypt_field)} patients indexed")
+    finally:
+        conn.close()
@@ -0,0 +1,277 @@
+"""
+Content-addressed store for lab images on local disk.
+
+Blobs live at BLOB_DIR/ab/cd/<address>. The address is the SHA-256 of the
+content (an HMAC under the blob key when encryption is on, so file names
+don't reveal which image is which), so an image uploaded twice is stored
+once. Writes go to a temp file in the shard and are renamed into place.
+
+With BLOB_ENCRYPTION_KEY set (32 bytes, urlsafe base64) files are AES-256-GCM
+in CHUNK_SIZE chunks, each with its own nonce and tag; the last chunk is
+flagged in its nonce so truncation is detected. A byte range is served by
+reading and decrypting only the chunks it covers, so memory per request
+stays at one chunk.
+
+Without a key blobs are plaintext and the bytes never pass through Python
+when the front server can take over: nginx via X-Accel-Redirect (set
+BLOB_ACCEL_PREFIX to an internal location aliased to BLOB_DIR), or the ASGI
+zero-copy send extension (sendfile) when the ASGI server offers it.
+Otherwise they are streamed chunk by chunk.
+
+WebP thumbnails (THUMB_SIZE px on the long edge) are generated at upload and
+stored as blobs of their own.
+"""
+
+import base64
+import hashlib
+import hmac
+import io
+import os
+import re
+import struct
+import tempfile
+from typing import Iterator, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+
+import metrics
+
+try:
+    from PIL import Image
+    HAS_PILLOW = True
+except ImportError:
+    HAS_PILLOW = False
+
+BLOB_DIR = os.environ.get("BLOB_DIR", "blobs")
+ACCEL_PREFIX = os.environ.get("BLOB_ACCEL_PREFIX", "").rstrip("/")
+THUMB_SIZE = int(os.environ.get("THUMB_SIZE", "320"))
+THUMB_QUALITY = 75
+CHUNK_SIZE = 64 * 1024
+
+# magic, plaintext size, chunk size, 7-byte nonce prefix
+MAGIC = b"TMSB1"
+_HEADER = struct.Struct(">5sQI7s")
+_TAG = 16
+
+_ADDRESS = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _load_key() -> Optional[bytes]:
+    raw = os.environ.get("BLOB_ENCRYPTION_KEY", "")
+    if not raw:
+        return None
+    key = base64.urlsafe_b64decode(raw)
+    if len(key) != 32:
+        raise ValueError("BLOB_ENCRYPTION_KEY must be 32 bytes, urlsafe base64")
+    return key
+
+
+_KEY = _load_key()
+_AEAD = AESGCM(_KEY) if _KEY else None
+
+
+def encrypted() -> bool:
+    return _AEAD is not None
+
+
+def address(data: bytes) -> str:
+    if _KEY:
+        return hmac.new(_KEY, data, hashlib.sha256).hexdigest()
+    return hashlib.sha256(data).hexdigest()
+
+
+def path_of(addr: str) -> str:
+    if not _ADDRESS.match(addr):
+        raise ValueError(f"Not a blob address: {addr!r}")
+    return os.path.join(BLOB_DIR, addr[:2], addr[2:4], addr)
+
+
+def _nonce(prefix: bytes, index: int, last: bool) -> bytes:
+    return prefix + struct.pack(">IB", index, last)
+
+
+def _encrypt(data: bytes) -> bytes:
+    prefix = os.urandom(7)
+    header = _HEADER.pack(MAGIC, len(data), CHUNK_SIZE, prefix)
+    n_chunks = max(1, -(-len(data) // CHUNK_SIZE))
+    parts = [header]
+    for i in range(n_chunks):
+        chunk = data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]
+        parts.append(_AEAD.encrypt(_nonce(prefix, i, i == n_chunks - 1), chunk, header))
+    return b"".join(parts)
+
+
+def put(data: bytes) -> str:
+    """Store `data` unless a blob with the same content exists. Returns its address."""
+    addr = address(data)
+    path = path_of(addr)
+    if os.path.exists(path):
+        metrics.inc("blob_store.dedup")
+        return addr
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_encrypt(data) if _AEAD else data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    metrics.inc("blob_store.put")
+    metrics.inc("blob_store.put_bytes", len(data))
+    return addr
+
+
+def _read_header(f) -> Tuple[int, int, bytes, bytes]:
+    header = f.read(_HEADER.size)
+    magic, size, chunk_size, prefix = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not an encrypted blob")
+    return size, chunk_size, prefix, header
+
+
+def size(addr: str) -> int:
+    """Size of the stored content (plaintext)."""
+    path = path_of(addr)
+    if not _AEAD:
+        return os.path.getsize(path)
+    with open(path, "rb") as f:
+        return _read_header(f)[0]
+
+
+def iter_range(addr: str, start: int, end: int) -> Iterator[bytes]:
+    """Yield content bytes start..end (inclusive), at most one chunk at a time."""
+    with open(path_of(addr), "rb") as f:
+        if not _AEAD:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(CHUNK_SIZE, remaining))
+                if not block:
+                    return
+                remaining -= len(block)
+                yield block
+            return
+
+        total, chunk_size, prefix, header = _read_header(f)
+        last_index = max(0, -(-total // chunk_size) - 1)
+        for i in range(start // chunk_size, end // chunk_size + 1):
+            f.seek(_HEADER.size + i * (chunk_size + _TAG))
+            chunk = _AEAD.decrypt(_nonce(prefix, i, i == last_index), f.read(chunk_size + _TAG), header)
+            base = i * chunk_size
+            yield chunk[max(start - base, 0):end - base + 1]
+
+
+def read(addr: str) -> bytes:
+    n = size(addr)
+    return b"".join(iter_range(addr, 0, n - 1)) if n else b""
+
+
+def thumbnail(data: bytes) -> Optional[bytes]:
+    """WebP preview no larger than THUMB_SIZE on either side, or None."""
+    if not HAS_PILLOW:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="WEBP", quality=THUMB_QUALITY, method=4)
+        return buf.getvalue()
+    except Exception:
+        return None
+
+
+# ─── HTTP serving ───
+
+def parse_range(header: Optional[str], total: int) -> Optional[Tuple[int, int]]:
+    """A single `bytes=` range as (start, end) inclusive; None means the whole
+    blob (no header, or a multi-range request, which may be answered with 200).
+    Raises 416 for unsatisfiable ranges."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else total - 1
+        else:
+            start, end = total - int(last), total - 1
+    except ValueError:
+        return None
+    start, end = max(start, 0), min(end, total - 1)
+    if total == 0 or start > end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{total}"})
+    return start, end
+
+
+class BlobResponse(Response):
+    """Streams one byte range of a blob. Plaintext blobs go out with the ASGI
+    zero-copy extension when the server supports it."""
+
+    def __init__(self, addr: str, start: int, end: int, status_code: int, headers: dict, media_type: str):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.addr = addr
+        self.start = start
+        self.end = end
+        self.raw_headers = [(k, v) for k, v in self.raw_headers if k != b"content-length"]
+        self.raw_headers.append((b"content-length", str(end - start + 1).encode("latin-1")))
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or self.end < self.start:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if not _AEAD and "http.response.zerocopysend" in scope.get("extensions", {}):
+            metrics.inc("blob_store.zerocopy")
+            with open(path_of(self.addr), "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f,
+                            "offset": self.start, "count": self.end - self.start + 1})
+            return
+        chunks = iter_range(self.addr, self.start, self.end)
+        while True:
+            block = await run_in_threadpool(next, chunks, None)
+            if block is None:
+                break
+            await send({"type": "http.response.body", "body": block, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def serve(addr: str, media_type: str, range_header: Optional[str] = None,
+          if_none_match: Optional[str] = None) -> Response:
+    """Response for GET of a blob: 304 on a matching ETag, 206 for a range,
+    X-Accel-Redirect when nginx serves the file."""
+    etag = f'"{addr[:32]}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Content-addressed, so a given URL+ETag never changes
+        "Cache-Control": "private, max-age=86400",
+    }
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    if ACCEL_PREFIX and not _AEAD:
+        metrics.inc("blob_store.accel")
+        headers["X-Accel-Redirect"] = f"{ACCEL_PREFIX}/{addr[:2]}/{addr[2:4]}/{addr}"
+        return Response(headers=headers, media_type=media_type)
+
+    total = size(addr)
+    rng = parse_range(range_header, total)
+    if rng is None:
+        return BlobResponse(addr, 0, total - 1, 200, headers, media_type)
+    start, end = rng
+    headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    metrics.inc("blob_store.range")
+    return BlobResponse(addr, start, end, 206, headers, media_type)
@@ -0,0 +1,380 @@
+"""
+Postgres connection helpers shared by the API module and maintenance commands.
+
+connect() / connect_read() hand out pooled connections; close() returns them to
+a per-target idle pool (rolled back, autocommit off) instead of disconnecting.
+An idle connection is checked before reuse: any pending input is read, so a
+backend the server already terminated shows up as an error, and one idle for
+DB_POOL_PING_AFTER_SECONDS also gets a `SELECT 1`. Dead ones are discarded
+(db.connections_discarded); opening a new connection is retried once.
+Each pooled connection remembers which server-side prepared statements it
+holds, so hot statements registered with prepare() are parsed and planned once
+per connection and then run with EXECUTE (see execute_prepared / query).
+
+Statements, BEGINs and COMMITs are counted as round trips, per request when a
+counter is active (count_round_trips) and in total (db.round_trips).
+
+Writes always go to DATABASE_URL. Read-only service functions call
+connect_read(), which round-robins over DATABASE_REPLICA_URLS and falls back to
+the primary when:
+  - no replica is configured or reachable (a failed replica is skipped for
+    DB_REPLICA_RETRY_SECONDS),
+  - a replica lags more than DB_REPLICA_MAX_LAG_SECONDS (re-measured at most
+    every DB_REPLICA_CHECK_SECONDS on the connection about to be used),
+  - the patient being read was written by this worker in the last
+    DB_READ_PIN_SECONDS (read-your-writes, e.g. history right after /analys),
+  - the client itself wrote in the last DB_READ_PIN_SECONDS, on any worker.
+    A request that writes hands the client its write time (WRITE_HEADER and
+    WRITE_COOKIE, see track_writes); the client sends it back and whichever
+    worker serves its next reads keeps them on the primary.
+"""
+
+import contextvars
+import itertools
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+REPLICA_URLS = [u.strip() for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+READ_PIN_SECONDS = float(os.environ.get("DB_READ_PIN_SECONDS", "5"))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("DB_REPLICA_MAX_LAG_SECONDS", "10"))
+REPLICA_CHECK_SECONDS = float(os.environ.get("DB_REPLICA_CHECK_SECONDS", "5"))
+REPLICA_RETRY_SECONDS = float(os.environ.get("DB_REPLICA_RETRY_SECONDS", "30"))
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+POOL_PING_AFTER_SECONDS = float(os.environ.get("DB_POOL_PING_AFTER_SECONDS", "30"))
+CONNECT_RETRY_DELAY_SECONDS = 0.2
+
+# Replay lag; 0 when the replica has applied everything it received (idle primary)
+_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+# ─── Round-trip accounting ───
+
+_round_trips: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("db_round_trips", default=None)
+
+
+def count_round_trips() -> List[int]:
+    """Start counting for the current context (request); returns the live counter.
+    Threadpool calls and tasks started from this context add to the same counter."""
+    counter = [0]
+    _round_trips.set(counter)
+    return counter
+
+
+def _count(n: int) -> None:
+    if n <= 0:
+        return
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += n
+    metrics.inc("db.round_trips", n)
+
+
+def _opens_transaction(conn) -> int:
+    # psycopg2 sends BEGIN on its own round trip before the first statement
+    idle = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return 1 if idle and not conn.autocommit else 0
+
+
+class TrackedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        _count(1 + _opens_transaction(self.connection))
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        _count(len(vars_list) + _opens_transaction(self.connection))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        _count(1 + _opens_transaction(self.connection))
+        return super().copy_expert(sql, file, size)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """close() hands the connection back to its pool; `prepared` lists the
+    server-side statements this session already holds."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool: Optional["_Pool"] = None
+        self.returned = False
+        self.prepared: set = set()
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", TrackedCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count(1)
+        super().commit()
+
+    def rollback(self):
+        if self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            _count(1)
+        super().rollback()
+
+    def close(self):
+        # A second close() must not touch a connection that is back in the
+        # idle list, or possibly already checked out by another thread
+        if self.returned:
+            return
+        pool, self.pool = self.pool, None
+        if pool is None or self.closed:
+            super().close()
+        else:
+            self.returned = True
+            pool.put(self)
+
+    def discard(self):
+        """Really close the connection (the pool's side of close())."""
+        super().close()
+
+
+class _Pool:
+    """LIFO idle list per DSN. Connections are opened on demand, so there is
+    no upper bound on checked-out connections; at most `size` stay idle."""
+
+    def __init__(self, dsn: str, size: int = POOL_SIZE, readonly: bool = False):
+        self.dsn = dsn
+        self.size = size
+        self.readonly = readonly
+        self.idle: List[Tuple[PooledConnection, float]] = []
+        self.lock = threading.Lock()
+
+    def _alive(self, conn: PooledConnection, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        try:
+            # No round trip: reads what the server sent while idle, e.g. the EOF of a terminated backend
+            conn.poll()
+            if time.monotonic() - idle_since >= POOL_PING_AFTER_SECONDS:
+                metrics.inc("db.pool_pings")
+                conn.autocommit = True
+                conn.cursor().execute("SELECT 1")
+                conn.autocommit = False
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _open(self, retry: bool, connect_kwargs: dict) -> PooledConnection:
+        try:
+            return psycopg2.connect(self.dsn, connection_factory=PooledConnection, **connect_kwargs)
+        except psycopg2.OperationalError:
+            if not retry:
+                raise
+        metrics.inc("db.connect_retries")
+        time.sleep(CONNECT_RETRY_DELAY_SECONDS)
+        return psycopg2.connect(self.dsn, connection_factory=PooledConnection, **connect_kwargs)
+
+    def get(self, retry: bool = True, **connect_kwargs) -> PooledConnection:
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, idle_since = self.idle.pop()
+            if self._alive(conn, idle_since):
+                conn.pool = self
+                conn.returned = False
+                return conn
+            metrics.inc("db.connections_discarded")
+            try:
+                conn.discard()
+            except psycopg2.Error:
+                pass
+        conn = self._open(retry, connect_kwargs)
+        if self.readonly:
+            conn.set_session(readonly=True)
+        metrics.inc("db.connections_opened")
+        conn.pool = self
+        return conn
+
+    def put(self, conn: PooledConnection) -> None:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            conn.discard()
+            return
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.monotonic()))
+                return
+        conn.discard()
+
+
+_primary = _Pool(DATABASE_URL)
+
+
+def connect():
+    return _primary.get()
+
+
+# ─── Prepared statements ───
+
+_statements: Dict[str, str] = {}
+
+
+def prepare(name: str, sql: str) -> str:
+    """Register a hot statement ($1, $2 … placeholders) under `name`."""
+    _statements[name] = sql
+    return name
+
+
+def execute_prepared(cur, name: str, params: Sequence[Any] = ()) -> None:
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {_statements[name]}")
+        # Prepared statements outlive the transaction (even a rolled-back one)
+        conn.prepared.add(name)
+    if params:
+        cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", tuple(params))
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+def query(name: str, params: Sequence[Any] = (), read: bool = False, patient_id: Optional[int] = None):
+    """Run one prepared statement in autocommit: a single round trip, no
+    BEGIN/COMMIT. Returns the rows, or the row count for statements without
+    a result set."""
+    conn = connect_read(patient_id) if read else connect()
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        execute_prepared(cur, name, params)
+        return cur.fetchall() if cur.description else cur.rowcount
+    finally:
+        conn.close()
+
+
+# ─── Read replicas ───
+
+class _Replica:
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool = _Pool(dsn, readonly=True)
+        self.down_until = 0.0
+        self.checked_at = 0.0
+        self.lag = 0.0
+
+
+_replicas = [_Replica(dsn) for dsn in REPLICA_URLS]
+_round_robin = itertools.count()
+_lock = threading.Lock()
+_recent_writes: Dict[int, float] = {}
+
+# Client-visible write time (epoch seconds): set on responses to writes, echoed back on requests
+WRITE_HEADER = "X-Last-Write"
+WRITE_COOKIE = "tms_last_write"
+# [last write the client reported, write made by the current request]
+_client_writes: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar("db_client_writes",
+                                                                                        default=None)
+
+
+def track_writes(client_value: Optional[str]) -> List[float]:
+    """Start read-your-writes tracking for the current request. `client_value`
+    is the write time the client sent back (header or cookie). Returns the live
+    pair; a non-zero second item means the response must carry a new write time."""
+    try:
+        reported = float(client_value or 0)
+    except ValueError:
+        reported = 0.0
+    if reported != reported or reported in (float("inf"), float("-inf")):
+        reported = 0.0
+    state = [reported, 0.0]
+    _client_writes.set(state)
+    return state
+
+
+def mark_write(patient_id: int) -> None:
+    """Pin reads of this patient to the primary for READ_PIN_SECONDS, on this
+    worker and, through track_writes, for the writing client on every worker."""
+    if not _replicas:
+        return
+    state = _client_writes.get()
+    if state is not None:
+        state[1] = time.time()
+    now = time.monotonic()
+    with _lock:
+        _recent_writes[patient_id] = now
+        if len(_recent_writes) > 10_000:
+            for pid, t in list(_recent_writes.items()):
+                if now - t >= READ_PIN_SECONDS:
+                    del _recent_writes[pid]
+
+
+def _pinned(patient_id: Optional[int]) -> bool:
+    state = _client_writes.get()
+    # A second of slack for clocks between hosts
+    if state is not None and -1.0 < time.time() - max(state) < READ_PIN_SECONDS:
+        return True
+    if patient_id is None:
+        return False
+    with _lock:
+        t = _recent_writes.get(patient_id)
+    return t is not None and time.monotonic() - t < READ_PIN_SECONDS
+
+
+def _try_replica(replica: _Replica):
+    now = time.monotonic()
+    try:
+        # No retry: an unreachable replica just means reading from the primary
+        conn = replica.pool.get(retry=False, connect_timeout=2)
+    except psycopg2.Error:
+        replica.down_until = now + REPLICA_RETRY_SECONDS
+        metrics.inc("db.replica_unreachable")
+        return None
+    try:
+        if now - replica.checked_at >= REPLICA_CHECK_SECONDS:
+            cur = conn.cursor()
+            cur.execute(_LAG_SQL)
+            replica.lag = float(cur.fetchone()[0])
+            replica.checked_at = now
+            conn.rollback()
+    except psycopg2.Error:
+        conn.close()
+        replica.down_until = now + REPLICA_RETRY_SECONDS
+        metrics.inc("db.replica_unreachable")
+        return None
+    if replica.lag > REPLICA_MAX_LAG_SECONDS:
+        conn.close()
+        metrics.inc("db.replica_lagging")
+        return None
+    return conn
+
+
+def connect_read(patient_id: Optional[int] = None):
+    """Connection for read-only work; see the module docstring for routing rules."""
+    if not _replicas or _pinned(patient_id):
+        metrics.inc("db.reads_primary")
+        return connect()
+    start = next(_round_robin)
+    now = time.monotonic()
+    for i in range(len(_replicas)):
+        replica = _replicas[(start + i) % len(_replicas)]
+        if replica.down_until > now:
+            continue
+        conn = _try_replica(replica)
+        if conn is not None:
+            metrics.inc("db.reads_replica")
+            return conn
+    metrics.inc("db.reads_primary")
+    return connect()
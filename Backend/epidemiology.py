@@ -0,0 +1,208 @@
+"""
+Population-level rollups for outbreak monitoring.
+
+Every diary day is counted at write time into epi_daily_counts
+(day, city_bucket, disease, zone, count). The table holds no patient
+identifiers and no ciphertext, so date-range queries are plain index scans
+and never decrypt diary_days or patients.
+
+patients.city is free text and encrypted, so it is never copied here: it is
+mapped onto a fixed list of cities (CITIES), anything else counts as "other".
+query_counts merges cells below MIN_CELL_COUNT into "other" and drops what is
+still below it, so a single patient can't be picked out of the rollup.
+
+Backfill (decrypts diary_days / patients once):  python epidemiology.py rebuild
+Counts for archived months (see partitions.py) are not recomputed, only moved
+onto the city buckets.
+"""
+
+import argparse
+import datetime
+import os
+import re
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import psycopg2.extras
+
+import partitions
+
+MAX_RANGE_DAYS = 366
+MIN_CELL_COUNT = int(os.environ.get("EPI_MIN_CELL_COUNT", "5"))
+
+# bucket → spellings patients type (ru / kk / en), compared after normalising
+CITIES = {
+    "almaty": ["алматы", "алма-ата", "алма ата", "almaty", "alma-ata"],
+    "astana": ["астана", "нур-султан", "нур султан", "целиноград", "астана қаласы", "astana", "nur-sultan"],
+    "shymkent": ["шымкент", "чимкент", "shymkent"],
+    "karaganda": ["караганда", "қарағанды", "karaganda", "karagandy"],
+    "aktobe": ["актобе", "ақтөбе", "актюбинск", "aktobe"],
+    "taraz": ["тараз", "джамбул", "taraz"],
+    "pavlodar": ["павлодар", "pavlodar"],
+    "oskemen": ["усть-каменогорск", "усть каменогорск", "өскемен", "оскемен", "oskemen", "ust-kamenogorsk"],
+    "semey": ["семей", "семипалатинск", "semey"],
+    "atyrau": ["атырау", "гурьев", "atyrau"],
+    "kostanay": ["костанай", "қостанай", "кустанай", "kostanay"],
+    "kyzylorda": ["кызылорда", "қызылорда", "kyzylorda"],
+    "oral": ["уральск", "орал", "oral", "uralsk"],
+    "petropavl": ["петропавловск", "петропавл", "petropavl", "petropavlovsk"],
+    "aktau": ["актау", "ақтау", "aktau"],
+    "turkistan": ["туркестан", "түркістан", "turkistan"],
+    "taldykorgan": ["талдыкорган", "талдықорған", "taldykorgan"],
+    "kokshetau": ["кокшетау", "көкшетау", "kokshetau"],
+    "ekibastuz": ["экибастуз", "екібастұз", "ekibastuz"],
+    "zhezkazgan": ["жезказган", "жезқазған", "zhezkazgan"],
+}
+OTHER = "other"
+UNKNOWN = "unknown"
+
+
+def _normalize(city: str) -> str:
+    city = re.sub(r"\s+", " ", city.strip().casefold().replace("ё", "е"))
+    return re.sub(r"^(?:г\.|г |город |city of )\s*", "", city).strip(" .,")
+
+
+_CITY_LOOKUP = {_normalize(alias): bucket for bucket, aliases in CITIES.items() for alias in aliases}
+BUCKETS = set(CITIES) | {OTHER, UNKNOWN}
+
+
+def city_bucket(city: Optional[str]) -> str:
+    """Map a patient's free-text city onto CITIES; never returns what they typed."""
+    if not city or not _normalize(city):
+        return UNKNOWN
+    normalized = _normalize(city)
+    if normalized in BUCKETS:
+        return normalized
+    return _CITY_LOOKUP.get(normalized, OTHER)
+
+
+def suppress_small_cells(rows: List[Dict[str, Any]], min_count: int = MIN_CELL_COUNT,
+                         merge: bool = True) -> List[Dict[str, Any]]:
+    """Fold cells below `min_count` into the (day, "other", disease, zone) cell
+    (or with merge=False just drop them), then drop whatever is still below it."""
+    kept: Dict[Tuple[str, str, str, str], int] = {}
+    small: Counter = Counter()
+    for r in rows:
+        if r["count"] >= min_count and r["city"] != OTHER:
+            kept[(r["date"], r["city"], r["disease"], r["zone"])] = r["count"]
+        elif merge or r["city"] == OTHER:
+            small[(r["date"], OTHER, r["disease"], r["zone"])] += r["count"]
+    for key, n in small.items():
+        if n >= min_count:
+            kept[key] = n
+    return [
+        {"date": day, "city": city, "disease": disease, "zone": zone, "count": n}
+        for (day, city, disease, zone), n in sorted(kept.items())
+    ]
+
+
+def record_day(cur, city: Optional[str], disease: str, zone: str) -> None:
+    cur.execute("""
+        INSERT INTO epi_daily_counts(day, city_bucket, disease, zone, count)
+        VALUES (CURRENT_DATE, %s, %s, %s, 1)
+        ON CONFLICT (day, city_bucket, disease, zone) DO UPDATE
+        SET count = epi_daily_counts.count + 1
+    """, (city_bucket(city), disease or "Nothing", zone))
+
+
+def query_counts(
+    cur,
+    date_from: datetime.date,
+    date_to: datetime.date,
+    disease: Optional[str] = None,
+    city: Optional[str] = None,
+    zone: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    conditions = ["day BETWEEN %s AND %s"]
+    params: List[Any] = [date_from, date_to]
+    if disease:
+        conditions.append("disease = %s")
+        params.append(disease)
+    if city:
+        conditions.append("city_bucket = %s")
+        params.append(city_bucket(city))
+    if zone:
+        conditions.append("zone = %s")
+        params.append(zone)
+    cur.execute(f"""
+        SELECT day, city_bucket, disease, zone, count
+        FROM epi_daily_counts
+        WHERE {" AND ".join(conditions)}
+        ORDER BY day, city_bucket, disease, zone
+    """, params)
+    # Filtered to one city there is nothing to merge small cells with
+    return suppress_small_cells([
+        {"date": str(r[0]), "city": r[1], "disease": r[2], "zone": r[3], "count": r[4]}
+        for r in cur.fetchall()
+    ], merge=not city)
+
+
+def rebucket(cur) -> int:
+    """Move rows whose city_bucket isn't one of BUCKETS (written before the
+    allow-list, or for archived months) onto city_bucket(). Returns buckets moved."""
+    cur.execute("SELECT DISTINCT city_bucket FROM epi_daily_counts")
+    moves = [(old, city_bucket(old)) for (old,) in cur.fetchall() if old not in BUCKETS]
+    for old, new in moves:
+        cur.execute("""
+            INSERT INTO epi_daily_counts(day, city_bucket, disease, zone, count)
+            SELECT day, %s, disease, zone, SUM(count)
+            FROM epi_daily_counts
+            WHERE city_bucket = %s
+            GROUP BY day, disease, zone
+            ON CONFLICT (day, city_bucket, disease, zone) DO UPDATE
+            SET count = epi_daily_counts.count + EXCLUDED.count
+        """, (new, old))
+        cur.execute("DELETE FROM epi_daily_counts WHERE city_bucket = %s", (old,))
+    return len(moves)
+
+
+def rebuild(conn, classify: Callable[[Optional[str], float], Tuple[str, str]], decrypt: Callable) -> int:
+    """Recount every retained day from diary_days; rows for archived months
+    are kept, moved onto the city buckets. `classify` maps the stored
+    (disease_predict, score) to (disease, zone)."""
+    rebucket(conn.cursor())
+    since = partitions.retained_since(conn.cursor())
+    if since is None:
+        conn.commit()
+        return 0
+    counts: Counter = Counter()
+    with conn.cursor(name="epi_rebuild") as src:
+        src.itersize = 5000
+        src.execute("""
+            SELECT d.created_at::date, p.city, d.disease_predict, d.score
+            FROM diary_days d
+            JOIN patients p ON p.patient_id = d.patient_id
+            WHERE d.created_at >= %s
+        """, (since,))
+        for day, city, predict, score in src:
+            disease, zone = classify(decrypt(predict), score or 0.0)
+            counts[(day, city_bucket(decrypt(city)), disease or "Nothing", zone)] += 1
+
+    cur = conn.cursor()
+    cur.execute("DELETE FROM epi_daily_counts WHERE day >= %s", (since,))
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO epi_daily_counts(day, city_bucket, disease, zone, count) VALUES %s
+    """, [(*key, n) for key, n in counts.items()], page_size=1000)
+    conn.commit()
+    return len(counts)
+
+
+if __name__ == "__main__":
+    from importlib import import_module
+
+    parser = argparse.ArgumentParser(description="Maintain epi_daily_counts")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="recount rollups from diary_days")
+    parser.parse_args()
+
+    app_module = import_module("backend TMS")
+
+    def classify(predict, score):
+        disease = app_module.primary_disease(predict)
+        return disease, app_module.classify_zone(disease, score)
+
+    conn = app_module.connect()
+    try:
+        print(f"{rebuild(conn, classify, app_module.decrypt_field)} rollup rows written")
+    finally:
+        conn.close()
@@ -0,0 +1,240 @@
+"""
+Cached LLM explanations of a diagnosis (patient text + doctor reasoning).
+
+Explanations depend only on what the model saw: the scoring model version,
+the top-3 diseases, a quantized symptom vector (absent / present / severe)
+and the language. The prompt is built from exactly those inputs, never from
+the patient's own words or lab data, so one generated pair can be served to
+every presentation that maps to the same key.
+
+Lookups go in-process LRU (CACHE_SIZE entries) → explanation_cache table →
+generation. Generation is single-flight per key and limited to CONCURRENCY
+calls per worker; failures are not cached.
+
+Drop rows unused for TTL_DAYS:  python explanations.py gc
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+import metrics
+import singleflight
+from crypto_utils import encrypt_field, decrypt_field
+from db import connect
+
+CACHE_SIZE = int(os.environ.get("EXPLANATION_CACHE_SIZE", "2000"))
+CONCURRENCY = int(os.environ.get("EXPLANATION_CONCURRENCY", "4"))
+TTL_DAYS = int(os.environ.get("EXPLANATION_CACHE_TTL_DAYS", "90"))
+LLM_MODEL = os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
+TIMEOUT_SECONDS = 60
+# Bump when the prompts change so old texts stop matching
+PROMPT_VERSION = 1
+
+LANG_NAMES = {"ru": "Russian", "en": "English", "kk": "Kazakh"}
+SEVERITY = {1: "present (mild to moderate)", 2: "severe"}
+
+PATIENT_PROMPT = """
+You are a medical AI assistant. The ML system made a preliminary diagnosis from a patient's symptoms.
+Write a SHORT explanation in {lang} for the PATIENT — why this diagnosis was suggested.
+
+RULES:
+1. 2-4 sentences in {lang}, simple patient-friendly language
+2. Explain which symptoms led to this diagnosis
+3. Do NOT scare the patient, be calm and professional
+4. Mention that this is a preliminary assessment and a doctor's consultation is needed
+5. Plain text only, no JSON, ENTIRELY in {lang}
+"""
+
+DOCTOR_PROMPT = """
+You are a clinical decision support system providing detailed analysis for a DOCTOR.
+The ML model made a preliminary diagnosis from patient-reported symptoms.
+Write a thorough clinical reasoning explanation in {lang} with these sections:
+
+1. **Clinical reasoning**: which symptoms and combinations point to the diagnosis, and their weight.
+2. **Differential diagnosis**: the other top conditions and why they are more or less likely.
+3. **Key symptoms**: decisive vs supportive symptoms; name any red flags.
+4. **Recommended tests**: what to order to confirm or exclude the diagnosis.
+5. **Points of attention**: possible complications, what to monitor.
+
+RULES:
+- Write in {lang}; medical terminology is fine
+- 8-15 sentences, markdown (**bold** headers, bullet lists)
+- State clearly that this is an AI assistant, not a replacement for clinical judgment
+- Do NOT output JSON
+"""
+
+_lru: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+_flight = singleflight.SingleFlight("explanations")
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def model_version(model: Dict[str, Any]) -> str:
+    """Fingerprint of the scoring model's weights."""
+    return hashlib.sha256(json.dumps(model, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def quantize(symptoms: Sequence[int]) -> Tuple[int, ...]:
+    """0 → 0 (absent), 1-2 → 1 (present), 3 → 2 (severe)."""
+    return tuple(0 if v <= 0 else 2 if v >= 3 else 1 for v in symptoms)
+
+
+def cache_key(version: str, top3: Sequence[str], qvec: Sequence[int], lang: str) -> str:
+    raw = json.dumps([PROMPT_VERSION, LLM_MODEL, version, list(top3), list(qvec), lang])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _remember(key: str, value: Tuple[str, str]) -> None:
+    _lru[key] = value
+    _lru.move_to_end(key)
+    while len(_lru) > CACHE_SIZE:
+        _lru.popitem(last=False)
+
+
+def lookup(key: str) -> Optional[Tuple[str, str]]:
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE explanation_cache SET last_used_at = NOW()
+            WHERE cache_key = %s
+            RETURNING patient_explanation, doctor_explanation
+        """, (key,))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return (decrypt_field(row[0]), decrypt_field(row[1])) if row else None
+
+
+def store(key: str, version: str, lang: str, value: Tuple[str, str]) -> None:
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO explanation_cache(cache_key, model_version, lang, patient_explanation, doctor_explanation)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO NOTHING
+        """, (key, version, lang, encrypt_field(value[0]), encrypt_field(value[1])))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def gc(cur) -> int:
+    cur.execute(
+        "DELETE FROM explanation_cache WHERE last_used_at < NOW() - make_interval(days => %s)",
+        (TTL_DAYS,),
+    )
+    return cur.rowcount
+
+
+def context_message(top3: Sequence[Tuple[str, str]], qvec: Sequence[int], symptom_codes: Sequence[str]) -> str:
+    symptoms = [f"{code}: {SEVERITY[q]}" for code, q in zip(symptom_codes, qvec) if q]
+    ranked = [f"{i + 1}. {label} ({name})" for i, (name, label) in enumerate(top3)]
+    return (
+        "Reported symptoms:\n" + "\n".join(f"- {s}" for s in symptoms)
+        + f"\nMain ML model diagnosis: {top3[0][1]} ({top3[0][0]})"
+        + "\nTop 3 probable conditions, most likely first:\n" + "\n".join(ranked)
+    )
+
+
+async def _complete(client, api_key: str, system: str, user: str, max_tokens: int) -> str:
+    from symptom_extraction import LLM_API_BASE
+
+    resp = await client.post(
+        f"{LLM_API_BASE}/chat/completions",
+        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        json={
+            "model": LLM_MODEL,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            "temperature": 0.3,
+            "max_tokens": max_tokens,
+        },
+    )
+    resp.raise_for_status()
+    content = resp.json().get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+    if not content:
+        raise ValueError("empty completion")
+    return content
+
+
+async def generate(top3: Sequence[Tuple[str, str]], qvec: Sequence[int], symptom_codes: Sequence[str],
+                   lang: str) -> Tuple[str, str]:
+    import httpx
+
+    api_key = os.environ.get("GROQ_API_KEY", "")
+    if not api_key:
+        raise HTTPException(status_code=503, detail="Explanation service not configured")
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    user = context_message(top3, qvec, symptom_codes)
+    lang_name = LANG_NAMES[lang]
+    async with _semaphore:
+        metrics.inc("explanations.generated")
+        try:
+            async with httpx.AsyncClient(timeout=TIMEOUT_SECONDS) as client:
+                return tuple(await asyncio.gather(
+                    _complete(client, api_key, PATIENT_PROMPT.format(lang=lang_name), user, 300),
+                    _complete(client, api_key, DOCTOR_PROMPT.format(lang=lang_name), user, 1500),
+                ))
+        except (httpx.HTTPError, ValueError, KeyError, IndexError):
+            metrics.inc("explanations.failed")
+            raise HTTPException(status_code=502, detail="AI service unavailable")
+
+
+async def _load_or_generate(key: str, version: str, top3: Sequence[Tuple[str, str]], qvec: Sequence[int],
+                            symptom_codes: Sequence[str], lang: str) -> Tuple[Tuple[str, str], str]:
+    stored = await run_in_threadpool(lookup, key)
+    if stored is not None:
+        metrics.inc("explanations.hit_db")
+        _remember(key, stored)
+        return stored, "db"
+    value = await generate(top3, qvec, symptom_codes, lang)
+    await run_in_threadpool(store, key, version, lang, value)
+    _remember(key, value)
+    return value, "generated"
+
+
+async def explain(version: str, top3: Sequence[Tuple[str, str]], symptoms: Sequence[int],
+                  symptom_codes: Sequence[str], lang: str) -> Dict[str, Any]:
+    """top3 is [(disease name, display label), ...], most likely first."""
+    qvec = quantize(symptoms)
+    key = cache_key(version, [name for name, _ in top3], qvec, lang)
+    hit = _lru.get(key)
+    if hit is not None:
+        _lru.move_to_end(key)
+        metrics.inc("explanations.hit_memory")
+        value, source = hit, "memory"
+    else:
+        value, source = await _flight.do(key, _load_or_generate, key, version, top3, qvec, symptom_codes, lang)
+    metrics.set_gauge("explanations.lru_size", len(_lru))
+    return {"patient_explanation": value[0], "doctor_explanation": value[1], "source": source}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain explanation_cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("gc", help=f"delete explanations unused for {TTL_DAYS} days")
+    parser.parse_args()
+
+    conn = connect()
+    try:
+        deleted = gc(conn.cursor())
+        conn.commit()
+        print(f"{deleted} cached explanations deleted")
+    finally:
+        conn.close()
@@ -0,0 +1,197 @@
+"""
+Idempotency-Key support for non-idempotent POSTs (/analys, /upload_lab_result).
+
+The first request with a key claims (scope, endpoint, key) with a pending row,
+runs, and stores its response encrypted for TTL_HOURS. A retry with the same
+key gets that response replayed (Idempotent-Replayed: true) without inserting
+or calling the vision model again. A duplicate that arrives while the first is
+still running polls until it completes. A pending claim older than
+LOCK_SECONDS is treated as abandoned (worker died) and taken over. If the
+handler raises, the claim is released so the client can retry.
+
+A key reused with a different payload is rejected with 422; a duplicate that
+outwaits LOCK_SECONDS gets 409.
+
+Expired keys are deleted in batches: opportunistically from the claim path
+at most every GC_INTERVAL_SECONDS per worker, and by  python idempotency.py gc
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+
+import metrics
+from crypto_utils import encrypt_field, decrypt_field
+from db import connect
+
+TTL_HOURS = int(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24"))
+LOCK_SECONDS = int(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", "120"))
+GC_INTERVAL_SECONDS = 3600
+GC_BATCH = 5000
+POLL_SECONDS = 0.25
+MAX_KEY_LENGTH = 255
+
+HEADER = "Idempotency-Key"
+REPLAY_HEADER = "Idempotent-Replayed"
+
+_last_gc = 0.0
+
+
+def request_hash(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def gc(cur, batch: int = GC_BATCH) -> int:
+    """Delete one batch of expired keys. Returns the number deleted."""
+    cur.execute("""
+        DELETE FROM idempotency_keys
+        WHERE ctid IN (
+            SELECT ctid FROM idempotency_keys WHERE expires_at < NOW() LIMIT %s
+        )
+    """, (batch,))
+    return cur.rowcount
+
+
+def claim(scope: str, endpoint: str, key: str, req_hash: str) -> Tuple[str, Optional[Any]]:
+    """One of ("run", None), ("replay", response), ("wait", None), ("mismatch", None)."""
+    global _last_gc
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        if time.monotonic() - _last_gc > GC_INTERVAL_SECONDS:
+            _last_gc = time.monotonic()
+            metrics.inc("idempotency.gc_deleted", gc(cur))
+        cur.execute("""
+            INSERT INTO idempotency_keys(scope, endpoint, idem_key, request_hash, expires_at)
+            VALUES (%s, %s, %s, %s, NOW() + make_interval(hours => %s))
+            ON CONFLICT (scope, endpoint, idem_key) DO UPDATE
+            SET request_hash = EXCLUDED.request_hash,
+                status = 'pending',
+                response = NULL,
+                created_at = NOW(),
+                expires_at = EXCLUDED.expires_at
+            WHERE idempotency_keys.expires_at < NOW()
+               OR (idempotency_keys.status = 'pending'
+                   AND idempotency_keys.created_at < NOW() - make_interval(secs => %s))
+            RETURNING 1
+        """, (scope, endpoint, key, req_hash, TTL_HOURS, LOCK_SECONDS))
+        if cur.fetchone() is not None:
+            conn.commit()
+            return "run", None
+        cur.execute("""
+            SELECT status, request_hash, response
+            FROM idempotency_keys
+            WHERE scope = %s AND endpoint = %s AND idem_key = %s
+        """, (scope, endpoint, key))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    if row is None:
+        # Released or collected between the two statements; claim again
+        return "wait", None
+    if row[1] != req_hash:
+        return "mismatch", None
+    if row[0] == "done":
+        return "replay", json.loads(decrypt_field(row[2]))
+    return "wait", None
+
+
+def complete(scope: str, endpoint: str, key: str, response: Any) -> None:
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE idempotency_keys
+            SET status = 'done', response = %s
+            WHERE scope = %s AND endpoint = %s AND idem_key = %s
+        """, (encrypt_field(json.dumps(response, ensure_ascii=False, default=str)), scope, endpoint, key))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def release(scope: str, endpoint: str, key: str) -> None:
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM idempotency_keys
+            WHERE scope = %s AND endpoint = %s AND idem_key = %s AND status = 'pending'
+        """, (scope, endpoint, key))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def run(
+    key: Optional[str],
+    scope: str,
+    endpoint: str,
+    req_hash: str,
+    handler: Callable[[], Awaitable[Any]],
+) -> Any:
+    """Run `handler` at most once per key; without a key it just runs."""
+    if not key:
+        return await handler()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{HEADER} too long")
+
+    deadline = time.monotonic() + LOCK_SECONDS
+    waited = False
+    while True:
+        state, stored = await run_in_threadpool(claim, scope, endpoint, key, req_hash)
+        if state == "run":
+            break
+        if state == "replay":
+            metrics.inc(f"idempotency.{endpoint}.replayed")
+            return ORJSONResponse(stored, headers={REPLAY_HEADER: "true"})
+        if state == "mismatch":
+            raise HTTPException(status_code=422, detail=f"{HEADER} was already used for a different request")
+        if time.monotonic() > deadline:
+            raise HTTPException(status_code=409, detail=f"A request with this {HEADER} is still in progress")
+        if not waited:
+            waited = True
+            metrics.inc(f"idempotency.{endpoint}.waited")
+        await asyncio.sleep(POLL_SECONDS)
+
+    metrics.inc(f"idempotency.{endpoint}.executed")
+    try:
+        response = await handler()
+    except Exception:
+        await run_in_threadpool(release, scope, endpoint, key)
+        raise
+    await run_in_threadpool(complete, scope, endpoint, key, response)
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain idempotency_keys")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("gc", help="delete expired idempotency keys")
+    parser.parse_args()
+
+    conn = connect()
+    try:
+        total = 0
+        while True:
+            deleted = gc(conn.cursor())
+            conn.commit()
+            total += deleted
+            if deleted < GC_BATCH:
+                break
+        print(f"{total} expired keys deleted")
+    finally:
+        conn.close()
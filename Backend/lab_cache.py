@@ -0,0 +1,153 @@
+"""
+Deduplication cache for lab-image OCR results.
+
+Re-uploads of the same photo by the same patient within LAB_OCR_CACHE_WINDOW_HOURS
+skip the PII blur, the vision-model call and the lab_results insert. Entries are
+keyed by the SHA-256 of the uploaded bytes. Parsed fields are stored encrypted.
+
+Optionally (LAB_OCR_CACHE_PHASH_DISTANCE >= 0, Pillow installed) a 64-bit
+difference hash also finds re-encoded / resized copies. Two photos of the same
+form with different values hash alike, so a perceptual candidate is only used
+after same_content() has compared its stored image with the upload pixel by
+pixel. Off by default.
+"""
+
+import hashlib
+import io
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from crypto_utils import encrypt_field, decrypt_field
+import metrics
+
+try:
+    from PIL import Image, ImageChops
+    HAS_PILLOW = True
+except ImportError:
+    HAS_PILLOW = False
+
+WINDOW_HOURS = int(os.environ.get("LAB_OCR_CACHE_WINDOW_HOURS", "24"))
+# Max Hamming distance between perceptual hashes; negative disables the perceptual match
+PHASH_MAX_DISTANCE = int(os.environ.get("LAB_OCR_CACHE_PHASH_DISTANCE", "-1"))
+# Pixel comparison of a perceptual candidate: images scaled to COMPARE_WIDTH,
+# every BLOCK×BLOCK block within MAX_BLOCK_DIFF grey levels on average
+COMPARE_WIDTH = 512
+BLOCK = 8
+MAX_BLOCK_DIFF = 8
+MAX_CANDIDATES = 3
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data: bytes) -> Optional[int]:
+    """dHash: 9×8 grayscale thumbnail, one bit per horizontal gradient.
+    Returned as a signed 64-bit int to fit a BIGINT column."""
+    if not HAS_PILLOW or PHASH_MAX_DISTANCE < 0:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data)).convert("L").resize((9, 8))
+    except Exception:
+        return None
+    px = list(img.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits - (1 << 64) if bits >= (1 << 63) else bits
+
+
+def _distance(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def same_content(a: bytes, b: bytes) -> bool:
+    """True when two images show the same thing down to small print: a changed
+    value on the same form differs in a few blocks, re-encoding noise in none."""
+    if not HAS_PILLOW:
+        return False
+    try:
+        img_a = Image.open(io.BytesIO(a)).convert("L")
+        img_b = Image.open(io.BytesIO(b)).convert("L")
+    except Exception:
+        return False
+    (wa, ha), (wb, hb) = img_a.size, img_b.size
+    if abs(ha / wa - hb / wb) > 0.02:
+        return False
+    size = (COMPARE_WIDTH, max(BLOCK, round(COMPARE_WIDTH * ha / wa)))
+    diff = ImageChops.difference(img_a.resize(size), img_b.resize(size)).reduce(BLOCK)
+    return max(diff.getdata()) <= MAX_BLOCK_DIFF
+
+
+def lookup(cur, patient_id: int, chash: str, phash: Optional[int],
+           confirm: Optional[Callable[[str], bool]] = None) -> Optional[Dict[str, Any]]:
+    """One query: the exact match sorts first, recent entries follow for the
+    perceptual check. `confirm(image_hash)` must accept a perceptual candidate
+    (see same_content) before it is reused; without it only exact matches hit."""
+    cur.execute("""
+        SELECT c.result_id, c.content_hash, c.phash, c.test_type, c.test_date, c.results_json,
+               c.interpretation, r.image_hash
+        FROM lab_ocr_cache c
+        LEFT JOIN lab_results r ON r.result_id = c.result_id
+        WHERE c.patient_id = %s AND c.created_at > NOW() - make_interval(hours => %s)
+        ORDER BY (c.content_hash = %s) DESC, c.created_at DESC
+        LIMIT 20
+    """, (patient_id, WINDOW_HOURS, chash))
+    rows = cur.fetchall()
+
+    hit = None
+    kind = None
+    if rows and rows[0][1] == chash:
+        hit, kind = rows[0], "exact"
+    elif phash is not None and confirm is not None:
+        candidates = [r for r in rows
+                      if r[2] is not None and r[7] and _distance(r[2], phash) <= PHASH_MAX_DISTANCE]
+        for r in candidates[:MAX_CANDIDATES]:
+            if confirm(r[7]):
+                hit, kind = r, "perceptual"
+                break
+            metrics.inc("lab_ocr_cache.perceptual_rejected")
+
+    if hit is None:
+        metrics.inc("lab_ocr_cache.miss")
+        return None
+    metrics.inc(f"lab_ocr_cache.hit_{kind}")
+    try:
+        results = json.loads(decrypt_field(hit[5]) or "[]")
+    except json.JSONDecodeError:
+        results = []
+    return {
+        "result_id": hit[0],
+        "test_type": decrypt_field(hit[3]),
+        "test_date": hit[4],
+        "results": results,
+        "interpretation": decrypt_field(hit[6]),
+    }
+
+
+def store(cur, patient_id: int, chash: str, phash: Optional[int], result_id: int,
+          test_type: str, test_date: str, results: List[Any], interpretation: str) -> None:
+    cur.execute("""
+        DELETE FROM lab_ocr_cache
+        WHERE patient_id = %s AND created_at <= NOW() - make_interval(hours => %s)
+    """, (patient_id, WINDOW_HOURS))
+    cur.execute("""
+        INSERT INTO lab_ocr_cache(patient_id, content_hash, phash, result_id, test_type, test_date, results_json, interpretation)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, (
+        patient_id, chash, phash, result_id,
+        encrypt_field(test_type), test_date,
+        encrypt_field(json.dumps(results, ensure_ascii=False)), encrypt_field(interpretation),
+    ))
+
+
+def stats() -> Dict[str, Any]:
+    hits = metrics.get("lab_ocr_cache.hit_exact") + metrics.get("lab_ocr_cache.hit_perceptual")
+    misses = metrics.get("lab_ocr_cache.miss")
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+    }
@@ -0,0 +1,216 @@
+"""
+Normalised lab-marker rows extracted from lab_results.results_json.
+
+Each panel item becomes one lab_markers row (result, marker code, value, unit,
+status, date) written in the same transaction as the panel. Marker code, unit,
+status and date stay plaintext so (patient_id, marker_code, taken_on) can be
+indexed; only the measured value is encrypted. Trend queries read just the rows
+of one marker instead of decrypting and parsing every panel blob.
+
+Backfill existing panels:  python lab_markers.py backfill [--rebuild]
+"""
+
+import argparse
+import datetime
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+import psycopg2.extras
+
+from crypto_utils import encrypt_field, decrypt_field
+
+# code → aliases, first match wins, so more specific markers come first ("Mean
+# corpuscular hemoglobin" is MCH, not HGB). An alias starts at a word boundary
+# and must end at one too; a trailing "*" lets it run on to the end of the word,
+# for stems that cover inflected forms.
+MARKER_ALIASES = [
+    ("HBA1C", ["hba1c", "hb a1c", "a1c", "гликированн*", "гликозилированн*", "glycated*", "glycosylated*"]),
+    ("MCHC", ["mchc", "средняя концентрация гемоглобин*", "mean corpuscular hemoglobin concentration",
+              "mean cell hemoglobin concentration"]),
+    ("MCH", ["mch", "среднее содержание гемоглобин*", "mean corpuscular hemoglobin", "mean cell hemoglobin"]),
+    ("MCV", ["mcv", "средний объем эритроцит*", "mean corpuscular volume", "mean cell volume"]),
+    ("MPV", ["mpv", "средний объем тромбоцит*", "mean platelet volume"]),
+    ("WBC", ["лейкоцит*", "wbc", "white blood*", "белые кровяные"]),
+    ("ESR", ["соэ", "esr", "скорость оседания"]),
+    ("CRP", ["срб", "crp", "c-реактивный", "c реактивный", "с-реактивный", "с реактивный"]),
+    ("GLU", ["глюкоз*", "glucose", "сахар крови", "blood sugar"]),
+    ("HGB", ["гемоглоб*", "hemoglobin", "haemoglobin", "hgb", "hb"]),
+    ("PLT", ["тромбоцит*", "platelet*", "plt"]),
+    ("EOS", ["эозинофил*", "eosinophil*"]),
+    ("IGE", ["иге", "ige", "immunoglobulin e"]),
+    ("PCT", ["прокальцитонин*", "procalcitonin", "pct"]),
+    ("KET", ["кетон*", "ketone*", "ацетон*"]),
+    ("K", ["калий", "калия", "potassium", "k+"]),
+    ("CHOL", ["холестерин*", "cholesterol"]),
+    ("BIL", ["билируб*", "bilirubin"]),
+    ("RBC", ["эритроцит*", "rbc", "red blood*"]),
+    ("HCT", ["гематокрит*", "hematocrit", "hct"]),
+    ("NEUT", ["нейтрофил*", "neutrophil*"]),
+    ("LYMPH", ["лимфоцит*", "lymphocyte*"]),
+    ("MONO", ["моноцит*", "monocyte*"]),
+]
+
+# Urinalysis: "Глюкоза в моче" must not trend together with blood glucose. A
+# panel titled "Общий анализ мочи" prints bare names ("Глюкоза"), so the panel
+# title counts as well as the item name.
+URINE_WORDS = ["моч*", "urine", "urinalysis", "оам"]
+URINE_MARKER_ALIASES = [
+    ("U_GLU", ["глюкоз*", "glucose", "сахар*"]),
+    ("U_PRO", ["белок", "белка", "protein*"]),
+    ("U_KET", ["кетон*", "ketone*", "ацетон*"]),
+    ("U_WBC", ["лейкоцит*", "leukocyte*", "wbc"]),
+    ("U_RBC", ["эритроцит*", "erythrocyte*", "rbc", "кровь", "blood"]),
+    ("U_SG", ["удельный вес", "относительная плотность", "плотность", "specific gravity"]),
+    ("U_PH", ["ph", "рн", "реакция"]),
+    ("U_BIL", ["билируб*", "bilirubin"]),
+    ("U_UBG", ["уробилиноген*", "urobilinogen"]),
+    ("U_NIT", ["нитрит*", "nitrite*"]),
+]
+
+
+def _alias_re(aliases: List[str]) -> "re.Pattern[str]":
+    parts = [re.escape(a.rstrip("*")) + (r"\w*" if a.endswith("*") else "") for a in aliases]
+    return re.compile(r"(?<!\w)(?:" + "|".join(parts) + r")(?!\w)")
+
+
+_MARKERS = [(code, _alias_re(aliases)) for code, aliases in MARKER_ALIASES]
+_URINE_MARKERS = [(code, _alias_re(aliases)) for code, aliases in URINE_MARKER_ALIASES]
+_URINE_RE = _alias_re(URINE_WORDS)
+
+_NUMBER_RE = re.compile(r"-?\d+(?:[.,]\d+)?")
+
+
+def _normalize(text: Optional[str]) -> str:
+    return re.sub(r"\s+", " ", (text or "").casefold().replace("ё", "е")).strip()
+
+
+def is_urine_panel(test_type: Optional[str]) -> bool:
+    return bool(_URINE_RE.search(_normalize(test_type)))
+
+
+def marker_code(name: str, test_type: Optional[str] = None) -> str:
+    """Canonical code for a printed marker name, read as a urine analyte when
+    the name or the panel title `test_type` says urine; unknown markers keep
+    their normalised name."""
+    normalized = _normalize(name)
+    if normalized.startswith("x:"):
+        return f"X:{normalized[2:66]}"
+    urine = bool(_URINE_RE.search(normalized)) or is_urine_panel(test_type)
+    for code, _ in MARKER_ALIASES + URINE_MARKER_ALIASES:
+        if normalized == code.casefold():
+            if urine and not code.startswith("U_") and any(u == f"U_{code}" for u, _ in URINE_MARKER_ALIASES):
+                return f"U_{code}"
+            return code
+    markers = _URINE_MARKERS if urine else _MARKERS
+    for code, pattern in markers:
+        if pattern.search(normalized):
+            return code
+    return f"X:{normalized[:64]}"
+
+
+def parse_value(raw: Optional[str]) -> Optional[float]:
+    m = _NUMBER_RE.search(raw or "")
+    return float(m.group().replace(",", ".")) if m else None
+
+
+def parse_test_date(test_date: Optional[str]) -> Optional[datetime.date]:
+    try:
+        return datetime.date.fromisoformat((test_date or "").strip()[:10])
+    except ValueError:
+        return None
+
+
+def insert_markers(cur, result_id: int, patient_id: int, test_type: Optional[str], test_date: Optional[str],
+                   results: List[Dict[str, Any]], fallback_date: Optional[datetime.date] = None) -> None:
+    rows = []
+    taken_on = parse_test_date(test_date) or fallback_date
+    for item in results:
+        if not isinstance(item, dict) or not item.get("name"):
+            continue
+        rows.append((
+            result_id,
+            patient_id,
+            marker_code(str(item["name"]), test_type),
+            taken_on,
+            encrypt_field(str(item.get("value", ""))),
+            str(item.get("unit", ""))[:32],
+            str(item.get("status", ""))[:16],
+        ))
+    if not rows:
+        return
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO lab_markers(result_id, patient_id, marker_code, taken_on, value, unit, status)
+        VALUES %s
+    """, rows, template="(%s, %s, %s, COALESCE(%s, CURRENT_DATE), %s, %s, %s)")
+
+
+def marker_trend(cur, patient_id: int, code: str, since: Optional[datetime.date] = None,
+                 limit: int = 500) -> List[Dict[str, Any]]:
+    cur.execute("""
+        SELECT result_id, taken_on, value, unit, status
+        FROM lab_markers
+        WHERE patient_id = %s AND marker_code = %s AND taken_on >= %s
+        ORDER BY taken_on, marker_id
+        LIMIT %s
+    """, (patient_id, code, since or datetime.date.min, limit))
+    points = []
+    for r in cur.fetchall():
+        raw = decrypt_field(r[2])
+        points.append({
+            "result_id": r[0],
+            "date": str(r[1]),
+            "value": parse_value(raw),
+            "raw": raw,
+            "unit": r[3],
+            "status": r[4],
+        })
+    return points
+
+
+def backfill(conn, batch_size: int = 500, rebuild: bool = False) -> int:
+    """Populate lab_markers for panels that have no marker rows yet, or with
+    `rebuild` re-extract every panel (after marker_code changes, e.g. panels
+    whose urine items were coded as blood markers). Returns panels processed."""
+    done = 0
+    last_id = 0
+    missing_only = "" if rebuild else "AND NOT EXISTS (SELECT 1 FROM lab_markers m WHERE m.result_id = r.result_id)"
+    while True:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT r.result_id, r.patient_id, r.test_type, r.test_date, r.results_json, r.created_at::date
+            FROM lab_results r
+            WHERE r.result_id > %s {missing_only}
+            ORDER BY r.result_id
+            LIMIT %s
+        """, (last_id, batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            return done
+        if rebuild:
+            cur.execute("DELETE FROM lab_markers WHERE result_id = ANY(%s)", ([r[0] for r in rows],))
+        for result_id, patient_id, test_type, test_date, blob, created_on in rows:
+            try:
+                items = json.loads(decrypt_field(blob) or "[]")
+            except json.JSONDecodeError:
+                items = []
+            insert_markers(cur, result_id, patient_id, test_type, test_date, items, created_on)
+        conn.commit()
+        done += len(rows)
+        last_id = rows[-1][0]
+
+
+if __name__ == "__main__":
+    from db import connect
+
+    parser = argparse.ArgumentParser(description="Maintain lab_markers")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bf = sub.add_parser("backfill", help="extract markers from existing lab_results blobs")
+    bf.add_argument("--rebuild", action="store_true", help="re-extract panels that already have markers")
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        print(f"{backfill(conn, rebuild=args.rebuild)} lab panels processed")
+    finally:
+        conn.close()
@@ -0,0 +1,113 @@
+"""
+Stub of the OpenAI-compatible chat-completions API used by the backend
+(lab vision OCR and symptom-extraction fallback), for offline load tests.
+
+Requests with an image part get a lab panel, text-only requests a symptom map.
+Latency and failures are configurable so the backend's timeouts, 502 paths
+and connection handling can be exercised without calling a real provider.
+
+    python loadtest/stub_llm.py [--port 8090] [--latency-ms 800] [--jitter-ms 300] \
+        [--error-rate 0.02] [--rate-limit-rate 0.01]
+
+Point the backend at it with LLM_API_BASE=http://127.0.0.1:8090/v1 and any
+non-empty GROQ_API_KEY.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="LLM stub")
+config = {"latency_ms": 800.0, "jitter_ms": 300.0, "error_rate": 0.0, "rate_limit_rate": 0.0}
+stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+MARKERS = [
+    ("Гемоглобин", "г/л", "120-160", 100, 170),
+    ("Лейкоциты", "10^9/л", "4.0-9.0", 3.0, 15.0),
+    ("СОЭ", "мм/ч", "2-15", 2, 40),
+    ("Тромбоциты", "10^9/л", "180-320", 150, 400),
+    ("Глюкоза", "ммоль/л", "3.3-5.5", 3.0, 9.0),
+]
+SYMPTOMS = ["FEVER", "COUGH", "HEADACHE", "SORE_THROAT", "RUNNY_NOSE", "VOMITING", "DIARRHEA", "RASH"]
+
+
+def lab_panel(rnd: random.Random) -> dict:
+    results = []
+    for name, unit, ref, lo, hi in rnd.sample(MARKERS, rnd.randint(3, len(MARKERS))):
+        value = round(rnd.uniform(lo, hi), 1)
+        ref_lo, ref_hi = (float(x) for x in ref.split("-"))
+        status = "low" if value < ref_lo else "high" if value > ref_hi else "normal"
+        results.append({"name": name, "value": str(value), "unit": unit, "reference_range": ref, "status": status})
+    return {
+        "test_type": "Общий анализ крови",
+        "test_date": time.strftime("%Y-%m-%d"),
+        "interpretation": "Синтетический результат нагрузочного теста",
+        "results": results,
+    }
+
+
+def has_image(messages: list) -> bool:
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            return True
+    return False
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    delay = max(0.0, random.gauss(config["latency_ms"], config["jitter_ms"])) / 1000
+    await asyncio.sleep(delay)
+
+    roll = random.random()
+    if roll < config["rate_limit_rate"]:
+        stats["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "rate limit (stub)"}}, status_code=429)
+    if roll < config["rate_limit_rate"] + config["error_rate"]:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "upstream error (stub)"}}, status_code=500)
+
+    rnd = random.Random()
+    if has_image(body.get("messages", [])):
+        content = lab_panel(rnd)
+    else:
+        content = {code: rnd.randint(1, 3) for code in rnd.sample(SYMPTOMS, rnd.randint(1, 3))}
+    return {
+        "id": f"stub-{stats['requests']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": json.dumps(content, ensure_ascii=False)},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return {**stats, **config}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible chat-completions stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=800.0)
+    parser.add_argument("--jitter-ms", type=float, default=300.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    args = parser.parse_args()
+    config.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                  error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
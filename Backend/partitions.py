@@ -0,0 +1,331 @@
+"""
+Monthly range partitioning and archival for diary_days / diary_symptoms.
+
+Both tables are partitioned by created_at month; diary_symptoms carries its
+day's created_at so a symptom row always lands in the same month as its day and
+joins can be pruned on both sides. Indexes are declared on the parents and so
+exist per partition (local), which keeps index size and vacuum work bounded by
+one month of data. Partitions are created PARTITIONS_AHEAD months in advance
+at startup and by the `ensure` command (run it from cron). A DEFAULT partition
+takes rows outside every month so a missed `ensure` never fails an insert;
+when that month's partition is created later, its rows are moved out of the
+default first.
+
+Partitions older than ARCHIVE_AFTER_MONTHS are exported to gzip'd CSV under
+ARCHIVE_DIR, detached and dropped, and data versions are bumped for the
+patients they held. Aggregates in symptom_daily_stats and epi_daily_counts
+are kept: their rebuilds only recompute days from retained_since() on. To
+restore a month, recreate its partitions and COPY the files back, days before
+symptoms:
+  gunzip -c diary_days_2024_01.csv.gz | psql -c "COPY diary_days FROM STDIN CSV HEADER"
+
+Plain tables from an older install are converted by create_tables() at
+startup (or by hand:  python partitions.py migrate).
+Maintenance:  python partitions.py ensure | archive [--months N] [--dir PATH]
+"""
+
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import re
+from typing import List, Optional, Sequence, Tuple
+
+import versions
+
+logger = logging.getLogger("tms")
+
+PARTITIONS_AHEAD = int(os.environ.get("DIARY_PARTITIONS_AHEAD", "3"))
+ARCHIVE_AFTER_MONTHS = int(os.environ.get("DIARY_ARCHIVE_AFTER_MONTHS", "24"))
+ARCHIVE_DIR = os.environ.get("DIARY_ARCHIVE_DIR", "archive")
+
+# Referencing table first: its partitions must go before the days they point at
+TABLES = ("diary_symptoms", "diary_days")
+
+DDL = """
+CREATE TABLE IF NOT EXISTS diary_days (
+    day_id SERIAL,
+    patient_id INTEGER NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+    doctor_id INTEGER REFERENCES doctors(doctor_id) ON DELETE SET NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    disease_predict TEXT,
+    score REAL,
+    disease_setup TEXT,
+    recept TEXT,
+    patient_explanation TEXT,
+    doctor_explanation TEXT,
+    PRIMARY KEY(day_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS diary_symptoms (
+    day_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    symptom_code TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(day_id, symptom_code, created_at),
+    FOREIGN KEY(day_id, created_at) REFERENCES diary_days(day_id, created_at) ON DELETE CASCADE
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS diary_days_default PARTITION OF diary_days DEFAULT;
+CREATE TABLE IF NOT EXISTS diary_symptoms_default PARTITION OF diary_symptoms DEFAULT;
+"""
+
+INDEX_DDL = """
+CREATE INDEX IF NOT EXISTS idx_days_patient ON diary_days(patient_id, day_id);
+CREATE INDEX IF NOT EXISTS idx_days_doctor  ON diary_days(doctor_id, day_id);
+CREATE INDEX IF NOT EXISTS idx_sym_code     ON diary_symptoms(symptom_code);
+"""
+
+_PARTITION_RE = re.compile(r"^(diary_days|diary_symptoms)_(\d{4})_(\d{2})$")
+
+
+def _add_months(month: datetime.date, n: int) -> datetime.date:
+    y, m = divmod(month.month - 1 + n, 12)
+    return datetime.date(month.year + y, m + 1, 1)
+
+
+def _partition_name(table: str, month: datetime.date) -> str:
+    return f"{table}_{month:%Y_%m}"
+
+
+def _current_month(cur) -> datetime.date:
+    # DB clock, the same one DEFAULT NOW() uses
+    cur.execute("SELECT date_trunc('month', NOW())::date")
+    return cur.fetchone()[0]
+
+
+def is_partitioned(cur, table: str = "diary_days") -> bool:
+    cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+    return cur.fetchone() is not None
+
+
+def needs_migration(cur) -> bool:
+    """diary_days exists as a plain table from before partitioning."""
+    cur.execute("SELECT to_regclass('diary_days')")
+    return cur.fetchone()[0] is not None and not is_partitioned(cur)
+
+
+def retained_since(cur) -> Optional[datetime.date]:
+    """First day still held in the diary tables, None when they are empty.
+    Rollup rows before it describe archived months and must not be rebuilt."""
+    cur.execute("SELECT MIN(created_at)::date FROM diary_days")
+    return cur.fetchone()[0]
+
+
+def list_partitions(cur, table: str) -> List[Tuple[str, datetime.date]]:
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    out = []
+    for (name,) in cur.fetchall():
+        m = _PARTITION_RE.match(name)
+        if m and m.group(1) == table:
+            out.append((name, datetime.date(int(m.group(2)), int(m.group(3)), 1)))
+    return sorted(out, key=lambda p: p[1])
+
+
+def _exists(cur, name: str) -> bool:
+    cur.execute("SELECT to_regclass(%s)", (name,))
+    return cur.fetchone()[0] is not None
+
+
+def _in_range(table: str) -> str:
+    return f"FROM {table} WHERE created_at >= %s AND created_at < %s"
+
+
+def _has_rows(cur, table: str, bounds: Tuple[datetime.date, datetime.date]) -> bool:
+    cur.execute(f"SELECT EXISTS (SELECT 1 {_in_range(table)})", bounds)
+    return cur.fetchone()[0]
+
+
+def _stash_default_rows(cur, missing: List[str], month: datetime.date, end: datetime.date) -> List[str]:
+    """Move this month's rows out of the default partitions into temp tables
+    (PostgreSQL won't create a partition whose range the default still holds
+    rows for). Returns the tables to refill, days first."""
+    bounds = (month, end)
+    if "diary_days" in missing and _has_rows(cur, "diary_days_default", bounds):
+        # Deleting the days cascades to their symptoms wherever they live
+        cur.execute(f"CREATE TEMP TABLE _moved_diary_days AS SELECT * {_in_range('diary_days_default')}", bounds)
+        cur.execute(f"CREATE TEMP TABLE _moved_diary_symptoms AS SELECT * {_in_range('diary_symptoms')}", bounds)
+        cur.execute(f"DELETE {_in_range('diary_days_default')}", bounds)
+        return ["diary_days", "diary_symptoms"]
+    if "diary_symptoms" in missing and _has_rows(cur, "diary_symptoms_default", bounds):
+        cur.execute(f"CREATE TEMP TABLE _moved_diary_symptoms AS SELECT * {_in_range('diary_symptoms_default')}",
+                    bounds)
+        cur.execute(f"DELETE {_in_range('diary_symptoms_default')}", bounds)
+        return ["diary_symptoms"]
+    return []
+
+
+def _create_month(cur, month: datetime.date) -> int:
+    end = _add_months(month, 1)
+    missing = [t for t in reversed(TABLES) if not _exists(cur, _partition_name(t, month))]
+    if not missing:
+        return 0
+    moved = _stash_default_rows(cur, missing, month, end)
+    for table in missing:
+        cur.execute(
+            f"CREATE TABLE {_partition_name(table, month)} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+            (month, end),
+        )
+    for table in moved:
+        cur.execute(f"INSERT INTO {table} SELECT * FROM _moved_{table}")
+        logger.warning("Moved %d %s rows for %s out of the default partition", cur.rowcount, table, f"{month:%Y-%m}")
+        cur.execute(f"DROP TABLE _moved_{table}")
+    return len(missing)
+
+
+def ensure_partitions(cur, ahead: int = PARTITIONS_AHEAD, since: Optional[datetime.date] = None) -> int:
+    """Create monthly partitions from `since` (default: this month) to `ahead`
+    months from now. Returns the number of partitions created."""
+    if not is_partitioned(cur):
+        return 0
+    # Workers run this concurrently at startup
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('diary_partitions'))")
+    month = _current_month(cur)
+    start = since.replace(day=1) if since else month
+    last = _add_months(month, ahead)
+    created = 0
+    while start <= last:
+        created += _create_month(cur, start)
+        start = _add_months(start, 1)
+    return created
+
+
+def window_sql(columns: Sequence[str], date_from: Optional[datetime.date],
+               date_to: Optional[datetime.date]) -> Tuple[str, list]:
+    """`AND ...` bounds on each created_at column for an inclusive date window.
+    psycopg2 inlines the values, so partitions are pruned at plan time; bound
+    every joined partitioned table, pruning does not follow join equalities."""
+    clauses, params = [], []
+    for col in columns:
+        if date_from is not None:
+            clauses.append(f"{col} >= %s")
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append(f"{col} < %s")
+            params.append(date_to + datetime.timedelta(days=1))
+    return "".join(" AND " + c for c in clauses), params
+
+
+def migrate(conn) -> int:
+    """Rewrite plain diary tables into partitioned ones in one transaction.
+    Holds an exclusive lock for the duration of the copy. Returns the number of
+    diary days moved (0 if there was nothing to convert)."""
+    cur = conn.cursor()
+    if not needs_migration(cur):
+        return 0
+    # Every worker calls this at startup; the first one converts, the rest wait and find nothing to do
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('diary_partitions'))")
+    if not needs_migration(cur):
+        conn.commit()
+        return 0
+    cur.execute("LOCK TABLE diary_days, diary_symptoms IN ACCESS EXCLUSIVE MODE")
+    # A foreign key can't point at day_id alone once the key includes created_at
+    cur.execute("""
+        ALTER TABLE IF EXISTS lab_results DROP CONSTRAINT IF EXISTS lab_results_day_id_fkey;
+        DROP INDEX IF EXISTS idx_days_patient, idx_days_doctor, idx_sym_code;
+        ALTER TABLE diary_symptoms RENAME TO diary_symptoms_legacy;
+        ALTER TABLE diary_days RENAME TO diary_days_legacy;
+        ALTER TABLE diary_symptoms_legacy RENAME CONSTRAINT diary_symptoms_pkey TO diary_symptoms_legacy_pkey;
+        ALTER TABLE diary_days_legacy RENAME CONSTRAINT diary_days_pkey TO diary_days_legacy_pkey;
+        ALTER SEQUENCE diary_days_day_id_seq RENAME TO diary_days_legacy_day_id_seq;
+    """)
+    cur.execute(DDL)
+    cur.execute(INDEX_DDL)
+    cur.execute("SELECT date_trunc('month', MIN(created_at))::date FROM diary_days_legacy")
+    oldest = cur.fetchone()[0]
+    ensure_partitions(cur, since=oldest)
+
+    cur.execute("""
+        INSERT INTO diary_days(day_id, patient_id, doctor_id, created_at, disease_predict, score,
+                               disease_setup, recept, patient_explanation, doctor_explanation)
+        SELECT day_id, patient_id, doctor_id, COALESCE(created_at, NOW()), disease_predict, score,
+               disease_setup, recept, patient_explanation, doctor_explanation
+        FROM diary_days_legacy
+    """)
+    moved = cur.rowcount
+    cur.execute("""
+        INSERT INTO diary_symptoms(day_id, created_at, symptom_code, value)
+        SELECT s.day_id, d.created_at, s.symptom_code, s.value
+        FROM diary_symptoms_legacy s
+        JOIN diary_days d ON d.day_id = s.day_id
+    """)
+    cur.execute("""
+        SELECT setval(pg_get_serial_sequence('diary_days', 'day_id'), COALESCE(MAX(day_id), 0) + 1, false)
+        FROM diary_days
+    """)
+    cur.execute("DROP TABLE diary_symptoms_legacy, diary_days_legacy")
+    conn.commit()
+    return moved
+
+
+def archive(conn, months: int = ARCHIVE_AFTER_MONTHS, out_dir: str = ARCHIVE_DIR) -> List[str]:
+    """Export, detach and drop partitions whose whole month is older than
+    `months`. Each month is committed separately, together with the data
+    version bumps of the patients it held. Returns written paths."""
+    cur = conn.cursor()
+    if not is_partitioned(cur):
+        return []
+    cutoff = _add_months(_current_month(cur), -months)
+    by_month = {}
+    for table in TABLES:
+        for name, month in list_partitions(cur, table):
+            if _add_months(month, 1) <= cutoff:
+                by_month.setdefault(month, []).append((table, name))
+    conn.commit()
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for month in sorted(by_month):
+        parts = by_month[month]
+        for table, name in parts:
+            path = os.path.join(out_dir, f"{name}.csv.gz")
+            tmp = path + ".tmp"
+            with gzip.open(tmp, "wb") as f:
+                cur.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+            os.replace(tmp, path)
+            written.append(path)
+        # Cached history / triage ETags of these patients must stop matching
+        days = [name for table, name in parts if table == "diary_days"]
+        patient_ids = []
+        if days:
+            cur.execute(f"SELECT DISTINCT patient_id FROM {days[0]}")
+            patient_ids = [r[0] for r in cur.fetchall()]
+        for table, name in parts:
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            cur.execute(f"DROP TABLE {name}")
+        versions.bump_many(cur, patient_ids)
+        conn.commit()
+        logger.info("Archived %s (%d patients) to %s", f"{month:%Y-%m}", len(patient_ids), out_dir)
+    return written
+
+
+if __name__ == "__main__":
+    from db import connect
+
+    parser = argparse.ArgumentParser(description="Maintain diary table partitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="convert plain diary tables to monthly partitions")
+    en = sub.add_parser("ensure", help="create upcoming monthly partitions")
+    en.add_argument("--ahead", type=int, default=PARTITIONS_AHEAD)
+    ar = sub.add_parser("archive", help="export and drop old partitions")
+    ar.add_argument("--months", type=int, default=ARCHIVE_AFTER_MONTHS)
+    ar.add_argument("--dir", default=ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        if args.command == "migrate":
+            print(f"{migrate(conn)} diary days moved into partitions")
+        elif args.command == "ensure":
+            print(f"{ensure_partitions(conn.cursor(), args.ahead)} partitions created")
+            conn.commit()
+        else:
+            for path in archive(conn, args.months, args.dir):
+                print(path)
+    finally:
+        conn.close()
@@ -0,0 +1,303 @@
+"""
+In-memory nearest-neighbour index over diary-day symptom vectors.
+
+Every day is one float32 row of its symptom severities. Rows live in two
+segments: a base loaded read-only (memory-mapped) from the latest snapshot,
+shared through the page cache by all workers, and an in-RAM tail that grows
+by doubling. insert_disease appends to the tail of the worker that served it;
+every SYNC_SECONDS a query also pulls days committed by other workers (with
+SYNC_OVERLAP ids of slack for transactions that committed out of order).
+
+Search is exact: squared Euclidean distance via one matrix-vector product
+against precomputed row norms, then argpartition for the k smallest. At
+1M days that is ~25M multiply-adds, a few milliseconds.
+
+Every SNAPSHOT_SECONDS one worker (file lock) writes base + tail to a new
+directory under SIMILAR_CASES_DIR and points CURRENT at it; every worker then
+maps the new base and keeps only tail rows it doesn't contain. Without a
+snapshot the first load reads every day from the database; create one up
+front on large installs:  python similar_cases.py snapshot
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from db import connect_read
+
+logger = logging.getLogger("tms")
+
+SNAPSHOT_DIR = os.environ.get("SIMILAR_CASES_DIR", "similar_cases_index")
+SYNC_SECONDS = float(os.environ.get("SIMILAR_CASES_SYNC_SECONDS", "5"))
+SNAPSHOT_SECONDS = float(os.environ.get("SIMILAR_CASES_SNAPSHOT_SECONDS", "900"))
+SYNC_OVERLAP = 500
+SYNC_BATCH = 50_000
+INITIAL_CAPACITY = 1024
+KEEP_SNAPSHOTS = 2
+
+_FIELDS = ("vectors", "norms", "day_ids", "patient_ids")
+
+
+def _empty(dim: int) -> Dict[str, np.ndarray]:
+    return {
+        "vectors": np.empty((0, dim), dtype=np.float32),
+        "norms": np.empty(0, dtype=np.float32),
+        "day_ids": np.empty(0, dtype=np.int64),
+        "patient_ids": np.empty(0, dtype=np.int32),
+    }
+
+
+class CaseIndex:
+    def __init__(self, codes: Sequence[str], directory: str = SNAPSHOT_DIR):
+        self.codes = list(codes)
+        self.dim = len(self.codes)
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._base = _empty(self.dim)
+        self._base_name = None
+        self._tail = {
+            "vectors": np.zeros((INITIAL_CAPACITY, self.dim), dtype=np.float32),
+            "norms": np.zeros(INITIAL_CAPACITY, dtype=np.float32),
+            "day_ids": np.zeros(INITIAL_CAPACITY, dtype=np.int64),
+            "patient_ids": np.zeros(INITIAL_CAPACITY, dtype=np.int32),
+        }
+        self._n = 0
+        self._synced = 0
+        self._loaded = False
+        self._synced_at = 0.0
+        self._snapshot_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._base["day_ids"]) + self._n
+
+    # ─── Appends ───
+
+    def _append(self, day_ids: np.ndarray, patient_ids: np.ndarray, vectors: np.ndarray) -> None:
+        # Caller holds _lock. Readers keep references to the old arrays, and
+        # rows past their count are never read, so growing in place is safe.
+        need = self._n + len(day_ids)
+        if need > len(self._tail["day_ids"]):
+            capacity = max(need, 2 * len(self._tail["day_ids"]))
+            grown = {}
+            for field, arr in self._tail.items():
+                new = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+                new[:self._n] = arr[:self._n]
+                grown[field] = new
+            self._tail = grown
+        rows = slice(self._n, need)
+        self._tail["vectors"][rows] = vectors
+        self._tail["norms"][rows] = np.einsum("ij,ij->i", vectors, vectors)
+        self._tail["day_ids"][rows] = day_ids
+        self._tail["patient_ids"][rows] = patient_ids
+        self._n = need
+
+    def add(self, day_id: int, patient_id: int, symptoms: Sequence[int]) -> None:
+        """Append a just-committed day (called from insert_disease), unless a
+        sync already picked it up."""
+        vector = np.asarray(symptoms, dtype=np.float32).reshape(1, self.dim)
+        ids = np.array([day_id])
+        with self._lock:
+            if self._known(ids)[0]:
+                return
+            self._append(ids, np.array([patient_id]), vector)
+
+    def _known(self, day_ids: np.ndarray) -> np.ndarray:
+        """Mask of `day_ids` already in the index (only ids near them are compared)."""
+        if not len(day_ids):
+            return np.zeros(0, dtype=bool)
+        lo = day_ids.min()
+        base_ids = self._base["day_ids"]
+        tail_ids = self._tail["day_ids"][:self._n]
+        recent = np.concatenate([base_ids[base_ids >= lo], tail_ids[tail_ids >= lo]])
+        return np.isin(day_ids, recent)
+
+    # ─── Database sync ───
+
+    def _fetch(self, cur, after: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        cur.execute("""
+            SELECT d.day_id, d.patient_id, array_agg(s.symptom_code), array_agg(s.value)
+            FROM diary_days d
+            JOIN diary_symptoms s ON s.day_id = d.day_id AND s.created_at = d.created_at
+            WHERE d.day_id > %s
+            GROUP BY d.day_id, d.patient_id
+            ORDER BY d.day_id
+            LIMIT %s
+        """, (after, SYNC_BATCH))
+        rows = cur.fetchall()
+        position = {code: i for i, code in enumerate(self.codes)}
+        vectors = np.zeros((len(rows), self.dim), dtype=np.float32)
+        for r, (_, _, codes, values) in enumerate(rows):
+            for code, value in zip(codes, values):
+                i = position.get(code)
+                if i is not None:
+                    vectors[r, i] = value
+        day_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        patient_ids = np.array([row[1] for row in rows], dtype=np.int32)
+        return day_ids, patient_ids, vectors
+
+    def sync(self) -> int:
+        """Pull days committed since the last sync. Returns the number added."""
+        added = 0
+        conn = connect_read()
+        try:
+            cur = conn.cursor()
+            after = max(0, self._synced - SYNC_OVERLAP)
+            while True:
+                day_ids, patient_ids, vectors = self._fetch(cur, after)
+                if not len(day_ids):
+                    break
+                with self._lock:
+                    new = ~self._known(day_ids)
+                    self._append(day_ids[new], patient_ids[new], vectors[new])
+                    self._synced = max(self._synced, int(day_ids[-1]))
+                added += int(new.sum())
+                if len(day_ids) < SYNC_BATCH:
+                    break
+                after = int(day_ids[-1])
+        finally:
+            conn.close()
+        self._synced_at = time.monotonic()
+        return added
+
+    # ─── Snapshots ───
+
+    def _current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, "CURRENT"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _adopt(self, name: str) -> None:
+        """Map snapshot `name` as the base and drop tail rows it already holds."""
+        path = os.path.join(self.directory, name)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["codes"] != self.codes:
+            logger.warning("Similar-cases snapshot %s has different symptom codes, ignoring it", name)
+            return
+        base = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r") for field in _FIELDS}
+        with self._lock:
+            self._base, self._base_name = base, name
+            self._synced = max(self._synced, meta["synced"])
+            keep = ~self._known_in_base(self._tail["day_ids"][:self._n])
+            kept = {field: np.array(arr[:self._n][keep]) for field, arr in self._tail.items()}
+            self._n = 0
+            self._append(kept["day_ids"], kept["patient_ids"], kept["vectors"])
+
+    def _known_in_base(self, day_ids: np.ndarray) -> np.ndarray:
+        if not len(day_ids):
+            return np.zeros(0, dtype=bool)
+        base_ids = self._base["day_ids"]
+        return np.isin(day_ids, base_ids[base_ids >= day_ids.min()])
+
+    def write_snapshot(self) -> Optional[str]:
+        """Write base + tail as a new snapshot, unless another process is
+        writing one. Returns the snapshot's name."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            with self._lock:
+                n, tail, base, synced = self._n, self._tail, self._base, self._synced
+            name = f"snap-{synced}-{len(base['day_ids']) + n}"
+            path = os.path.join(self.directory, name)
+            tmp = path + ".tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            for field in _FIELDS:
+                with open(os.path.join(tmp, f"{field}.npy"), "wb") as f:
+                    np.save(f, np.concatenate([base[field], tail[field][:n]]))
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"synced": synced, "count": len(base["day_ids"]) + n, "codes": self.codes}, f)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+            with open(os.path.join(self.directory, "CURRENT.tmp"), "w", encoding="utf-8") as f:
+                f.write(name)
+            os.replace(os.path.join(self.directory, "CURRENT.tmp"), os.path.join(self.directory, "CURRENT"))
+            # Mapped files of older snapshots stay readable after unlink
+            old = sorted((d for d in os.listdir(self.directory) if d.startswith("snap-") and d != name),
+                         key=lambda d: os.path.getmtime(os.path.join(self.directory, d)))
+            for d in old[:max(0, len(old) - KEEP_SNAPSHOTS + 1)]:
+                shutil.rmtree(os.path.join(self.directory, d), ignore_errors=True)
+        return name
+
+    # ─── Refresh / search ───
+
+    def refresh(self, snapshot: bool = False) -> None:
+        """Load on first use, sync if stale, snapshot if due (or `snapshot`).
+        Once loaded, a caller that finds a refresh already running searches
+        what is there instead of waiting."""
+        if not self._refresh_lock.acquire(blocking=not self._loaded or snapshot):
+            return
+        try:
+            if not self._loaded:
+                current = self._current()
+                if current:
+                    self._adopt(current)
+                self.sync()
+                self._loaded = True
+                logger.info("Similar-cases index loaded: %d days", len(self))
+            elif time.monotonic() - self._synced_at > SYNC_SECONDS:
+                self.sync()
+            if snapshot or time.monotonic() - self._snapshot_at > SNAPSHOT_SECONDS:
+                self._snapshot_at = time.monotonic()
+                self.write_snapshot()
+                current = self._current()
+                if current and current != self._base_name:
+                    self._adopt(current)
+        finally:
+            self._refresh_lock.release()
+
+    def search(self, symptoms: Sequence[int], k: int, exclude_patient: Optional[int] = None,
+               exclude_day: Optional[int] = None) -> List[Tuple[int, int, float]]:
+        """k nearest days as (day_id, patient_id, distance), closest first."""
+        self.refresh()
+        q = np.asarray(symptoms, dtype=np.float32)
+        with self._lock:
+            n = self._n
+            segments = [self._base, {field: arr[:n] for field, arr in self._tail.items()}]
+        candidates = []
+        for seg in segments:
+            if not len(seg["day_ids"]):
+                continue
+            dist = seg["norms"] - 2 * (seg["vectors"] @ q) + float(q @ q)
+            if exclude_patient is not None:
+                dist[seg["patient_ids"] == exclude_patient] = np.inf
+            if exclude_day is not None:
+                dist[seg["day_ids"] == exclude_day] = np.inf
+            top = np.argpartition(dist, k)[:k] if len(dist) > k else np.arange(len(dist))
+            candidates += [(int(seg["day_ids"][i]), int(seg["patient_ids"][i]), float(dist[i]))
+                           for i in top if np.isfinite(dist[i])]
+        candidates.sort(key=lambda c: (c[2], -c[0]))
+        return [(day, pid, max(0.0, d) ** 0.5) for day, pid, d in candidates[:k]]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"days": len(self), "snapshot": self._base_name, "tail": self._n, "synced_day_id": self._synced}
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from importlib import import_module
+
+    parser = argparse.ArgumentParser(description="Maintain the similar-cases index snapshot")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("snapshot", help="load/sync the index from the database and write a snapshot")
+    parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    index = import_module("backend TMS").similar_index
+    index.refresh(snapshot=True)
+    print(f"{len(index)} days in snapshot {index.stats()['snapshot']}")
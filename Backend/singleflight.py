@@ -0,0 +1,67 @@
+"""
+Request coalescing for expensive reads.
+
+Concurrent callers asking for the same key share one computation: the first
+starts it as a task (a blocking function runs in the threadpool, a coroutine
+function is awaited), the rest await the same task. Callers await through asyncio.shield, so a leader whose
+client disconnects does not cancel the work the followers are waiting on.
+Keys include the data version, so a finished result may additionally be reused
+for `ttl` seconds without serving anything stale.
+
+Per-worker, per-event-loop. /metrics gets singleflight.<name>.{calls,runs,
+shared,cached} and a coalesce_ratio gauge (share of calls that did not run).
+"""
+
+import asyncio
+import time
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+import metrics
+
+
+class SingleFlight:
+    def __init__(self, name: str, ttl: float = 0.0):
+        self.name = name
+        self.ttl = ttl
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._done: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def _count(self, outcome: str) -> None:
+        prefix = f"singleflight.{self.name}"
+        metrics.inc(f"{prefix}.calls")
+        metrics.inc(f"{prefix}.{outcome}")
+        calls = metrics.get(f"{prefix}.calls")
+        metrics.set_gauge(f"{prefix}.coalesce_ratio", round(1 - metrics.get(f"{prefix}.runs") / calls, 4))
+
+    async def do(self, key: Hashable, fn: Callable[..., Any], *args: Any) -> Any:
+        hit = self._done.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            self._count("cached")
+            return hit[1]
+        task = self._inflight.get(key)
+        if task is None:
+            self._count("runs")
+            task = asyncio.ensure_future(self._run(key, fn, args))
+            # Nobody may be left awaiting a failed task; don't log it as unretrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._inflight[key] = task
+        else:
+            self._count("shared")
+        return await asyncio.shield(task)
+
+    async def _run(self, key: Hashable, fn: Callable[..., Any], args: tuple) -> Any:
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                value = await fn(*args)
+            else:
+                value = await run_in_threadpool(fn, *args)
+            if self.ttl > 0:
+                now = time.monotonic()
+                for k in [k for k, (exp, _) in self._done.items() if exp <= now]:
+                    del self._done[k]
+                self._done[key] = (now + self.ttl, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
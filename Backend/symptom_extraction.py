@@ -0,0 +1,408 @@
+"""
+Server-side free-text → 23-element symptom vector extraction.
+
+A compiled Aho-Corasick matcher over a Russian / English (plus common Kazakh)
+synonym lexicon handles the bulk of messages in microseconds. Only when the
+lexicon covers too little of the text does the request fall back to an LLM
+backend. Normalised texts are memoised in an LRU in front of both paths.
+
+The LLM backend is pluggable: set_llm_backend(StubSymptomExtractor({...}))
+replaces the network call with a local stub.
+"""
+
+import json
+import logging
+import os
+import re
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("tms")
+
+LLM_API_BASE = os.environ.get("LLM_API_BASE", "https://api.groq.com/openai/v1").rstrip("/")
+MIN_COVERAGE = float(os.environ.get("SYMPTOM_LEXICON_MIN_COVERAGE", "0.5"))
+CACHE_SIZE = int(os.environ.get("SYMPTOM_EXTRACTION_CACHE_SIZE", "2048"))
+
+# ─── Lexicon ───
+# pattern → severity; None means "2 unless a severity cue says otherwise".
+# Patterns match at the start of a word, so stems cover inflected forms.
+
+LEXICON: Dict[str, List[Tuple[str, Optional[int]]]] = {
+    "ABDOMINAL_PAIN": [("болит живот", None), ("живот болит", None), ("боль в живот", None),
+                       ("боли в живот", None), ("живот ноет", 1), ("живот справа", 3), ("живот внизу", 3),
+                       ("abdominal pain", None), ("stomach ache", None), ("stomachache", None),
+                       ("belly pain", None), ("tummy ache", None), ("іш ауыр", None)],
+    "CHEST_PAIN": [("боль в груд", None), ("болит груд", None), ("грудь болит", None),
+                   ("за грудиной", None), ("chest pain", None)],
+    "COUGH": [("кашел", None), ("кашл", None), ("покашлива", 1), ("cough", None), ("жөтел", None)],
+    "DEHYDRATION": [("обезвож", None), ("сухие губы", None), ("сухой язык", None), ("dehydrat", None)],
+    "DIARRHEA": [("понос", None), ("диаре", None), ("жидкий стул", 1), ("водянистый стул", 3),
+                 ("diarrh", None)],
+    "FEVER": [("температур", None), ("жар", 2), ("горячий лоб", 2), ("лихорад", None),
+              ("субфебрил", 1), ("высокая температур", 3), ("fever", None),
+              ("high temperature", 3), ("дене қызуы", None)],
+    "HEADACHE": [("болит голов", None), ("голова болит", None), ("головн", None),
+                 ("headache", None), ("басым ауыр", None), ("бас ауыр", None)],
+    "ITCHING": [("зуд", None), ("чешет", None), ("чешут", None), ("itch", None)],
+    "MUSCLE_ACHES": [("ломот", None), ("ломит", None), ("мышц", None), ("muscle ache", None),
+                     ("body ache", None), ("myalgia", None)],
+    "NAUSEA": [("тошн", None), ("подташнива", 1), ("nause", None)],
+    "NECK_STIFFNESS": [("шея не поворачива", None), ("ригидн", None), ("шея жестк", None),
+                       ("жесткая шея", None), ("затылок напряж", None), ("stiff neck", None),
+                       ("neck stiff", None)],
+    "PHOTOPHOBIA": [("светобоязн", None), ("больно смотреть на свет", None), ("photophob", None),
+                    ("sensitivity to light", None), ("light sensitiv", None)],
+    "POLYDIPSIA": [("постоянно пьет", None), ("много пьет", None), ("жажд", None),
+                   ("polydips", None), ("excessive thirst", None), ("very thirsty", None)],
+    "POLYURIA": [("часто писает", None), ("частое мочеиспуск", None), ("много мочи", None),
+                 ("polyur", None), ("frequent urination", None)],
+    "RASH": [("сып", None), ("высыпан", None), ("пятна на коже", None), ("rash", None)],
+    "RESPIRATORY_DISTRESS": [("тяжело дыш", None), ("задыха", None), ("одышк", None),
+                             ("не хватает воздуха", None), ("shortness of breath", None),
+                             ("difficulty breathing", None), ("breathless", None)],
+    "RUNNY_NOSE": [("насморк", None), ("сопл", None), ("течет из носа", None), ("runny nose", None)],
+    "SNEEZING": [("чиха", None), ("чхает", None), ("sneez", None)],
+    "SORE_THROAT": [("болит горл", None), ("горло болит", None), ("боль в горл", None),
+                    ("першит", 1), ("sore throat", None)],
+    "STRIDOR": [("стридор", None), ("свист на вдох", None), ("шумный вдох", None), ("осип", 2),
+                ("stridor", None)],
+    "VOMITING": [("рвот", None), ("вырвал", None), ("рвет", None), ("однократная рвота", 1),
+                 ("рвота фонтаном", 3), ("многократная рвота", 3), ("vomit", None)],
+    "WEIGHT_LOSS": [("похуде", None), ("потеря веса", None), ("теряет вес", None),
+                    ("weight loss", None), ("losing weight", None)],
+    "WHEEZING": [("хрип", None), ("свист на выдох", None), ("свистящее дыхание", None),
+                 ("wheez", None)],
+}
+
+# Multi-symptom phrases that the frontend prompt calls out explicitly
+COMBINED: Dict[str, List[Tuple[str, int]]] = {
+    "лающий кашель": [("COUGH", 3), ("STRIDOR", 2)],
+    "barking cough": [("COUGH", 3), ("STRIDOR", 2)],
+}
+
+# Cue words are prefixes; in a multi-word cue every word but the last is exact
+SEVERE_CUES = ("сильн", "очень", "невыносим", "резк", "остр", "ужасн", "не прекраща",
+               "не проход", "severe", "very", "bad", "terrible", "extreme")
+MILD_CUES = ("немного", "слегка", "небольш", "чуть", "слабо", "mild", "slight", "little", "bit")
+# "температура нормальная", "normal temperature": the symptom is mentioned, not reported
+NORMAL_CUES = ("норм", "normal")
+NEGATIONS = {"нет", "без", "не", "ни", "no", "not", "without"}
+# Words that start like a lexicon stem but are not symptoms ("жарко на улице")
+FALSE_FRIENDS = ("жарк", "жарен", "жарил", "жарищ", "жарг")
+# Negation and cues never reach across these: punctuation between tokens, or a
+# contrasting conjunction that opens a new clause
+CLAUSE_PUNCT = set(".,;:!?")
+CLAUSE_WORDS = {"но", "а", "однако", "зато", "but", "however", "though"}
+STOPWORDS = {
+    "и", "а", "но", "у", "в", "во", "на", "с", "со", "к", "по", "за", "из", "от", "до", "о",
+    "я", "мы", "он", "она", "они", "меня", "нас", "него", "нее", "его", "ее", "ребенка", "ребенок",
+    "уже", "еще", "так", "тоже", "есть", "был", "была", "было", "стал", "стала", "сегодня",
+    "вчера", "утром", "вечером", "ночью", "день", "дня", "дней", "дет", "сын", "дочь",
+    "the", "a", "an", "and", "my", "i", "is", "are", "has", "have", "had", "with", "of",
+    "in", "at", "to", "he", "she", "it", "since", "day", "days", "today", "yesterday",
+}
+
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)?|[^\W\d_]+")
+_TEMP_RE = re.compile(r"(?<![\d.,])(3[4-9]|4[0-2])(?:[.,](\d))?(?![\d])")
+
+
+def normalize(text: str) -> str:
+    text = text.casefold().replace("ё", "е")
+    text = re.sub(r"[^\w\s.,;:!?°-]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+# ─── Aho-Corasick ───
+
+class AhoCorasick:
+    """Multi-pattern matcher: one pass over the text regardless of lexicon size."""
+
+    def __init__(self, patterns: Sequence[Tuple[str, Any]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[Tuple[int, Any]]] = [[]]
+        for pattern, payload in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append((len(pattern), payload))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def find(self, text: str):
+        """Yields (start, end, payload) for every occurrence, overlaps included."""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, payload in self.out[node]:
+                yield i - length + 1, i + 1, payload
+
+
+def _build_matcher() -> AhoCorasick:
+    patterns: List[Tuple[str, Any]] = []
+    for code, entries in LEXICON.items():
+        for pattern, severity in entries:
+            patterns.append((normalize(pattern), [(code, severity)]))
+    for pattern, outputs in COMBINED.items():
+        patterns.append((normalize(pattern), outputs))
+    return AhoCorasick(patterns)
+
+
+_MATCHER = _build_matcher()
+
+
+def _fever_from_temperature(value: float) -> int:
+    if value >= 38.5:
+        return 3
+    if value >= 37.5:
+        return 2
+    if value >= 37.0:
+        return 1
+    return 0
+
+
+def _cue_at(words: List[str], i: int, cue: str) -> int:
+    """Number of words `cue` spans when it starts at words[i], else 0."""
+    parts = cue.split()
+    if i + len(parts) > len(words):
+        return 0
+    if any(words[i + k] != w for k, w in enumerate(parts[:-1])):
+        return 0
+    return len(parts) if words[i + len(parts) - 1].startswith(parts[-1]) else 0
+
+
+def _severity_cue(words: List[str]) -> Tuple[Optional[int], List[int]]:
+    """Severity named by cue words, and the positions of the words that named it."""
+    for i in range(len(words)):
+        for cues, severity in ((SEVERE_CUES, 3), (MILD_CUES, 1)):
+            for cue in cues:
+                n = _cue_at(words, i, cue)
+                if n:
+                    return severity, list(range(i, i + n))
+    return None, []
+
+
+def _clauses(norm: str, tokens: List[Tuple[int, int, str]]) -> List[int]:
+    """Clause number of every token."""
+    out = []
+    clause = 0
+    for i, (start, _, word) in enumerate(tokens):
+        if i and (CLAUSE_PUNCT.intersection(norm[tokens[i - 1][1]:start]) or word in CLAUSE_WORDS):
+            clause += 1
+        out.append(clause)
+    return out
+
+
+def extract_lexicon(text: str, symptom_codes: Sequence[str]) -> Dict[str, Any]:
+    """Deterministic fast path. Returns detected severities and lexicon coverage."""
+    norm = normalize(text)
+    tokens = [(m.start(), m.end(), m.group()) for m in _TOKEN_RE.finditer(norm)]
+    clause = _clauses(norm, tokens)
+
+    # Leftmost-longest non-overlapping matches that start on a word boundary
+    hits = sorted(
+        (h for h in _MATCHER.find(norm)
+         if (h[0] == 0 or not norm[h[0] - 1].isalnum()) and not norm.startswith(FALSE_FRIENDS, h[0])),
+        key=lambda h: (h[0], -(h[1] - h[0])),
+    )
+    chosen = []
+    last_end = -1
+    for start, end, payload in hits:
+        if start >= last_end:
+            idx = [i for i, t in enumerate(tokens) if t[1] > start and t[0] < end]
+            if idx:
+                chosen.append((idx[0], idx[-1], end, payload))
+            last_end = end
+
+    detected: Dict[str, int] = {}
+    covered = set()
+    # A post-positional "нет" ("температуры нет") belongs to the match before it only
+    used_negations = set()
+    for n, (first, last, end, payload) in enumerate(chosen):
+        covered.update(range(first, last + 1))
+        # Context is the same clause, up to two words, never into a neighbouring match
+        lo = max(first - 2, chosen[n - 1][1] + 1 if n else 0)
+        hi = min(last + 3, chosen[n + 1][0] if n + 1 < len(chosen) else len(tokens))
+        before = [i for i in range(lo, first) if clause[i] == clause[first]]
+        after = [i for i in range(last + 1, hi) if clause[i] == clause[last]]
+        words = [tokens[i][2] for i in before + after]
+
+        pre = [i for i in before if i not in used_negations]
+        negated = bool(pre) and (
+            tokens[pre[-1]][2] in NEGATIONS
+            # "нет сильного кашля", "без высокой ..."
+            or (len(pre) == 2 and tokens[pre[0]][2] in NEGATIONS
+                and _severity_cue([tokens[pre[1]][2]])[0] is not None)
+        )
+        if after and tokens[after[0]][2] == "нет":
+            negated = True
+            used_negations.add(after[0])
+        if negated or any(w.startswith(NORMAL_CUES) for w in words):
+            covered.update(before + after[:1])
+            continue
+        cue, cue_at = _severity_cue(words)
+        covered.update((before + after)[i] for i in cue_at)
+        for code, severity in payload:
+            sev = severity if severity is not None else (cue or 2)
+            if code == "FEVER":
+                clause_end = max(t[1] for t, c in zip(tokens, clause) if c == clause[last])
+                m = _TEMP_RE.search(norm, end, min(end + 24, clause_end))
+                if m:
+                    value = float(m.group(1) + "." + (m.group(2) or "0"))
+                    covered.update(i for i, t in enumerate(tokens) if t[0] == m.start())
+                    sev = _fever_from_temperature(value)
+                    if sev == 0:
+                        continue
+            detected[code] = max(detected.get(code, 0), sev)
+
+    # A bare "39.5" / "38 градусов" without the word "температура"
+    if "FEVER" not in detected:
+        for m in _TEMP_RE.finditer(norm):
+            tail = norm[m.end():m.end() + 8]
+            if m.group(2) or tail.lstrip().startswith(("°", "градус")):
+                sev = _fever_from_temperature(float(m.group(1) + "." + (m.group(2) or "0")))
+                if sev:
+                    detected["FEVER"] = sev
+                    covered.update(i for i, t in enumerate(tokens) if t[0] == m.start())
+                    break
+
+    content = [i for i, t in enumerate(tokens) if t[2] not in STOPWORDS]
+    coverage = (len([i for i in content if i in covered]) / len(content)) if content else 0.0
+    return {
+        "detected": {code: detected[code] for code in symptom_codes if code in detected},
+        "coverage": round(coverage, 3),
+    }
+
+
+# ─── LLM fallback backends ───
+
+class GroqSymptomExtractor:
+    """OpenAI-compatible chat-completions backend (Groq by default)."""
+
+    SYSTEM_PROMPT = (
+        "You are a medical symptom extractor. Parse the user text (usually Russian, may be "
+        "Kazakh or English) and return ONLY a JSON object {\"SYMPTOM_NAME\": severity} with "
+        "integer severity 1-3, using only these names: %s. Do not include symptoms "
+        "the patient denies. Fever: 37-37.5 → 1, 37.5-38.5 → 2, above 38.5 → 3. "
+        "Barking cough → COUGH 3 and STRIDOR 2. "
+        "If the text contains no symptoms, return {\"_NO_SYMPTOMS\": true}."
+    )
+
+    def __init__(self, api_key: str, model: str, base_url: str = LLM_API_BASE, timeout: float = 30):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url
+        self.timeout = timeout
+
+    async def extract(self, text: str, symptom_codes: Sequence[str]) -> Dict[str, int]:
+        import httpx
+
+        prompt = self.SYSTEM_PROMPT % json.dumps(list(symptom_codes))
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            resp = await client.post(
+                f"{self.base_url}/chat/completions",
+                headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+                json={
+                    "model": self.model,
+                    "messages": [
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": text},
+                    ],
+                    "temperature": 0,
+                    "response_format": {"type": "json_object"},
+                },
+            )
+            resp.raise_for_status()
+        content = resp.json().get("choices", [{}])[0].get("message", {}).get("content", "")
+        parsed = json.loads(content or "{}")
+        if parsed.get("_NO_SYMPTOMS"):
+            return {}
+        result = {}
+        for key, value in parsed.items():
+            code = str(key).upper()
+            try:
+                sev = min(3, max(0, int(value)))
+            except (TypeError, ValueError):
+                continue
+            if code in symptom_codes and sev > 0:
+                result[code] = sev
+        return result
+
+
+class StubSymptomExtractor:
+    """Local stand-in for tests and load runs: a fixed mapping or a callable."""
+
+    def __init__(self, response=None):
+        self.response = response if response is not None else {}
+        self.calls = 0
+
+    async def extract(self, text: str, symptom_codes: Sequence[str]) -> Dict[str, int]:
+        self.calls += 1
+        result = self.response(text) if callable(self.response) else self.response
+        return {k: v for k, v in result.items() if k in symptom_codes}
+
+
+def _default_backend():
+    api_key = os.environ.get("GROQ_API_KEY", "")
+    if not api_key:
+        return None
+    return GroqSymptomExtractor(api_key, os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile"))
+
+
+_llm_backend = _default_backend()
+_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def set_llm_backend(backend) -> None:
+    """Swap the fallback backend (None disables it) and drop cached results."""
+    global _llm_backend
+    _llm_backend = backend
+    _cache.clear()
+
+
+async def extract_symptoms(text: str, symptom_codes: Sequence[str]) -> Dict[str, Any]:
+    key = normalize(text)
+    cached = _cache.get(key)
+    if cached is not None:
+        _cache.move_to_end(key)
+        return {**cached, "cached": True}
+
+    result = extract_lexicon(text, symptom_codes)
+    detected = result["detected"]
+    source = "lexicon"
+    if result["coverage"] < MIN_COVERAGE and _llm_backend is not None:
+        try:
+            detected = await _llm_backend.extract(text, symptom_codes)
+            source = "llm"
+        except Exception as e:
+            logger.warning("LLM symptom extraction failed, using lexicon result: %s", e)
+
+    entry = {
+        "symptoms": [detected.get(code, 0) for code in symptom_codes],
+        "detected": detected,
+        "coverage": result["coverage"],
+        "source": source,
+        "no_symptoms": not detected,
+    }
+    _cache[key] = entry
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return {**entry, "cached": False}
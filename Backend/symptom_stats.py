@@ -0,0 +1,121 @@
+"""
+Incremental per-patient symptom aggregates for doctor dashboards.
+
+One row per (patient, symptom, calendar day) keeps count / sum / max and is
+upserted in the same transaction that writes the diary day. 7- and 30-day
+averages, maxima and trend slopes are then computed from at most 23 × 30 bucket
+rows per patient, independent of how long the diary is.
+
+Backfill / repair:  python symptom_stats.py rebuild [--patient-id N]
+Buckets older than the oldest retained diary day (archived months, see
+partitions.py) are left as they are.
+"""
+
+import argparse
+from typing import Any, Dict, List, Optional, Sequence
+
+import psycopg2.extras
+
+import partitions
+
+WINDOWS = (7, 30)
+
+
+def record_day(cur, patient_id: int, symptom_codes: Sequence[str], values: Sequence[int]) -> None:
+    """Fold one diary day into today's buckets (one round trip for all symptoms)."""
+    rows = [(patient_id, code, int(v), int(v)) for code, v in zip(symptom_codes, values)]
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO symptom_daily_stats(patient_id, symptom_code, day, n, total, peak)
+        VALUES %s
+        ON CONFLICT (patient_id, symptom_code, day) DO UPDATE
+        SET n = symptom_daily_stats.n + EXCLUDED.n,
+            total = symptom_daily_stats.total + EXCLUDED.total,
+            peak = GREATEST(symptom_daily_stats.peak, EXCLUDED.peak)
+    """, rows, template="(%s, %s, CURRENT_DATE, 1, %s, %s)")
+
+
+def _window_stats(points: List[tuple]) -> Optional[Dict[str, Any]]:
+    """points: (age_in_days, n, total, peak) for one symptom inside the window."""
+    if not points:
+        return None
+    n = sum(p[1] for p in points)
+    total = sum(p[2] for p in points)
+    # Least-squares slope of the daily mean, in severity points per day
+    xs = [-p[0] for p in points]
+    ys = [p[2] / p[1] for p in points]
+    slope = 0.0
+    if len(points) > 1:
+        mx = sum(xs) / len(xs)
+        my = sum(ys) / len(ys)
+        var = sum((x - mx) ** 2 for x in xs)
+        if var:
+            slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var
+    return {
+        "days": len(points),
+        "entries": n,
+        "avg": round(total / n, 3),
+        "max": max(p[3] for p in points),
+        "slope": round(slope, 4),
+    }
+
+
+def get_patient_stats(cur, patient_id: int, symptom_codes: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    cur.execute("""
+        SELECT symptom_code, CURRENT_DATE - day, n, total, peak
+        FROM symptom_daily_stats
+        WHERE patient_id = %s AND day > CURRENT_DATE - %s
+    """, (patient_id, max(WINDOWS)))
+    by_code: Dict[str, List[tuple]] = {}
+    for code, age, n, total, peak in cur.fetchall():
+        by_code.setdefault(code, []).append((age, n, total, peak))
+
+    stats = {}
+    for code in symptom_codes:
+        points = by_code.get(code, [])
+        stats[code] = {
+            f"{w}d": _window_stats([p for p in points if p[0] < w])
+            for w in WINDOWS
+        }
+    return stats
+
+
+def rebuild(conn, patient_id: Optional[int] = None) -> int:
+    """Recompute buckets from diary_symptoms. Returns the number of bucket rows."""
+    cur = conn.cursor()
+    since = partitions.retained_since(cur)
+    if since is None:
+        conn.commit()
+        return 0
+    only = (patient_id,) if patient_id is not None else ()
+    if patient_id is not None:
+        cur.execute("DELETE FROM symptom_daily_stats WHERE day >= %s AND patient_id = %s", (since, patient_id))
+    else:
+        cur.execute("DELETE FROM symptom_daily_stats WHERE day >= %s", (since,))
+    where = "AND d.patient_id = %s" if patient_id is not None else ""
+    cur.execute(f"""
+        INSERT INTO symptom_daily_stats(patient_id, symptom_code, day, n, total, peak)
+        SELECT d.patient_id, s.symptom_code, d.created_at::date, COUNT(*), SUM(s.value), MAX(s.value)
+        FROM diary_days d
+        JOIN diary_symptoms s ON s.day_id = d.day_id AND s.created_at = d.created_at
+        WHERE d.created_at >= %s AND s.created_at >= %s {where}
+        GROUP BY d.patient_id, s.symptom_code, d.created_at::date
+    """, (since, since) + only)
+    count = cur.rowcount
+    conn.commit()
+    return count
+
+
+if __name__ == "__main__":
+    from db import connect
+
+    parser = argparse.ArgumentParser(description="Maintain symptom_daily_stats")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rb = sub.add_parser("rebuild", help="recompute aggregates from diary_symptoms")
+    rb.add_argument("--patient-id", type=int, default=None)
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        print(f"{rebuild(conn, args.patient_id)} bucket rows written")
+    finally:
+        conn.close()
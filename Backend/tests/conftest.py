@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Backend modules are flat and imported by name, as the app does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
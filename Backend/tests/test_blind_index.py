@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+os.environ.setdefault("BLIND_INDEX_KEY", "test-key")
+
+import blind_index
+
+
+def test_normalize():
+    assert blind_index.normalize("  Пётр  ИВАНОВ-Смирнов 2 ") == "петр иванов смирнов"
+    assert blind_index.normalize(None) == ""
+
+
+def test_terms_are_keyed_and_field_scoped():
+    assert blind_index.term("name", "иван") == blind_index.term("name", "иван")
+    assert blind_index.term("name", "иван") != blind_index.term("city", "иван")
+    assert len(blind_index.term("name", "иван")) == 32
+
+
+def test_patient_terms_cover_prefixes():
+    terms = set(blind_index.patient_terms("Иван", "Алматы"))
+    assert ("name", blind_index.term("name", "иван")) in terms
+    assert ("name_prefix", blind_index.term("name_prefix", "ива")) in terms
+    assert ("name_prefix", blind_index.term("name_prefix", "ив")) not in terms
+    assert ("city", blind_index.term("city", "алматы")) in terms
+
+
+def test_query_terms_are_a_subset_of_patient_terms():
+    stored = set(blind_index.patient_terms("Иванов Пётр", "Алматы"))
+    assert set(blind_index.query_terms("пётр иван", "АЛМАТЫ", prefix=True)) <= stored
+    assert not set(blind_index.query_terms("пётр иван", None, prefix=False)) <= stored
+
+
+@pytest.mark.parametrize("name, city, prefix, ok", [
+    ("иванов", None, False, True),
+    ("иван", None, False, False),
+    ("иван", None, True, True),
+    ("петр иван", "алматы", True, True),
+    ("иванов", "астана", False, False),
+])
+def test_matches_rechecks_decrypted_values(name, city, prefix, ok):
+    assert blind_index._matches("Иванов Пётр", "Алматы", name, city, prefix) is ok
@@ -0,0 +1,134 @@
+import contextvars
+import itertools
+import time
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+import db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        self.conn.pool.lag_checks += 1
+
+    def fetchone(self):
+        return (self.conn.pool.lag,)
+
+
+class FakeConn:
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+    def __init__(self, name, lag=0.0, down=False):
+        self.name = name
+        self.lag = lag
+        self.down = down
+        self.lag_checks = 0
+
+    def get(self, retry=True, **connect_kwargs):
+        if self.down:
+            raise psycopg2.OperationalError("connection refused")
+        return FakeConn(self)
+
+
+@pytest.fixture
+def routing(monkeypatch):
+    """Primary plus two replicas, all fake; returns a callable giving the
+    name of the pool connect_read() picked."""
+    replicas = []
+    for name in ("replica1", "replica2"):
+        replica = db._Replica.__new__(db._Replica)
+        replica.dsn = name
+        replica.pool = FakePool(name)
+        replica.down_until = 0.0
+        replica.checked_at = 0.0
+        replica.lag = 0.0
+        replicas.append(replica)
+    monkeypatch.setattr(db, "_replicas", replicas)
+    monkeypatch.setattr(db, "_primary", FakePool("primary"))
+    monkeypatch.setattr(db, "_round_robin", itertools.count())
+    monkeypatch.setattr(db, "_recent_writes", {})
+    monkeypatch.setattr(db, "_client_writes", contextvars.ContextVar("db_client_writes", default=None))
+
+    def read(patient_id=None):
+        return db.connect_read(patient_id).pool.name
+    read.replicas = replicas
+    return read
+
+
+def test_reads_round_robin_over_replicas(routing):
+    assert [routing() for _ in range(4)] == ["replica1", "replica2", "replica1", "replica2"]
+
+
+def test_unreachable_replica_is_skipped_until_retry(routing):
+    routing.replicas[0].pool.down = True
+    assert [routing() for _ in range(3)] == ["replica2", "replica2", "replica2"]
+    assert routing.replicas[0].down_until > time.monotonic()
+
+
+def test_all_replicas_down_falls_back_to_primary(routing):
+    for replica in routing.replicas:
+        replica.pool.down = True
+    assert routing() == "primary"
+
+
+def test_lagging_replica_falls_back(routing):
+    routing.replicas[0].pool.lag = db.REPLICA_MAX_LAG_SECONDS + 1
+    routing.replicas[1].pool.lag = db.REPLICA_MAX_LAG_SECONDS + 1
+    assert routing() == "primary"
+
+
+def test_lag_is_measured_at_most_every_check_interval(routing):
+    routing()
+    routing()
+    routing()
+    assert routing.replicas[0].pool.lag_checks == 1
+
+
+def test_patient_written_here_reads_from_primary(routing):
+    db.mark_write(7)
+    assert routing(7) == "primary"
+    assert routing(8) == "replica1"
+
+
+def test_patient_pin_expires(routing):
+    db.mark_write(7)
+    db._recent_writes[7] -= db.READ_PIN_SECONDS
+    assert routing(7) == "replica1"
+
+
+def test_client_write_time_pins_all_its_reads(routing):
+    db.track_writes(str(time.time()))
+    assert routing() == "primary"
+    assert routing(8) == "primary"
+
+
+@pytest.mark.parametrize("reported", ["", "garbage", "nan", "inf", str(time.time() - 3600), str(time.time() + 3600)])
+def test_stale_or_bogus_client_write_time_is_ignored(routing, reported):
+    db.track_writes(reported)
+    assert routing() == "replica1"
+
+
+def test_write_in_this_request_is_reported_and_pins(routing):
+    state = db.track_writes(None)
+    db.mark_write(7)
+    assert state[1] > 0
+    assert routing() == "primary"
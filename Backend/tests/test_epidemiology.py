@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+import epidemiology
+
+
+@pytest.mark.parametrize("city, bucket", [
+    ("Алматы", "almaty"),
+    ("  г. Алма-Ата ", "almaty"),
+    ("Нур-Султан", "astana"),
+    ("Өскемен", "oskemen"),
+    ("с. Кайнар, ул. Абая 5", "other"),
+    ("", "unknown"),
+    (None, "unknown"),
+])
+def test_city_bucket_is_from_the_allow_list(city, bucket):
+    assert epidemiology.city_bucket(city) == bucket
+
+
+def _cell(city, count, day="2024-03-01"):
+    return {"date": day, "city": city, "disease": "Flu", "zone": "green", "count": count}
+
+
+def test_small_cells_are_merged_into_other():
+    rows = [_cell("almaty", 7), _cell("astana", 3), _cell("taraz", 2), _cell("other", 1)]
+    assert epidemiology.suppress_small_cells(rows, 5) == [_cell("almaty", 7), _cell("other", 6)]
+
+
+def test_merged_cells_still_below_the_minimum_are_dropped():
+    rows = [_cell("astana", 1), _cell("taraz", 2)]
+    assert epidemiology.suppress_small_cells(rows, 5) == []
+
+
+def test_small_cells_are_dropped_without_merging():
+    rows = [_cell("astana", 3), _cell("astana", 4, day="2024-03-02"), _cell("astana", 9, day="2024-03-03")]
+    assert epidemiology.suppress_small_cells(rows, 5, merge=False) == [_cell("astana", 9, day="2024-03-03")]
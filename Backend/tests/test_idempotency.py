@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("psycopg2")
+pytest.importorskip("cryptography")
+
+import idempotency
+
+
+def test_request_hash_is_stable():
+    assert idempotency.request_hash("image/png", b"abc") == idempotency.request_hash("image/png", b"abc")
+
+
+def test_request_hash_separates_parts():
+    assert idempotency.request_hash("ab", "c") != idempotency.request_hash("a", "bc")
+    assert idempotency.request_hash("image/png", b"abc") != idempotency.request_hash("image/jpeg", b"abc")
@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("cryptography")
+pytest.importorskip("dotenv")
+
+import lab_markers
+
+
+@pytest.mark.parametrize("name, code", [
+    ("Гемоглобин", "HGB"),
+    ("HGB", "HGB"),
+    ("Лейкоциты (WBC)", "WBC"),
+    ("СОЭ", "ESR"),
+    ("С-реактивный белок", "CRP"),
+    ("Тромбоциты", "PLT"),
+    ("Эритроциты", "RBC"),
+    ("K+", "K"),
+    ("MCH", "MCH"),
+    ("MCHC", "MCHC"),
+    ("Среднее содержание гемоглобина в эритроците (MCH)", "MCH"),
+    ("Mean corpuscular hemoglobin concentration", "MCHC"),
+    ("MCV", "MCV"),
+    ("Средний объем эритроцита", "MCV"),
+    ("Mean platelet volume", "MPV"),
+    ("HbA1c", "HBA1C"),
+    ("Гемоглобин гликированный", "HBA1C"),
+])
+def test_marker_code(name, code):
+    assert lab_markers.marker_code(name) == code
+
+
+@pytest.mark.parametrize("name, code", [
+    ("Глюкоза в моче", "U_GLU"),
+    ("Белок в моче", "U_PRO"),
+    ("Лейкоциты в моче", "U_WBC"),
+    ("Удельный вес мочи", "U_SG"),
+    ("Urine glucose", "U_GLU"),
+])
+def test_urine_analytes_have_their_own_codes(name, code):
+    assert lab_markers.marker_code(name) == code
+
+
+@pytest.mark.parametrize("name, code", [
+    ("Глюкоза", "U_GLU"),
+    ("Лейкоциты", "U_WBC"),
+    ("Эритроциты", "U_RBC"),
+    ("Белок", "U_PRO"),
+    ("GLU", "U_GLU"),
+    ("Цвет", "X:цвет"),
+])
+def test_urinalysis_panel_items_get_urine_codes(name, code):
+    assert lab_markers.marker_code(name, "Общий анализ мочи") == code
+
+
+def test_blood_panel_items_keep_blood_codes():
+    assert lab_markers.marker_code("Глюкоза", "Биохимический анализ крови") == "GLU"
+    assert lab_markers.marker_code("Глюкоза") == "GLU"
+
+
+@pytest.mark.parametrize("name", ["Pigeon", "Hemoglobinopathy screen"])
+def test_aliases_match_whole_words(name):
+    assert lab_markers.marker_code(name).startswith("X:")
+
+
+def test_unknown_marker_keeps_its_name():
+    assert lab_markers.marker_code("  Ферритин  ") == "X:ферритин"
+
+
+@pytest.mark.parametrize("raw, value", [
+    ("135", 135.0),
+    ("4,5 ×10^9/л", 4.5),
+    ("-0.2", -0.2),
+    ("отрицательно", None),
+    (None, None),
+])
+def test_parse_value(raw, value):
+    assert lab_markers.parse_value(raw) == value
+
+
+def test_parse_test_date():
+    assert lab_markers.parse_test_date("2024-03-05T10:00") == datetime.date(2024, 3, 5)
+    assert lab_markers.parse_test_date("05.03.2024") is None
+    assert lab_markers.parse_test_date(None) is None
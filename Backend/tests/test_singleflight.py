@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+import singleflight
+
+
+def test_concurrent_calls_share_one_run():
+    calls = []
+
+    async def load(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    async def main():
+        flight = singleflight.SingleFlight("test_shared")
+        return await asyncio.gather(*(flight.do("k", load, 21) for _ in range(5)))
+
+    assert asyncio.run(main()) == [42] * 5
+    assert calls == [21]
+
+
+def test_blocking_function_runs_in_threadpool():
+    main_thread = threading.get_ident()
+
+    def load():
+        return threading.get_ident()
+
+    async def main():
+        return await singleflight.SingleFlight("test_thread").do("k", load)
+
+    assert asyncio.run(main()) != main_thread
+
+
+def test_ttl_reuses_finished_result():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        flight = singleflight.SingleFlight("test_ttl", ttl=60)
+        return await flight.do("k", load), await flight.do("k", load)
+
+    assert asyncio.run(main()) == (1, 1)
+
+
+def test_failure_is_shared_and_not_cached():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def main():
+        flight = singleflight.SingleFlight("test_fail", ttl=60)
+        results = await asyncio.gather(*(flight.do("k", load) for _ in range(3)), return_exceptions=True)
+        with pytest.raises(ValueError):
+            await flight.do("k", load)
+        return results
+
+    assert all(isinstance(r, ValueError) for r in asyncio.run(main()))
+    assert len(calls) == 2
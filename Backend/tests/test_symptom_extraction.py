@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import symptom_extraction as se
+
+CODES = list(se.LEXICON)
+
+
+def detect(text):
+    return se.extract_lexicon(text, CODES)["detected"]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("сильный кашель", {"COUGH": 3}),
+    ("немного болит горло", {"SORE_THROAT": 1}),
+    ("насморк и кашель", {"COUGH": 2, "RUNNY_NOSE": 2}),
+    ("лающий кашель", {"COUGH": 3, "STRIDOR": 2}),
+    ("кашель не прекращается", {"COUGH": 3}),
+    ("severe headache", {"HEADACHE": 3}),
+])
+def test_detects_symptoms_and_severity(text, expected):
+    assert detect(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("нет температуры", {}),
+    ("без температуры", {}),
+    ("нет сильного кашля", {}),
+    ("no fever", {}),
+    # Negation stays inside its clause
+    ("температуры нет, кашель сильный", {"COUGH": 3}),
+    ("болит голова, но температуры нет", {"HEADACHE": 2}),
+    ("не кашляет, температура 39", {"FEVER": 3}),
+    # A post-positional "нет" only negates the match before it
+    ("температуры нет кашель сильный", {"COUGH": 3}),
+])
+def test_negation_scope(text, expected):
+    assert detect(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "температура нормальная",
+    "normal temperature",
+    "жарко на улице",
+    "температура 36.6",
+])
+def test_no_fever(text):
+    assert "FEVER" not in detect(text)
+
+
+@pytest.mark.parametrize("text, severity", [
+    ("температура 37.2", 1),
+    ("температура 38", 2),
+    ("температура 38,5, кашель", 3),
+    ("39.5", 3),
+    ("38 градусов", 2),
+    ("жар", 2),
+])
+def test_fever_from_temperature(text, severity):
+    assert detect(text)["FEVER"] == severity
+
+
+def test_coverage():
+    assert se.extract_lexicon("сильный кашель", CODES)["coverage"] == 1.0
+    assert se.extract_lexicon("жарко на улице", CODES)["coverage"] == 0.0
+
+
+def test_aho_corasick_reports_overlaps():
+    matcher = se.AhoCorasick([("he", 1), ("she", 2), ("hers", 3)])
+    assert sorted(matcher.find("ushers")) == [(1, 4, 2), (2, 4, 1), (2, 6, 3)]
+
+
+def test_normalize():
+    assert se.normalize("  Ёлка,   ЖАР!! ") == "елка, жар!!"
+
+
+def test_llm_fallback_and_cache():
+    stub = se.StubSymptomExtractor({"NAUSEA": 2, "UNKNOWN": 3})
+    se.set_llm_backend(stub)
+    try:
+        first = asyncio.run(se.extract_symptoms("что-то непонятное со мной", CODES))
+        again = asyncio.run(se.extract_symptoms("Что-то непонятное  со мной", CODES))
+    finally:
+        se.set_llm_backend(None)
+    assert first["source"] == "llm"
+    assert first["detected"] == {"NAUSEA": 2}
+    assert again["cached"] and stub.calls == 1
+
+
+def test_lexicon_hit_skips_llm():
+    stub = se.StubSymptomExtractor({"NAUSEA": 2})
+    se.set_llm_backend(stub)
+    try:
+        result = asyncio.run(se.extract_symptoms("сильный кашель", CODES))
+    finally:
+        se.set_llm_backend(None)
+    assert result["source"] == "lexicon" and stub.calls == 0
+    assert result["symptoms"][CODES.index("COUGH")] == 3
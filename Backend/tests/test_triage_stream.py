@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+import triage_stream
+
+
+def test_seen_ids_accepts_late_smaller_ids_once():
+    seen = triage_stream.SeenIds()
+    assert seen.add(10)
+    assert seen.add(8)  # committed after 10
+    assert not seen.add(8)
+    assert not seen.add(10)
+
+
+def test_seen_ids_prunes_below_the_overlap_window():
+    seen = triage_stream.SeenIds()
+    for event_id in range(1, 10 * triage_stream.OVERLAP_IDS):
+        seen.add(event_id)
+    assert len(seen.ids) <= 4 * triage_stream.OVERLAP_IDS + 1
+    assert not seen.add(seen.high - 1)
+
+
+def test_replay_keeps_each_patients_newest_event():
+    events = [
+        {"id": 1, "patient_id": 5, "zone": "red"},
+        {"id": 2, "patient_id": 6, "zone": "green"},
+        {"id": 3, "patient_id": 5, "zone": "yellow"},
+    ]
+    assert triage_stream.latest_per_patient(events) == events[1:]
+
+
+class _Stop(BaseException):
+    pass
+
+
+class _FakeCursor:
+    def __init__(self, backlog):
+        self.backlog = backlog
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if "MAX(event_id)" in sql:
+            self.rows = [(self.backlog + 10,)]
+        elif sql.lstrip().startswith("SELECT event_id"):
+            self.rows = [(10 + i, 1, "red") for i in range(min(self.backlog, params[1]))]
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+
+class _FakeConn:
+    def __init__(self, backlog):
+        self.backlog = backlog
+
+    def cursor(self):
+        return _FakeCursor(self.backlog)
+
+    def close(self):
+        pass
+
+
+class _InlineLoop:
+    def call_soon_threadsafe(self, fn, *args):
+        fn(*args)
+
+
+def _catch_up(monkeypatch, backlog):
+    monkeypatch.setattr(triage_stream.psycopg2, "connect", lambda dsn: _FakeConn(backlog))
+
+    def stop(*args):
+        raise _Stop
+    monkeypatch.setattr(triage_stream.select, "select", stop)
+    # A listener error would otherwise back off and reconnect forever
+    monkeypatch.setattr(triage_stream.time, "sleep", stop)
+    broadcaster = triage_stream.TriageBroadcaster("postgresql://fake")
+    broadcaster.loop = _InlineLoop()
+    broadcaster.last_event_id = 10
+    sub = triage_stream.Subscriber()
+    broadcaster.subscribers.add(sub)
+    with pytest.raises(_Stop):
+        broadcaster._listen_forever()
+    events = []
+    while not sub.queue.empty():
+        events.append(sub.queue.get_nowait())
+    return broadcaster, events
+
+
+def test_reconnect_replays_a_small_backlog(monkeypatch):
+    broadcaster, events = _catch_up(monkeypatch, 3)
+    assert [e["id"] for e in events] == [10, 11, 12]
+    assert broadcaster.last_event_id == 12
+
+
+def test_reconnect_sends_resync_when_the_backlog_exceeds_the_replay_limit(monkeypatch):
+    broadcaster, events = _catch_up(monkeypatch, triage_stream.REPLAY_LIMIT + 5)
+    assert events == [triage_stream.RESYNC]
+    assert broadcaster.last_event_id == triage_stream.REPLAY_LIMIT + 15
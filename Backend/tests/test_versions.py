@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+import versions
+
+
+def test_etag_is_weak_and_per_resource():
+    assert versions.etag("history", 7) == 'W/"history-7"'
+    assert versions.etag("history", 7) != versions.etag("triage", 7)
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ("", False),
+    ('W/"history-7"', True),
+    ('W/"history-6", W/"history-7"', True),
+    ("*", True),
+    ('W/"history-8"', False),
+])
+def test_not_modified(header, matches):
+    assert versions.not_modified(header, 'W/"history-7"') is matches
+
+
+def test_bump_many_includes_global_once_per_patient(monkeypatch):
+    sent = []
+    monkeypatch.setattr(versions.psycopg2.extras, "execute_values",
+                        lambda cur, sql, rows, **kw: sent.extend(rows))
+    versions.bump_many(object(), [3, 1, 3])
+    assert sent == [("global", 1), ("patient:1", 1), ("patient:3", 1)]
+    sent.clear()
+    versions.bump(object())
+    assert sent == [("global", 1)]
@@ -0,0 +1,220 @@
+"""
+Push-based triage updates: Postgres LISTEN/NOTIFY fanned out over Server-Sent Events.
+
+Writers call emit() inside their transaction. It appends a row to triage_events
+(event ids are global across workers) and issues NOTIFY with the new event,
+which Postgres delivers only on commit. Each worker keeps one LISTEN connection
+in a background thread and hands events to per-subscriber bounded queues.
+
+A subscriber that falls behind gets its queue replaced by a single "resync"
+event (refetch /list_patients_triage) instead of stalling the fan-out.
+Reconnecting clients send Last-Event-ID and are replayed from triage_events.
+
+Event ids come from a sequence, but NOTIFYs arrive in commit order, so a
+smaller id can show up after a larger one. Replays therefore re-scan
+OVERLAP_IDS ids below the last one seen, and every consumer drops ids it
+already delivered (SeenIds) rather than everything below its high-water mark.
+subscribe() waits until the listener is LISTENing before the caller replays,
+so nothing committed in between falls through.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+import psycopg2
+
+from db import DATABASE_URL
+
+logger = logging.getLogger("tms")
+
+CHANNEL = "triage"
+QUEUE_SIZE = int(os.environ.get("TRIAGE_STREAM_QUEUE_SIZE", "100"))
+HEARTBEAT_SECONDS = 15
+REPLAY_LIMIT = 1000
+# Ids handed out before the last one seen that may still commit later
+OVERLAP_IDS = int(os.environ.get("TRIAGE_STREAM_OVERLAP_IDS", "100"))
+LISTEN_WAIT_SECONDS = 5
+RETENTION_HOURS = int(os.environ.get("TRIAGE_EVENTS_RETENTION_HOURS", "24"))
+
+RESYNC = {"event": "resync"}
+
+
+def emit(cur, patient_id: int, zone: str) -> None:
+    """Record and announce a zone change. One statement; delivered on COMMIT."""
+    cur.execute("""
+        WITH ev AS (
+            INSERT INTO triage_events(patient_id, zone) VALUES (%s, %s)
+            RETURNING event_id, patient_id, zone
+        )
+        SELECT pg_notify(%s, json_build_object('id', event_id, 'patient_id', patient_id, 'zone', zone)::text)
+        FROM ev
+    """, (patient_id, zone, CHANNEL))
+
+
+def events_since(cur, last_event_id: int, limit: int = REPLAY_LIMIT) -> List[Dict[str, Any]]:
+    """Events after `last_event_id`, plus the OVERLAP_IDS before it that may
+    have committed after it; callers dedupe with SeenIds."""
+    cur.execute("""
+        SELECT event_id, patient_id, zone
+        FROM triage_events
+        WHERE event_id > %s
+        ORDER BY event_id
+        LIMIT %s
+    """, (max(0, last_event_id - OVERLAP_IDS), limit))
+    return [{"id": r[0], "patient_id": r[1], "zone": r[2]} for r in cur.fetchall()]
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    if event is RESYNC:
+        return "event: resync\ndata: {}\n\n"
+    payload = json.dumps({"patient_id": event["patient_id"], "zone": event["zone"]})
+    return f"id: {event['id']}\nevent: zone\ndata: {payload}\n\n"
+
+
+def latest_per_patient(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Keep each patient's newest event from a replay, so re-sent overlap events
+    can't roll a client back to an older zone."""
+    latest = {e["patient_id"]: e for e in events}
+    return sorted(latest.values(), key=lambda e: e["id"])
+
+
+class SeenIds:
+    """Ids already delivered, kept for the OVERLAP_IDS window a re-scan can repeat."""
+
+    def __init__(self):
+        self.ids: Set[int] = set()
+        self.high = 0
+
+    def add(self, event_id: int) -> bool:
+        """True the first time an id is offered."""
+        if event_id in self.ids:
+            return False
+        self.ids.add(event_id)
+        if event_id > self.high:
+            self.high = event_id
+            if len(self.ids) > 4 * OVERLAP_IDS:
+                self.ids = {i for i in self.ids if i > self.high - 2 * OVERLAP_IDS}
+        return True
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.seen = SeenIds()
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer: drop the backlog, tell the client to refetch the full list
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class TriageBroadcaster:
+    """One LISTEN connection per worker, started lazily with the first subscriber."""
+
+    def __init__(self, dsn: str = DATABASE_URL):
+        self.dsn = dsn
+        self.subscribers: Set[Subscriber] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.last_event_id = 0
+        self.published = SeenIds()
+        self.listening = threading.Event()
+
+    async def subscribe(self) -> Subscriber:
+        """Register a subscriber and wait (up to LISTEN_WAIT_SECONDS) until the
+        listener is LISTENing, so a replay started afterwards leaves no gap."""
+        self.loop = asyncio.get_running_loop()
+        sub = Subscriber()
+        self.subscribers.add(sub)
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._listen_forever, name="triage-listener", daemon=True)
+            self.thread.start()
+        if not self.listening.is_set():
+            # If the database is down, the listener's catch-up on reconnect covers the gap
+            await self.loop.run_in_executor(None, self.listening.wait, LISTEN_WAIT_SECONDS)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        self.subscribers.discard(sub)
+
+    def _dispatch(self, events: List[Dict[str, Any]]) -> None:
+        for event in events:
+            for sub in list(self.subscribers):
+                sub.offer(event)
+
+    def _publish(self, events: List[Dict[str, Any]]) -> None:
+        events = [e for e in events if self.published.add(e["id"])]
+        if not events:
+            return
+        self.last_event_id = max(self.last_event_id, max(e["id"] for e in events))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._dispatch, events)
+
+    def _resync(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._dispatch, [RESYNC])
+
+    def _listen_forever(self) -> None:
+        backoff = 1
+        last_prune = 0.0
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {CHANNEL}")
+                self.listening.set()
+                missed = events_since(cur, self.last_event_id) if self.last_event_id else []
+                if len(missed) < REPLAY_LIMIT:
+                    # Catch up on whatever was committed while we were disconnected
+                    self._publish(missed)
+                if not self.last_event_id or len(missed) >= REPLAY_LIMIT:
+                    cur.execute("SELECT COALESCE(MAX(event_id), 0) FROM triage_events")
+                    self.last_event_id = cur.fetchone()[0]
+                    if missed:
+                        # Too much to replay: every client refetches the full list
+                        self._resync()
+                backoff = 1
+                while True:
+                    if time.monotonic() - last_prune > 3600:
+                        cur.execute(
+                            "DELETE FROM triage_events WHERE created_at < NOW() - make_interval(hours => %s)",
+                            (RETENTION_HOURS,),
+                        )
+                        last_prune = time.monotonic()
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    events = []
+                    while conn.notifies:
+                        note = conn.notifies.pop(0)
+                        try:
+                            events.append(json.loads(note.payload))
+                        except json.JSONDecodeError:
+                            logger.warning("Malformed triage notification: %s", note.payload)
+                    self._publish(events)
+            except Exception as e:
+                self.listening.clear()
+                logger.error("Triage listener error, reconnecting in %ds: %s", backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+broadcaster = TriageBroadcaster()
@@ -0,0 +1,47 @@
+"""
+Data version counters behind the ETags of history, triage and lab endpoints.
+
+"global" moves on every diary / lab / registration write, "patient:<id>" on
+writes that touch that patient. Writers bump inside their own transaction, so a
+version is never visible before the data it describes. Readers look the version
+up first; an unchanged version answers 304 without touching encrypted rows.
+"""
+
+from typing import Iterable, Optional
+
+import psycopg2.extras
+
+import db
+
+# Runs on every ETag request
+DATA_VERSION = db.prepare("data_version", "SELECT version FROM data_versions WHERE scope = $1")
+
+
+def bump(cur, patient_id: Optional[int] = None) -> None:
+    bump_many(cur, [] if patient_id is None else [patient_id])
+
+
+def bump_many(cur, patient_ids: Iterable[int]) -> None:
+    """"global" plus every listed patient, in one round trip."""
+    scopes = ["global"] + [f"patient:{pid}" for pid in sorted(set(patient_ids))]
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO data_versions(scope, version) VALUES %s
+        ON CONFLICT (scope) DO UPDATE SET version = data_versions.version + 1
+    """, [(scope, 1) for scope in scopes])
+
+
+def get(cur, scope: str) -> int:
+    db.execute_prepared(cur, DATA_VERSION, (scope,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def etag(resource: str, version: int) -> str:
+    return f'W/"{resource}-{version}"'
+
+
+def not_modified(if_none_match: Optional[str], current: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or current in tags
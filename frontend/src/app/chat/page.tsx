@@ -15,10 +15,10 @@ import { Input } from "@/components/ui/input";
 import { ChatMessage } from "@/components/ChatMessage";
 import { DiagnosisCard } from "@/components/DiagnosisCard";
 import { DiagnosisSkeleton } from "@/components/DiagnosisSkeleton";
-import { analyzeSymptoms } from "@/app/actions/analyzeSymptoms";
+import { analyzeSymptoms, type SymptomsResult } from "@/app/actions/analyzeSymptoms";
 import { generateExplanation } from "@/app/actions/generateExplanation";
-import { getSymptomLabel, type SymptomCode } from "@/lib/symptoms";
-import { sendAnalysis, saveExplanation, getHistory, logout as apiLogout, type HistoryEntry } from "@/lib/api";
+import { getSymptomLabel, SYMPTOM_LIST, type SymptomCode } from "@/lib/symptoms";
+import { sendAnalysis, saveExplanation, explainDiagnosis, extractSymptoms, getHistory, newIdempotencyKey, logout as apiLogout, type ExtractSymptomsResponse, type HistoryEntry } from "@/lib/api";
 import { getDiseaseLabel } from "@/lib/diseaseWeights";
 import type { DiagnosisResult } from "@/lib/types";
 import { t, getLang, setLang, type Lang } from "@/lib/i18n";
@@ -70,9 +70,16 @@ function saveMessages(patientId: number, msgs: Message[]): void {
   }
 }
 
-// LLM (Groq) используется только для парсинга текста → вектор симптомов.
+// Симптомы извлекает бэкенд (/extract_symptoms: словарь, LLM только если словарь
+// не справился); analyzeSymptoms (LLM) — запасной путь, если бэкенд недоступен.
 // Предикт делается на бэкенде через /analys (ML модель).
 
+function toSymptomsResult(extracted: ExtractSymptomsResponse): SymptomsResult {
+  const vector = SYMPTOM_LIST.map((code) => extracted.detected[code] ?? 0);
+  const detectedSymptoms = SYMPTOM_LIST.flatMap((code, i) => (vector[i] > 0 ? [`${code} (${vector[i]})`] : []));
+  return { vector, detectedSymptoms, noSymptoms: extracted.no_symptoms };
+}
+
 const LANG_CYCLE: Lang[] = ["ru", "en", "kk"];
 const LANG_LABELS: Record<Lang, string> = { ru: "RU", en: "EN", kk: "KZ" };
 
@@ -90,6 +97,9 @@ export default function ChatPage() {
   const [historyLoading, setHistoryLoading] = useState(false);
   const [cooldown, setCooldown] = useState(0);
   const [lang, setLangState] = useState<Lang>("ru");
+  // Key of the last /analys that didn't come back: sending the same symptoms
+  // again (e.g. after a timeout) reuses it, so the diary day is saved only once
+  const pendingAnalysis = useRef<{ symptoms: string; key: string } | null>(null);
 
   useEffect(() => {
     const id = localStorage.getItem("patient_id");
@@ -159,8 +169,9 @@ export default function ChatPage() {
     setIsLoading(true);
 
     try {
-      // Step 1: LLM extracts symptoms from text
-      const symptomResult = await analyzeSymptoms(text);
+      // Step 1: extract symptoms from text
+      const extracted = await extractSymptoms(text).catch(() => null);
+      const symptomResult = extracted ? toSymptomsResult(extracted) : await analyzeSymptoms(text);
 
       const { vector, detectedSymptoms, error, noSymptoms } = symptomResult;
 
@@ -193,7 +204,16 @@ export default function ChatPage() {
       }
 
       // Step 2: Send symptoms to backend ML model for prediction + storage
-      const analysisResult = await sendAnalysis(patientId, vector, "Nothing").catch(() => null);
+      const symptomsKey = vector.join(",");
+      let pending = pendingAnalysis.current;
+      if (!pending || pending.symptoms !== symptomsKey) {
+        pending = { symptoms: symptomsKey, key: newIdempotencyKey() };
+        pendingAnalysis.current = pending;
+      }
+      const analysisResult = await sendAnalysis(patientId, vector, "Nothing", pending.key).catch(() => null);
+      if (analysisResult) {
+        pendingAnalysis.current = null;
+      }
 
       // Build DiagnosisResult from backend response
       const diagnosis: DiagnosisResult = analysisResult
@@ -236,21 +256,28 @@ export default function ChatPage() {
         score: s.score,
       }));
 
-      const { patientExplanation, doctorExplanation } = await generateExplanation(
-        text,
-        detectedSymptoms,
-        diagnosis.diseaseName,
-        diagnosis.diseaseLabel,
-        topDiseases,
-        undefined,
-        lang,
-      );
+      // Backend caches explanations per top-3 + symptom pattern and saves them
+      // to the diary day; fall back to generating here if it is unavailable
+      const cached = analysisResult?.day
+        ? await explainDiagnosis(vector, lang, analysisResult.day).catch(() => null)
+        : null;
+      const { patientExplanation, doctorExplanation } = cached
+        ? { patientExplanation: cached.patient_explanation, doctorExplanation: cached.doctor_explanation }
+        : await generateExplanation(
+            text,
+            detectedSymptoms,
+            diagnosis.diseaseName,
+            diagnosis.diseaseLabel,
+            topDiseases,
+            undefined,
+            lang,
+          );
 
       diagnosis.patientExplanation = patientExplanation;
       diagnosis.doctorExplanation = doctorExplanation;
 
-      // Step 4b: Save explanations to DB (fire-and-forget)
-      if (analysisResult?.day) {
+      // Step 4b: Save locally generated explanations to DB (fire-and-forget)
+      if (!cached && analysisResult?.day) {
         saveExplanation(analysisResult.day, patientExplanation, doctorExplanation).catch(() => {});
       }
 
@@ -5,7 +5,7 @@ import { useRouter } from "next/navigation";
 import { Upload, ArrowLeft, FlaskConical, Loader2, ImageIcon, ShieldCheck } from "lucide-react";
 import { Button } from "@/components/ui/button";
 import { LabResultCard } from "@/components/LabResultCard";
-import { uploadLabResult, getLabResults, type LabResult } from "@/lib/api";
+import { uploadLabResult, getLabResults, newIdempotencyKey, type LabResult } from "@/lib/api";
 import { t, getLang, type Lang } from "@/lib/i18n";
 
 async function cropTopOfImage(file: File, cropPercent = 0.15): Promise<File> {
@@ -48,6 +48,9 @@ export default function LabPage() {
   const [error, setError] = useState<string | null>(null);
   const [dragOver, setDragOver] = useState(false);
   const [cropEnabled, setCropEnabled] = useState(true);
+  // The exact bytes and key of the current upload: retrying it replays the
+  // stored result instead of running OCR again. Reset when the photo or crop changes
+  const pendingUpload = useRef<{ file: File; key: string } | null>(null);
 
   useEffect(() => {
     const id = localStorage.getItem("patient_id");
@@ -89,6 +92,7 @@ export default function LabPage() {
     setError(null);
     setSelectedFile(file);
     setCurrentResult(null);
+    pendingUpload.current = null;
 
     const displayFile = cropEnabled ? await cropTopOfImage(file) : file;
     const reader = new FileReader();
@@ -114,8 +118,12 @@ export default function LabPage() {
     setError(null);
 
     try {
-      const fileToSend = cropEnabled ? await cropTopOfImage(selectedFile) : selectedFile;
-      const result = await uploadLabResult(patientId, fileToSend);
+      if (!pendingUpload.current) {
+        const fileToSend = cropEnabled ? await cropTopOfImage(selectedFile) : selectedFile;
+        pendingUpload.current = { file: fileToSend, key: newIdempotencyKey() };
+      }
+      const { file, key } = pendingUpload.current;
+      const result = await uploadLabResult(patientId, file, key);
       setCurrentResult(result);
       loadHistory();
     } catch (err: unknown) {
@@ -130,6 +138,7 @@ export default function LabPage() {
   }
 
   function resetUpload() {
+    pendingUpload.current = null;
     setSelectedFile(null);
     setPreview(null);
     setCurrentResult(null);
@@ -139,6 +148,7 @@ export default function LabPage() {
   async function toggleCrop() {
     const next = !cropEnabled;
     setCropEnabled(next);
+    pendingUpload.current = null;
     if (selectedFile) {
       const displayFile = next ? await cropTopOfImage(selectedFile) : selectedFile;
       const reader = new FileReader();
@@ -7,6 +7,10 @@ const api = axios.create({
   headers: { "Content-Type": "application/json" },
 });
 
+// Time of our last write (X-Last-Write); echoed back so reads right after a
+// write are served from the primary, not a lagging replica
+let lastWrite: string | null = null;
+
 // Attach JWT token to every request if available
 api.interceptors.request.use((config) => {
   if (typeof window !== "undefined") {
@@ -15,15 +19,71 @@ api.interceptors.request.use((config) => {
       config.headers.Authorization = `Bearer ${token}`;
     }
   }
+  if (lastWrite) {
+    config.headers["X-Last-Write"] = lastWrite;
+  }
   return config;
 });
 
-// Handle 401 responses — redirect to login
+function storeTokens(data: { access_token?: string; refresh_token?: string | null }): void {
+  if (data.access_token) {
+    localStorage.setItem("access_token", data.access_token);
+  }
+  if (data.refresh_token) {
+    localStorage.setItem("refresh_token", data.refresh_token);
+  }
+}
+
+// Single in-flight refresh shared by all requests that hit 401 at once
+let refreshPromise: Promise<string | null> | null = null;
+
+function refreshAccessToken(): Promise<string | null> {
+  const refreshToken = localStorage.getItem("refresh_token");
+  if (!refreshToken) return Promise.resolve(null);
+  if (!refreshPromise) {
+    refreshPromise = axios
+      .post<{ access_token: string; refresh_token: string }>(`${API_URL}/token/refresh`, {
+        refresh_token: refreshToken,
+      })
+      .then(({ data }) => {
+        storeTokens(data);
+        return data.access_token;
+      })
+      .catch(() => null)
+      .finally(() => {
+        refreshPromise = null;
+      });
+  }
+  return refreshPromise;
+}
+
+// Handle 401 responses — try the refresh token once, then redirect to login
 api.interceptors.response.use(
-  (response) => response,
-  (error) => {
+  (response) => {
+    const written = response.headers["x-last-write"];
+    if (written) {
+      lastWrite = written;
+    }
+    return response;
+  },
+  async (error) => {
+    const original = error.config;
+    if (
+      error.response?.status === 401 &&
+      typeof window !== "undefined" &&
+      original &&
+      !original._retried
+    ) {
+      original._retried = true;
+      const token = await refreshAccessToken();
+      if (token) {
+        original.headers.Authorization = `Bearer ${token}`;
+        return api(original);
+      }
+    }
     if (error.response?.status === 401 && typeof window !== "undefined") {
       localStorage.removeItem("access_token");
+      localStorage.removeItem("refresh_token");
       localStorage.removeItem("patient_id");
       localStorage.removeItem("patient_name");
       localStorage.removeItem("pairing_code");
@@ -36,21 +96,44 @@ api.interceptors.response.use(
   }
 );
 
+// Conditional POSTs: remember the last body per ETag and let the backend answer 304
+const etagCache = new Map<string, { etag: string; data: unknown }>();
+
+async function postCached<T>(url: string, body: object): Promise<T> {
+  const key = `${url}:${JSON.stringify(body)}`;
+  const cached = etagCache.get(key);
+  const response = await api.post<T>(url, body, {
+    headers: cached ? { "If-None-Match": cached.etag } : {},
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+  });
+  if (response.status === 304 && cached) {
+    return cached.data as T;
+  }
+  const etag = response.headers["etag"];
+  if (etag) {
+    etagCache.set(key, { etag, data: response.data });
+  }
+  return response.data;
+}
+
 export interface RegisterResponse {
   patient_id: number;
   access_token: string;
+  refresh_token?: string | null;
   token_type: string;
 }
 
 export interface LoginResponse {
   login: boolean;
   access_token: string;
+  refresh_token?: string | null;
   token_type: string;
 }
 
 export interface DoctorLoginResponse {
   login: boolean;
   access_token: string;
+  refresh_token?: string | null;
   token_type: string;
   doctor: {
     doctor_id: number;
@@ -119,9 +202,7 @@ export async function registerPatient(
     city,
     password,
   });
-  if (data.access_token) {
-    localStorage.setItem("access_token", data.access_token);
-  }
+  storeTokens(data);
   return data;
 }
 
@@ -133,31 +214,37 @@ export async function loginPatient(
     patient_id: patientId,
     password,
   });
-  if (data.access_token) {
-    localStorage.setItem("access_token", data.access_token);
-  }
+  storeTokens(data);
   return data;
 }
 
+// Idempotency keys are made by the caller, once per submission (a diary
+// entry, a selected photo): a retry after a timeout or a failed response must
+// send the same key, or the backend records the day / runs the OCR twice
+export function newIdempotencyKey(): string {
+  return crypto.randomUUID();
+}
+
 export async function sendAnalysis(
   _patientId: number,
   symptoms: number[],
-  diagnoseSetup: string
+  diagnoseSetup: string,
+  idempotencyKey: string
 ): Promise<AnalysResponse> {
-  const { data } = await api.post<AnalysResponse>("/analys", {
-    symptoms,
-    diagnose_setup: diagnoseSetup,
-  });
+  const { data } = await api.post<AnalysResponse>(
+    "/analys",
+    { symptoms, diagnose_setup: diagnoseSetup },
+    { headers: { "Idempotency-Key": idempotencyKey } }
+  );
   return data;
 }
 
 export async function getHistory(
   patientId: number
 ): Promise<{ history: HistoryEntry[] }> {
-  const { data } = await api.post<{ history: HistoryEntry[] }>("/get_history", {
+  return postCached<{ history: HistoryEntry[] }>("/get_history", {
     patient_id: patientId,
   });
-  return data;
 }
 
 export async function loginDoctor(
@@ -168,9 +255,7 @@ export async function loginDoctor(
     doctor_id: doctorId,
     password,
   });
-  if (data.access_token) {
-    localStorage.setItem("access_token", data.access_token);
-  }
+  storeTokens(data);
   return data;
 }
 
@@ -202,8 +287,7 @@ export interface TriagePatient {
 }
 
 export async function listPatientsTriage(): Promise<{ patients: TriagePatient[] }> {
-  const { data } = await api.post<{ patients: TriagePatient[] }>("/list_patients_triage", {});
-  return data;
+  return postCached<{ patients: TriagePatient[] }>("/list_patients_triage", {});
 }
 
 export async function getPatientInfo(
@@ -239,6 +323,41 @@ export async function saveExplanation(
   return data;
 }
 
+export interface ExtractSymptomsResponse {
+  symptoms: number[];
+  detected: Record<string, number>;
+  coverage: number;
+  source: "lexicon" | "llm";
+  no_symptoms: boolean;
+  cached: boolean;
+}
+
+// Lexicon first on the server; the LLM only sees texts the lexicon can't cover
+export async function extractSymptoms(text: string): Promise<ExtractSymptomsResponse> {
+  const { data } = await api.post<ExtractSymptomsResponse>("/extract_symptoms", { text });
+  return data;
+}
+
+export interface ExplainResponse {
+  patient_explanation: string;
+  doctor_explanation: string;
+  source: "memory" | "db" | "generated";
+}
+
+// Cached server-side; with dayId the texts are also saved to that diary day
+export async function explainDiagnosis(
+  symptoms: number[],
+  lang: "ru" | "en" | "kk",
+  dayId?: number
+): Promise<ExplainResponse> {
+  const { data } = await api.post<ExplainResponse>("/explain_diagnosis", {
+    symptoms,
+    lang,
+    ...(dayId ? { day_id: dayId } : {}),
+  });
+  return data;
+}
+
 export async function updateByDoctor(
   patientId: number,
   dayId: number,
@@ -271,11 +390,14 @@ export interface LabResult {
   results: LabResultItem[];
   interpretation: string;
   created_at?: string;
+  has_image?: boolean;
+  has_thumbnail?: boolean;
 }
 
 export async function uploadLabResult(
   _patientId: number,
-  imageFile: File
+  imageFile: File,
+  idempotencyKey: string
 ): Promise<LabResult> {
   const formData = new FormData();
   formData.append("image", imageFile);
@@ -284,6 +406,7 @@ export async function uploadLabResult(
   const { data } = await axios.post<LabResult>(`${API_URL}/upload_lab_result`, formData, {
     headers: {
       "Content-Type": "multipart/form-data",
+      "Idempotency-Key": idempotencyKey,
       ...(token ? { Authorization: `Bearer ${token}` } : {}),
     },
   });
@@ -293,12 +416,22 @@ export async function uploadLabResult(
 export async function getLabResults(
   _patientId?: number
 ): Promise<{ results: LabResult[] }> {
-  const { data } = await api.post<{ results: LabResult[] }>("/get_lab_results", {});
-  return data;
+  return postCached<{ results: LabResult[] }>("/get_lab_results", {});
+}
+
+// Object URL for a stored lab photo (revoke it when the <img> unmounts)
+export async function getLabImageUrl(resultId: number, thumb = false): Promise<string> {
+  const { data } = await api.get<Blob>(`/lab_image/${resultId}`, {
+    params: thumb ? { thumb: true } : {},
+    responseType: "blob",
+  });
+  return URL.createObjectURL(data);
 }
 
 export function logout(): void {
+  etagCache.clear();
   localStorage.removeItem("access_token");
+  localStorage.removeItem("refresh_token");
   localStorage.removeItem("patient_id");
   localStorage.removeItem("patient_name");
   localStorage.removeItem("pairing_code");